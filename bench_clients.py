@@ -0,0 +1,118 @@
+"""
+共有Session（clients.http_session）と、リクエストごとの requests.post の比較ベンチマーク
+ローカルのHTTPSサーバー（自己署名証明書）に対してリクエストを送り、1リクエストあたりの時間と
+TLSハンドシェイク（新しい接続）の回数を比べる
+
+使い方: python bench_clients.py --requests 200
+"""
+import argparse
+import os
+import ssl
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import clients
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """LINE APIの代わりに200を返すハンドラー（キープアライブのためHTTP/1.1で応答する）"""
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with StandInHandler.lock:
+            StandInHandler.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b'{}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_certificate(directory):
+    """自己署名証明書を作成"""
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+         '-keyout', key, '-out', cert, '-subj', '/CN=localhost',
+         '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1'],
+        check=True, capture_output=True
+    )
+    return cert, key
+
+
+def start_server(cert, key):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(label, send, count):
+    StandInHandler.connections = 0
+    timings = []
+    for _ in range(count):
+        started = time.perf_counter()
+        send()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        'label': label,
+        'mean': statistics.mean(timings),
+        'p50': timings[len(timings) // 2],
+        'p95': timings[int(len(timings) * 0.95) - 1],
+        'connections': StandInHandler.connections
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='各方式で送るリクエスト数')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        cert, key = create_certificate(directory)
+        server = start_server(cert, key)
+        url = f'https://127.0.0.1:{server.server_address[1]}/v2/bot/chat/loading/start'
+        payload = {'chatId': 'U0000000000', 'loadingSeconds': 20}
+
+        session = clients.http_session()
+        # 初回の接続はどちらの方式でも発生するので事前に1回送っておく
+        session.post(url, json=payload, verify=cert, timeout=clients.http_timeout())
+
+        results = [
+            run('requests.post（毎回接続）',
+                lambda: requests.post(url, json=payload, verify=cert), args.requests),
+            run('clients.http_session（共有Session）',
+                lambda: session.post(url, json=payload, verify=cert, timeout=clients.http_timeout()),
+                args.requests),
+        ]
+        server.shutdown()
+
+    print(f"{'方式':<36}{'平均(ms)':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'新規接続':>10}")
+    for r in results:
+        print(f"{r['label']:<36}{r['mean']:>10.2f}{r['p50']:>10.2f}{r['p95']:>10.2f}{r['connections']:>10}")
+    saved = results[0]['mean'] - results[1]['mean']
+    print(f"1リクエストあたりの削減: {saved:.2f}ms（{saved / results[0]['mean'] * 100:.1f}%）")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+モデルのプロバイダーのルーティングの確認
+実際のAPIの代わりにFakeProviderを使い、次の場合の応答時間と各プロバイダーの呼び出し回数を比べる
+- tail: 最初のプロバイダーの一部の呼び出しだけが遅い（ヘッジングなし / あり）
+- outage: 最初のプロバイダーが失敗し続ける（サーキットブレーカーで切り替わる）
+
+使い方: python bench_llm_routing.py --requests 200 --tail-rate 0.1 --tail-ms 3000
+"""
+import argparse
+import logging
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import llm_providers
+from deadline import Deadline
+
+SYSTEM = 'あなたはテスト用のアシスタントです。'
+MESSAGES = [{'role': 'user', 'content': 'こんにちは'}]
+
+
+def run(router, requests, concurrency, budget_ms):
+    def call(_):
+        started = time.perf_counter()
+        deadline = Deadline(time.monotonic() + budget_ms / 1000, budget_ms)
+        try:
+            completion = router.generate(SYSTEM, MESSAGES, deadline)
+            outcome = 'truncated' if completion.truncated else completion.provider
+        except llm_providers.ProviderUnavailable:
+            outcome = 'unavailable'
+        return (time.perf_counter() - started) * 1000, outcome
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(call, range(requests)))
+    latencies = sorted(ms for ms, _ in results)
+    outcomes = {}
+    for _, outcome in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    return {
+        'p50Ms': round(statistics.median(latencies)),
+        'p95Ms': round(latencies[int(len(latencies) * 0.95) - 1]),
+        'p99Ms': round(latencies[int(len(latencies) * 0.99) - 1]),
+        'outcomes': outcomes
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='各シナリオのリクエスト数')
+    parser.add_argument('--concurrency', type=int, default=8, help='同時に送るリクエストの数')
+    parser.add_argument('--first-chunk-ms', type=float, default=150, help='通常の最初のチャンクまでの時間')
+    parser.add_argument('--tail-rate', type=float, default=0.1, help='遅くなる呼び出しの割合')
+    parser.add_argument('--tail-ms', type=float, default=3000, help='遅くなった呼び出しの最初のチャンクまでの時間')
+    parser.add_argument('--budget-ms', type=int, default=10000, help='1リクエストのデッドライン')
+    args = parser.parse_args()
+    # 切り替えのたびに出る警告は表示しない
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    for hedging in (False, True):
+        primary = llm_providers.FakeProvider(
+            'primary', first_chunk_ms=args.first_chunk_ms, jitter=0.3, tail_rate=args.tail_rate, tail_ms=args.tail_ms
+        )
+        secondary = llm_providers.FakeProvider('secondary', first_chunk_ms=args.first_chunk_ms * 1.5, jitter=0.3)
+        router = llm_providers.ProviderRouter([primary, secondary], hedging=hedging)
+        result = run(router, args.requests, args.concurrency, args.budget_ms)
+        print(f"tail（ヘッジング{'あり' if hedging else 'なし'}）: {result}、"
+              f"呼び出し回数 primary {primary.calls} / secondary {secondary.calls}")
+
+    primary = llm_providers.FakeProvider('primary', first_chunk_ms=args.first_chunk_ms, error_rate=1.0)
+    secondary = llm_providers.FakeProvider('secondary', first_chunk_ms=args.first_chunk_ms * 1.5)
+    router = llm_providers.ProviderRouter([primary, secondary])
+    result = run(router, args.requests, args.concurrency, args.budget_ms)
+    print(f"outage: {result}、呼び出し回数 primary {primary.calls} / secondary {secondary.calls}")
+    print(f"ルーターの状態: {router.stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+レスポンスのJSONエンコードのベンチマーク
+DynamoDBから読み込んだ形のプロフィール（数値はDecimal）を、従来の json.dumps(default=decimal_to_dict) と
+http_response.encode_json（標準ライブラリ / orjson）でエンコードして、1レスポンスあたりの時間を比べる
+
+使い方: python bench_response_encoding.py --items 50 --repeat 2000
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+from decimal import Decimal
+
+import http_response
+
+
+def decimal_to_dict(obj):
+    """従来の各ハンドラーにあった変換関数"""
+    if isinstance(obj, Decimal):
+        if obj % 1 == 0:
+            return int(obj)
+        else:
+            return float(obj)
+    raise TypeError("Type not serializable")
+
+
+def sample_profile(index):
+    """LineUserProfilesのアイテムと同じ形のダミーデータ"""
+    rng = random.Random(index)
+    return {
+        'lineId': f'U{index:032x}',
+        'profileId': f'U{index:032x}-1700000000',
+        'name': 'テストユーザー',
+        'birthDate': '1990-04-01',
+        'gender': rng.choice(['male', 'female']),
+        'height': Decimal(str(round(rng.uniform(150, 190), 1))),
+        'weight': Decimal(str(round(rng.uniform(45, 100), 1))),
+        'targetWeight': Decimal(str(round(rng.uniform(45, 90), 1))),
+        'targetPeriod': Decimal(rng.choice([3, 6, 12])),
+        'priority': '食事と運動のバランス',
+        'pastExperience': 'ジムに半年通っていた',
+        'exerciseFrequency': Decimal(rng.randint(0, 7)),
+        'mealFrequency': Decimal(rng.randint(2, 5)),
+        'alcoholFrequency': Decimal(rng.randint(0, 7)),
+        'allergies': {'えび', 'かに'},
+        'restrictions': 'なし',
+        'illness': 'なし',
+        'motivation': '健康診断の数値を改善したい',
+        'createdAt': Decimal(1700000000 + index),
+        'updatedAt': Decimal(1700000000 + index)
+    }
+
+
+def legacy_encode(body):
+    return json.dumps(body, default=decimal_to_dict)
+
+
+def stdlib_encode(body):
+    return json.dumps(body, default=http_response._default, ensure_ascii=False, separators=(',', ':'))
+
+
+def measure(encode, body, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        encode(body)
+        timings.append((time.perf_counter() - started) * 1_000_000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=1, help='1レスポンスに含めるプロフィールの数')
+    parser.add_argument('--repeat', type=int, default=2000, help='各方式でエンコードする回数')
+    args = parser.parse_args()
+
+    body = {
+        'message': 'Profile retrieved successfully!',
+        'data': [sample_profile(i) for i in range(args.items)]
+    }
+
+    # 従来の実装はセットを扱えないので、セットをリストにしたデータを渡す
+    legacy_body = {
+        **body,
+        'data': [{**item, 'allergies': sorted(item['allergies'])} for item in body['data']]
+    }
+
+    candidates = [
+        ('json.dumps(default=decimal_to_dict)', legacy_encode, legacy_body),
+        ('encode_json（標準ライブラリ）', stdlib_encode, body),
+    ]
+    if http_response.orjson is not None:
+        candidates.append(('encode_json（orjson）', http_response.encode_json, body))
+    else:
+        print('orjsonがインストールされていないため、orjsonの計測は省略します')
+
+    # どの方式でも同じ値になることを確認
+    expected = json.loads(legacy_encode(legacy_body))
+    for label, encode, data in candidates[1:]:
+        if json.loads(encode(data)) != expected:
+            raise SystemExit(f"{label} の出力が従来の実装と一致しません")
+
+    results = [(label, measure(encode, data, args.repeat)) for label, encode, data in candidates]
+    baseline = results[0][1]
+    print(f"{'方式':<40}{'中央値(µs)':>12}{'倍率':>8}")
+    for label, us in results:
+        print(f"{label:<40}{us:>12.1f}{baseline / us:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+ハンドラー間で共有するHTTP/AWSクライアント
+コネクションプールとキープアライブを有効にし、ウォームスタート時は同じクライアントを使い回す
+コールドスタートを短くするため、SDKの読み込みとクライアントの作成は最初に使うときまで遅らせる
+"""
+import os
+import socket
+import threading
+
+# HTTP（LINE API）のコネクションプールの大きさ
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '20'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '3'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '10'))
+
+# AWS SDK（botocore）の設定
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv('AWS_MAX_POOL_CONNECTIONS', '50'))
+AWS_CONNECT_TIMEOUT = float(os.getenv('AWS_CONNECT_TIMEOUT', '2'))
+AWS_READ_TIMEOUT = float(os.getenv('AWS_READ_TIMEOUT', '5'))
+AWS_MAX_ATTEMPTS = int(os.getenv('AWS_MAX_ATTEMPTS', '4'))
+# read_timeoutはストリーミングのチャンク間で待つ最大秒数（長いとデッドラインの判定が遅れるため短めにする）
+BEDROCK_READ_TIMEOUT = float(os.getenv('BEDROCK_READ_TIMEOUT', '10'))
+BEDROCK_REGION = os.getenv('BEDROCK_REGION', 'us-east-1')
+
+_lock = threading.RLock()
+_clients = {}
+
+
+class PooledHttpClient:
+    """
+    LINE SDK用のHTTPクライアント（SDKのRequestsHttpClientと同じインターフェース）
+    リクエストごとに接続せず、共有のSessionを使う
+    """
+
+    def __init__(self, session, timeout=None):
+        self.session = session
+        self.timeout = timeout or http_timeout()
+
+    def _request(self, method, url, timeout=None, **kwargs):
+        from linebot.http_client import RequestsHttpResponse
+        response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+        return RequestsHttpResponse(response)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request('GET', url, timeout, headers=headers, params=params, stream=stream)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request('POST', url, timeout, headers=headers, data=data)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request('DELETE', url, timeout, headers=headers, data=data)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request('PUT', url, timeout, headers=headers, data=data)
+
+
+def _get_or_create(key, factory):
+    client = _clients.get(key)
+    if client is None:
+        # boto3のセッションはスレッドセーフではないので作成はロックの中で行う
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = factory()
+                _clients[key] = client
+    return client
+
+
+def _create_http_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection
+    from urllib3.util.retry import Retry
+
+    class KeepAliveAdapter(HTTPAdapter):
+        """アイドル中の接続をNATなどに切られないようにTCPキープアライブを有効にしたHTTPAdapter"""
+
+        def init_poolmanager(self, *args, **kwargs):
+            kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            ]
+            super().init_poolmanager(*args, **kwargs)
+
+    session = requests.Session()
+    # 接続の失敗だけを再試行する（送信済みのメッセージを二重に送らないため）
+    adapter = KeepAliveAdapter(
+        pool_connections=4,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.1)
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def http_session():
+    """LINE APIなどに使う、キープアライブ付きの共有Session"""
+    return _get_or_create('http', _create_http_session)
+
+
+def http_timeout():
+    """requestsに渡す (接続, 読み込み) のタイムアウト"""
+    return (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+
+def aws_config(read_timeout=AWS_READ_TIMEOUT):
+    """コネクションプール・タイムアウト・適応型リトライを設定したbotocoreのConfig"""
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+        connect_timeout=AWS_CONNECT_TIMEOUT,
+        read_timeout=read_timeout,
+        retries={'max_attempts': AWS_MAX_ATTEMPTS, 'mode': 'adaptive'},
+        tcp_keepalive=True
+    )
+
+
+def aws_client(service_name, **kwargs):
+    """
+    共有のboto3クライアント
+    endpoint_urlなどの引数が異なれば別のクライアントになる（Noneの引数は指定しなかったものとして扱う）
+    """
+    import boto3
+    kwargs = {name: value for name, value in kwargs.items() if value is not None}
+    return _get_or_create(
+        ('client', service_name, tuple(sorted(kwargs.items()))),
+        lambda: boto3.client(service_name, config=aws_config(), **kwargs)
+    )
+
+
+def dynamodb_resource():
+    """共有のDynamoDBリソース"""
+    import boto3
+    return _get_or_create('dynamodb', lambda: boto3.resource('dynamodb', config=aws_config()))
+
+
+def dynamodb_table(table_name):
+    """共有のDynamoDBテーブル"""
+    return _get_or_create(('table', table_name), lambda: dynamodb_resource().Table(table_name))
+
+
+def bedrock_client():
+    """共有のBedrock Runtimeクライアント"""
+    import boto3
+    return _get_or_create(
+        'bedrock',
+        lambda: boto3.client(
+            service_name='bedrock-runtime',
+            region_name=BEDROCK_REGION,
+            config=aws_config(read_timeout=BEDROCK_READ_TIMEOUT)
+        )
+    )
+
+
+def line_bot_api(channel_access_token):
+    """共有のSessionを使うLineBotApi"""
+    from linebot import LineBotApi
+    # SDKはhttp_client(timeout=...)としてクライアントを作るので、共有のSessionを使うクライアントを返す関数を渡す
+    # タイムアウトはSDKの既定値ではなくhttp_timeout()を使う
+    return _get_or_create(
+        ('line', channel_access_token),
+        lambda: LineBotApi(channel_access_token, http_client=lambda timeout=None: PooledHttpClient(http_session()))
+    )
@@ -0,0 +1,156 @@
+"""
+会話履歴のアーカイブ（EventBridgeのスケジュールで1日1回程度実行する）
+ARCHIVE_AFTER_DAYSより古い会話を、ユーザーごと・月ごとの圧縮したセグメントに移してテーブルから削除する
+テーブルにはボットが使う直近の会話だけが残り、古い会話はconversation_archive.read_turnsで読み出せる
+アーカイブする会話のあるユーザーは、会話のテーブルをスキャンせずに会話のあった日の索引（conversation_days）から探す
+
+会話には保存時にTTL（CONVERSATION_RETENTION_DAYS）が付いているので、アーカイブが止まっていても
+テーブルは際限なく大きくならない（その場合、アーカイブされないまま期限を過ぎた会話は失われる）
+
+ローカルからの実行: python conversationArchiver.py --archive-uri ./archive [--line-id U...] [--dry-run]
+"""
+import argparse
+import logging
+import os
+from datetime import datetime, timedelta
+
+import clients
+import conversation_archive
+import conversation_days
+import conversation_store
+from deadline import Deadline
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# この日数より古い会話をアーカイブに移す
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '30'))
+# 次のユーザーに進まずに終えるための残り時間
+ARCHIVE_RESERVE_MS = int(os.getenv('ARCHIVE_RESERVE_MS', '10000'))
+
+
+def archive_cutoff(now=None, days=ARCHIVE_AFTER_DAYS):
+    """このタイムスタンプ以前の会話をアーカイブする"""
+    return ((now or datetime.now()) - timedelta(days=days)).isoformat()
+
+
+def users_with_old_turns(cutoff, day_table=None):
+    """
+    アーカイブする会話があるユーザー（{lineId: 索引のキーのリスト}）
+    カットオフの日より前に会話した日が索引に残っているユーザーを返す（カットオフの日の会話は次の実行で移す）
+    """
+    return conversation_days.pending_users(cutoff[:10], day_table)
+
+
+def delete_turns(table, items):
+    with table.batch_writer() as batch:
+        for item in items:
+            batch.delete_item(Key={'lineId': item['lineId'], 'timestamp': item['timestamp']})
+
+
+def archive_user(table, store, line_id, cutoff, dry_run=False, deadline=None):
+    """
+    ユーザーの古い会話を月ごとにセグメントへ移し、(会話の件数, 書いたセグメントの数, 最後まで移したか) を返す
+    会話は古い順に読むので、メモリに持つのは1か月分だけ
+    セグメントとインデックスを書き終えた月の会話だけをテーブルから削除する
+    月を書き出す前に残り時間を確かめ、ARCHIVE_RESERVE_MSを切っていたらその月からは次の実行に回す
+    """
+    index = None if dry_run else conversation_archive.load_index(store, line_id)
+    turns = segments = 0
+    month, pending = None, []
+
+    def flush():
+        """pendingの月を書き出す（時間が足りなければ書かずにFalse）"""
+        nonlocal index, turns, segments
+        if not pending:
+            return True
+        if deadline is not None and deadline.remaining_ms() < ARCHIVE_RESERVE_MS:
+            return False
+        if not dry_run:
+            index = conversation_archive.append_turns(store, line_id, month, pending, index)
+            delete_turns(table, pending)
+        turns += len(pending)
+        segments += 1
+        return True
+
+    for items, _ in conversation_store.iter_export_pages(table, line_id, end=cutoff):
+        for item in items:
+            item_month = conversation_archive.month_of(item['timestamp'])
+            if item_month != month:
+                if not flush():
+                    return turns, segments, False
+                month, pending = item_month, []
+            pending.append(item)
+    finished = flush()
+    return turns, segments, finished
+
+
+def archive_all(table, store, cutoff, deadline=None, line_ids=None, dry_run=False, day_table=None):
+    """
+    ユーザーごとに古い会話をアーカイブする
+    時間が足りなくなったらユーザー（またはユーザーの月）の区切りで終え、残りは次の実行で続ける
+    （アーカイブ済みの会話はテーブルにないので読まない）
+    最後まで移したユーザーは索引から外すので、次の実行では読まない
+    """
+    summary = {'cutoff': cutoff, 'users': 0, 'turns': 0, 'segments': 0, 'failed': 0, 'complete': True}
+    if line_ids:
+        pending = {line_id: [] for line_id in line_ids}
+    else:
+        pending = users_with_old_turns(cutoff, day_table)
+    for line_id, day_keys in pending.items():
+        if deadline is not None and deadline.remaining_ms() < ARCHIVE_RESERVE_MS:
+            logger.info(f"時間が足りないため、{summary['users']}人でアーカイブを区切ります")
+            summary['complete'] = False
+            break
+        try:
+            turns, segments, finished = archive_user(table, store, line_id, cutoff, dry_run, deadline)
+        except Exception as e:
+            logger.error(f"会話のアーカイブでエラーが発生しました: {line_id}: {e}")
+            summary['failed'] += 1
+            continue
+        summary['turns'] += turns
+        summary['segments'] += segments
+        if not finished:
+            logger.info(f"時間が足りないため、{line_id}の途中でアーカイブを区切ります")
+            summary['complete'] = False
+            break
+        if day_keys and not dry_run:
+            conversation_days.clear(day_keys, day_table)
+        summary['users'] += 1
+    return summary
+
+
+def lambda_handler(event, context):
+    deadline = Deadline.from_context(context)
+    table = clients.dynamodb_table(conversation_store.CONVERSATION_TABLE_NAME)
+    cutoff = archive_cutoff()
+    logger.info(f"会話のアーカイブを開始します: {cutoff}以前")
+    with deadline.stage('archive'):
+        summary = archive_all(table, conversation_archive.store_from_uri(), cutoff, deadline)
+    for key in ('users', 'turns', 'segments'):
+        deadline.note(key, summary[key])
+    deadline.report('conversationArchiver')
+
+    # 失敗したユーザーがあれば失敗として返し、EventBridgeの再試行でやり直す
+    if summary['failed']:
+        raise RuntimeError(f"アーカイブできなかったユーザーがあります: {summary}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--archive-uri', default=conversation_archive.ARCHIVE_URI,
+                        help='保存先（s3://バケット/プレフィックス またはディレクトリ）')
+    parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS, help='この日数より古い会話を移す')
+    parser.add_argument('--line-id', action='append', help='対象のユーザー（複数指定可。省略すると全ユーザー）')
+    parser.add_argument('--dry-run', action='store_true', help='書き込み・削除をせずに件数だけを数える')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    table = clients.dynamodb_table(conversation_store.CONVERSATION_TABLE_NAME)
+    store = conversation_archive.store_from_uri(args.archive_uri)
+    print(archive_all(table, store, archive_cutoff(days=args.days), line_ids=args.line_id, dry_run=args.dry_run))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,368 @@
+"""
+会話履歴のエクスポート
+linebot-conversation-historyをページ単位で読み、gzip圧縮したNDJSONまたはCSVとして少しずつ書き出す
+読み出し・圧縮・アップロードをページごとに進めるので、会話が数十万件あってもメモリの使用量は一定
+
+Lambdaでは1回の実行で書き出した分をS3の1つのオブジェクト（セグメント）にし、
+時間が足りなくなったら続きのトークン（nextToken）を返す。次の実行にtokenを渡すと続きのセグメントを書き出す
+gzipは連結しても1つのgzipとして読めるので、セグメントを順に連結すれば全体のファイルになる
+
+lineIdを指定したエクスポートは、ARCHIVE_URIが設定されていれば、テーブルから外してアーカイブに移した古い会話
+（conversation_archive）を先に書き出し、続けてテーブルの会話を書き出す
+全ユーザーのエクスポートはテーブルの会話だけを書き出す（アーカイブはユーザーごとに conversation_archive.read_turns で読む）
+API Gatewayから呼ばれた場合はlineIdを必須とし、全ユーザーのエクスポートは直接呼び出しとローカルからの実行でだけ行う
+
+ローカルからの実行: python conversationExport.py --line-id U... --format csv --output history.csv.gz
+"""
+import argparse
+import base64
+import csv
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import sys
+import uuid
+import zlib
+
+import clients
+import conversation_archive
+import conversation_store
+from deadline import Deadline
+from http_response import encode_json, json_response
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# セグメントを書き出すS3バケットとキーのプレフィックス
+EXPORT_BUCKET = os.getenv('EXPORT_BUCKET')
+EXPORT_PREFIX = os.getenv('EXPORT_PREFIX', 'conversation-exports/')
+# S3のマルチパートアップロードの1パートの大きさ（5MB以上）
+EXPORT_PART_BYTES = int(os.getenv('EXPORT_PART_BYTES', str(8 * 1024 * 1024)))
+# ダウンロード用の署名付きURLの有効秒数
+EXPORT_URL_EXPIRES_SECONDS = int(os.getenv('EXPORT_URL_EXPIRES_SECONDS', '3600'))
+# セグメントを閉じてアップロードを終えるために残しておく時間
+EXPORT_RESERVE_MS = int(os.getenv('EXPORT_RESERVE_MS', '5000'))
+# 続きのトークンの署名（HMAC-SHA256）に使う秘密鍵（トークンの状態を書き換えて他のユーザーを書き出させないため）
+EXPORT_TOKEN_SECRET = os.getenv('EXPORT_TOKEN_SECRET')
+
+FORMATS = ('ndjson', 'csv')
+CSV_FIELDS = ['lineId', 'timestamp', 'user_message', 'assistant_message']
+
+
+def _token_signature(payload):
+    if not EXPORT_TOKEN_SECRET:
+        raise RuntimeError('EXPORT_TOKEN_SECRETが設定されていません')
+    digest = hmac.new(EXPORT_TOKEN_SECRET.encode('utf-8'), payload.encode('ascii'), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode('ascii')
+
+
+def encode_token(state):
+    """続きから書き出すための状態を、署名付きのトークン（<状態>.<署名>）にする"""
+    payload = base64.urlsafe_b64encode(encode_json(state).encode('utf-8')).decode('ascii')
+    return f"{payload}.{_token_signature(payload)}"
+
+
+def decode_token(token):
+    """トークンの署名を確かめて状態に戻す（署名が一致しなければValueError）"""
+    payload, _, signature = str(token).partition('.')
+    if not hmac.compare_digest(signature.encode('utf-8'), _token_signature(payload).encode('ascii')):
+        raise ValueError('Invalid token')
+    try:
+        return json.loads(base64.urlsafe_b64decode(payload.encode('ascii')))
+    except (ValueError, UnicodeError):
+        raise ValueError('Invalid token')
+
+
+class GzipChunks:
+    """
+    行をgzipで圧縮し、圧縮後のバイト列をchunk_bytesごとに取り出す
+    1つのGzipChunksが1つのgzipメンバーになる
+    """
+
+    def __init__(self, chunk_bytes=64 * 1024):
+        self.chunk_bytes = chunk_bytes
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self._buffer = bytearray()
+
+    def write(self, text):
+        """行を追加し、chunk_bytes以上たまった圧縮済みのバイト列があれば返す"""
+        self._buffer += self._compressor.compress(text.encode('utf-8'))
+        if len(self._buffer) < self.chunk_bytes:
+            return None
+        chunk, self._buffer = bytes(self._buffer), bytearray()
+        return chunk
+
+    def close(self):
+        """gzipのメンバーを閉じ、残りのバイト列を返す"""
+        chunk = bytes(self._buffer + self._compressor.flush())
+        self._buffer = bytearray()
+        return chunk
+
+
+class RowEncoder:
+    """会話アイテムをNDJSONまたはCSVの行にする"""
+
+    def __init__(self, fmt):
+        if fmt not in FORMATS:
+            raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+        self.fmt = fmt
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer) if fmt == 'csv' else None
+
+    def _csv_line(self, values):
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._writer.writerow(values)
+        return self._buffer.getvalue()
+
+    def header(self):
+        return self._csv_line(CSV_FIELDS) if self.fmt == 'csv' else ''
+
+    def row(self, item):
+        if self.fmt == 'csv':
+            return self._csv_line([item.get(field, '') for field in CSV_FIELDS])
+        return encode_json({field: item[field] for field in CSV_FIELDS if field in item}) + '\n'
+
+
+def export_chunks(table, line_id=None, start=None, end=None, fmt='ndjson', start_key=None, header=True,
+                  deadline=None, stats=None, store=None, after=None):
+    """
+    会話をgzip圧縮したNDJSON/CSVのバイト列として少しずつ返すジェネレーター
+    storeを渡すと、line_idのアーカイブされた会話を先に書き出してからテーブルの会話を書き出す
+    afterより後のタイムスタンプの会話だけを書き出すので、アーカイブとテーブルの両方にある会話
+    （アーカイブの書き込み後、テーブルから削除する前に止まった場合）も1回だけ書き出す
+    deadlineの残り時間がEXPORT_RESERVE_MSを切ったら、アーカイブは会話の区切り、テーブルはページの区切りで書き出しを終える
+    statsのdictには書き出した行数（rows）と、続きから書き出すための値
+    （archiveDone: アーカイブを最後まで書き出したか、after: アーカイブから書き出した最後のタイムスタンプ、
+    nextKey: テーブルの開始キー。最後まで読んだらNone）が入る
+    """
+    stats = stats if stats is not None else {}
+    stats.update(rows=0, nextKey=start_key, after=after, archiveDone=store is None)
+    encoder = RowEncoder(fmt)
+    gzip = GzipChunks()
+    if header and encoder.header():
+        gzip.write(encoder.header())
+
+    def out_of_time():
+        return deadline is not None and deadline.remaining_ms() < EXPORT_RESERVE_MS
+
+    if store is not None:
+        for item in conversation_archive.read_turns(store, line_id, after or start, end):
+            if after and item['timestamp'] <= after:
+                continue
+            chunk = gzip.write(encoder.row(item))
+            if chunk:
+                yield chunk
+            stats['rows'] += 1
+            stats['after'] = item['timestamp']
+            if out_of_time():
+                logger.info(f"時間が足りないため、アーカイブの{stats['rows']}件で書き出しを区切ります")
+                yield gzip.close()
+                return
+        stats['archiveDone'] = True
+
+    after = stats['after']
+    pages = conversation_store.iter_export_pages(table, line_id, max(after or '', start or '') or None, end, start_key)
+    for items, next_key in pages:
+        for item in items:
+            if after and item['timestamp'] <= after:
+                continue
+            chunk = gzip.write(encoder.row(item))
+            if chunk:
+                yield chunk
+            stats['rows'] += 1
+        stats['nextKey'] = next_key
+        if next_key and out_of_time():
+            logger.info(f"時間が足りないため、{stats['rows']}件で書き出しを区切ります")
+            break
+    yield gzip.close()
+
+
+class S3MultipartWriter:
+    """
+    バイト列をS3のオブジェクトに少しずつアップロードする
+    パートの大きさ分だけをメモリに持ち、小さいオブジェクトは1回のput_objectで書く
+    """
+
+    def __init__(self, s3, bucket, key, part_bytes=EXPORT_PART_BYTES, content_type='application/gzip'):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_bytes = part_bytes
+        self.content_type = content_type
+        self.size = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def _upload_part(self, data):
+        if self._upload_id is None:
+            self._upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, ContentType=self.content_type
+            )['UploadId']
+        number = len(self._parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id, PartNumber=number, Body=data
+        )
+        self._parts.append({'PartNumber': number, 'ETag': response['ETag']})
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        if len(self._buffer) >= self.part_bytes:
+            data, self._buffer = bytes(self._buffer), bytearray()
+            self._upload_part(data)
+
+    def close(self):
+        if self._upload_id is None:
+            self.s3.put_object(
+                Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer), ContentType=self.content_type
+            )
+            return
+        if self._buffer:
+            self._upload_part(bytes(self._buffer))
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id, MultipartUpload={'Parts': self._parts}
+        )
+
+    def abort(self):
+        if self._upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+
+def export_request(params):
+    """
+    リクエストの指定から書き出しの状態を作る（tokenがあれば続きの状態）
+    指定: lineId（省略すると全ユーザー）, from / to（YYYY-MM-DD）, format（ndjson / csv）, token
+    """
+    if params.get('token'):
+        state = decode_token(params['token'])
+        state['segment'] += 1
+        return state
+    fmt = params.get('format') or 'ndjson'
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    return {
+        'exportId': uuid.uuid4().hex,
+        'lineId': params.get('lineId'),
+        'start': params.get('from'),
+        # toの日付のタイムスタンプをすべて含める
+        'end': f"{params['to']}~" if params.get('to') else None,
+        'format': fmt,
+        'segment': 1,
+        # アーカイブを書き出し終えていないか（lineIdを指定し、アーカイブが設定されているときだけ読む）
+        'archive': bool(params.get('lineId') and conversation_archive.ARCHIVE_URI),
+        'after': None,
+        'key': None
+    }
+
+
+def export_segment(state, deadline, table=None, s3=None, bucket=None):
+    """1つのセグメントを書き出し、レスポンスの内容を返す"""
+    table = table or clients.dynamodb_table(conversation_store.CONVERSATION_TABLE_NAME)
+    s3 = s3 or clients.aws_client('s3')
+    bucket = bucket or EXPORT_BUCKET
+    key = f"{EXPORT_PREFIX}{state['exportId']}/part-{state['segment']:05d}.{state['format']}.gz"
+
+    stats = {}
+    store = conversation_archive.store_from_uri() if state.get('archive') else None
+    writer = S3MultipartWriter(s3, bucket, key)
+    try:
+        for chunk in export_chunks(table, state['lineId'], state['start'], state['end'], state['format'],
+                                   state['key'], header=state['segment'] == 1, deadline=deadline, stats=stats,
+                                   store=store, after=state.get('after')):
+            writer.write(chunk)
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+
+    next_token = None
+    if stats['nextKey'] or not stats['archiveDone']:
+        next_token = encode_token({
+            **state, 'key': stats['nextKey'], 'archive': not stats['archiveDone'], 'after': stats['after']
+        })
+    return {
+        'exportId': state['exportId'],
+        'segment': state['segment'],
+        'key': key,
+        'url': s3.generate_presigned_url(
+            'get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=EXPORT_URL_EXPIRES_SECONDS
+        ),
+        'rows': stats['rows'],
+        'bytes': writer.size,
+        'complete': next_token is None,
+        'nextToken': next_token
+    }
+
+
+def lambda_handler(event, context):
+    """
+    API Gateway（GETのクエリ）または直接呼び出し（イベントのトップレベル）で指定を受け取る
+    API Gatewayからの呼び出しでは、全ユーザーのエクスポート（lineIdの指定がないもの）は受け付けない
+    """
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type',
+        'Content-Type': 'application/json'
+    }
+    # httpMethodかrequestContextがあればAPI Gateway（ペイロード形式 1.0 / 2.0）からの呼び出し
+    via_http = 'httpMethod' in event or 'requestContext' in event
+    http_method = event.get('httpMethod') or (event.get('requestContext') or {}).get('http', {}).get('method')
+    if http_method == 'OPTIONS':
+        return {'statusCode': 200, 'headers': headers, 'body': ''}
+    if not EXPORT_BUCKET or not EXPORT_TOKEN_SECRET:
+        logger.error('EXPORT_BUCKETまたはEXPORT_TOKEN_SECRETが設定されていません')
+        return json_response(500, {'message': 'Export is not configured'}, headers)
+
+    params = (event.get('queryStringParameters') or {}) if via_http else event
+    try:
+        state = export_request(params)
+    except (KeyError, ValueError) as e:
+        return json_response(400, {'message': str(e)}, headers)
+    if via_http and not state['lineId']:
+        return json_response(400, {'message': 'lineId is required'}, headers)
+
+    deadline = Deadline.from_context(context)
+    try:
+        with deadline.stage('export'):
+            result = export_segment(state, deadline)
+    except Exception as e:
+        logger.error(f"会話履歴のエクスポートでエラーが発生しました: {e}")
+        return json_response(500, {'message': 'Export failed'}, headers)
+    deadline.note('rows', result['rows'])
+    deadline.report('conversationExport')
+    return json_response(200, result, headers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--line-id', help='ユーザーのlineId（省略すると全ユーザー）')
+    parser.add_argument('--from', dest='start', help='開始日（YYYY-MM-DD）')
+    parser.add_argument('--to', dest='end', help='終了日（YYYY-MM-DD、この日を含む）')
+    parser.add_argument('--format', choices=FORMATS, default='ndjson')
+    parser.add_argument('--output', help='書き出すファイル（省略すると標準出力）')
+    parser.add_argument('--archive-uri', default=conversation_archive.ARCHIVE_URI,
+                        help='アーカイブの保存先（--line-idを指定したとき、アーカイブの会話も書き出す）')
+    args = parser.parse_args()
+
+    table = clients.dynamodb_table(conversation_store.CONVERSATION_TABLE_NAME)
+    store = conversation_archive.store_from_uri(args.archive_uri) if args.line_id and args.archive_uri else None
+    stats = {}
+    output = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for chunk in export_chunks(table, args.line_id, args.start, f"{args.end}~" if args.end else None,
+                                   args.format, stats=stats, store=store):
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+    print(f"{stats['rows']}件を書き出しました", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+会話履歴のアーカイブ
+テーブルから外した古い会話を、ユーザーごと・月ごとのgzip圧縮したNDJSON（セグメント）として保存する
+ユーザーごとのインデックス（index.json）に月ごとのセグメントのキー・件数・期間を記録し、読み出し時はインデックスから必要な月だけを読む
+
+保存先はARCHIVE_URIで指定する
+  s3://バケット/プレフィックス  S3（ARCHIVE_S3_ENDPOINTを指定すればS3互換のストレージ）
+  それ以外                      ローカルのディレクトリ
+"""
+import gzip
+import json
+import logging
+import os
+from datetime import datetime
+
+import clients
+from http_response import encode_json
+
+logger = logging.getLogger()
+
+# アーカイブの保存先
+ARCHIVE_URI = os.getenv('ARCHIVE_URI', '')
+# S3互換のストレージのエンドポイント（未設定ならAWSのS3）
+ARCHIVE_S3_ENDPOINT = os.getenv('ARCHIVE_S3_ENDPOINT')
+
+INDEX_NAME = 'index.json'
+# セグメントに残さない属性（テーブルでだけ意味を持つ）
+DROPPED_ATTRIBUTES = ('expiresAt',)
+
+
+class LocalStore:
+    """ローカルのディレクトリに保存する"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def get(self, key):
+        """保存されたバイト列（なければNone）"""
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data, content_type=None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 途中で止まっても壊れたファイルが残らないように、書き終えてから置き換える
+        with open(f"{path}.tmp", 'wb') as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+
+
+class S3Store:
+    """S3（またはS3互換のストレージ）に保存する"""
+
+    def __init__(self, bucket, prefix='', s3=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = s3 or clients.aws_client('s3', endpoint_url=ARCHIVE_S3_ENDPOINT)
+
+    def get(self, key):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=f"{self.prefix}{key}")
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return response['Body'].read()
+
+    def put(self, key, data, content_type=None):
+        self.s3.put_object(
+            Bucket=self.bucket, Key=f"{self.prefix}{key}", Body=data,
+            ContentType=content_type or 'application/octet-stream'
+        )
+
+
+def store_from_uri(uri=None):
+    """ARCHIVE_URIから保存先を作る"""
+    uri = uri or ARCHIVE_URI
+    if not uri:
+        raise ValueError('ARCHIVE_URI is not set')
+    if uri.startswith('s3://'):
+        bucket, _, prefix = uri[len('s3://'):].partition('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        return S3Store(bucket, prefix)
+    return LocalStore(uri)
+
+
+def month_of(timestamp):
+    """タイムスタンプ（ISO形式）の年月（YYYY-MM）"""
+    return timestamp[:7]
+
+
+def segment_key(line_id, month):
+    return f"{line_id}/{month}.ndjson.gz"
+
+
+def index_key(line_id):
+    return f"{line_id}/{INDEX_NAME}"
+
+
+def encode_segment(items):
+    """会話（古い順）をセグメントのバイト列にする"""
+    lines = ''.join(
+        encode_json({k: v for k, v in item.items() if k not in DROPPED_ATTRIBUTES}) + '\n' for item in items
+    )
+    # 同じ内容なら同じバイト列になるように、gzipのヘッダーに時刻を入れない
+    return gzip.compress(lines.encode('utf-8'), mtime=0)
+
+
+def decode_segment(data):
+    """セグメントのバイト列から会話（古い順）を取り出す"""
+    return [json.loads(line) for line in gzip.decompress(data).decode('utf-8').splitlines() if line]
+
+
+def load_index(store, line_id):
+    """ユーザーのインデックス（なければ空のインデックス）"""
+    data = store.get(index_key(line_id))
+    if data is None:
+        return {'lineId': line_id, 'segments': {}}
+    return json.loads(data)
+
+
+def append_turns(store, line_id, month, items, index=None):
+    """
+    その月のセグメントに会話を追加し、インデックスを更新して返す
+    同じタイムスタンプの会話は1件にまとめるので、途中で止まって同じ会話をもう一度追加しても重複しない
+    セグメントを書いてからインデックスを書くので、インデックスにある月のセグメントは必ず存在する
+    """
+    index = index or load_index(store, line_id)
+    key = segment_key(line_id, month)
+    existing = store.get(key)
+    turns = {item['timestamp']: item for item in (decode_segment(existing) if existing else [])}
+    for item in items:
+        turns[item['timestamp']] = item
+    ordered = [turns[timestamp] for timestamp in sorted(turns)]
+
+    data = encode_segment(ordered)
+    store.put(key, data, 'application/gzip')
+    index['segments'][month] = {
+        'key': key,
+        'turns': len(ordered),
+        'bytes': len(data),
+        'first': ordered[0]['timestamp'],
+        'last': ordered[-1]['timestamp']
+    }
+    index['updatedAt'] = datetime.now().isoformat()
+    store.put(index_key(line_id), json.dumps(index, ensure_ascii=False).encode('utf-8'), 'application/json')
+    return index
+
+
+def read_turns(store, line_id, start=None, end=None):
+    """
+    アーカイブされたユーザーの会話を古い順に返すジェネレーター
+    start / end はタイムスタンプの範囲（ISO形式の文字列の前方一致で比べる）。範囲にかかる月のセグメントだけを読む
+    """
+    index = load_index(store, line_id)
+    for month in sorted(index['segments']):
+        segment = index['segments'][month]
+        if (start and segment['last'] < start) or (end and segment['first'] > end):
+            continue
+        data = store.get(segment['key'])
+        if data is None:
+            logger.error(f"アーカイブのセグメントがありません: {segment['key']}")
+            continue
+        for item in decode_segment(data):
+            if (start and item['timestamp'] < start) or (end and item['timestamp'] > end):
+                continue
+            yield item
@@ -0,0 +1,133 @@
+"""
+会話のあった日の索引
+会話を保存したときに「ユーザーがこの日に会話した」というアイテムを書いておき、
+アーカイブの実行時は会話のテーブルをスキャンせずに、カットオフより前の日のアイテムだけをクエリする
+アーカイブし終えたユーザーのアイテムは削除するので、読む量はテーブルの大きさではなく、アーカイブ待ちの会話の量に比例する
+書き込みが1つのパーティションに偏らないよう、アイテムはユーザーごとのシャードに分ける
+索引を入れる前の会話は、backfillで会話のテーブルから索引に加える
+
+使い方（既存の会話の取り込み）: python conversation_days.py [--dry-run]
+"""
+import argparse
+import logging
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import clients
+import conversation_store
+
+logger = logging.getLogger()
+
+DAY_TABLE_NAME = os.getenv('CONVERSATION_DAY_TABLE', 'LineConversationDays')
+# シャードの数（パーティションキー）
+DAY_SHARDS = int(os.getenv('CONVERSATION_DAY_SHARDS', '16'))
+# コンテナ内で書き込み済みとして覚えておく（ユーザー, 日）の数（同じ日の2回目以降の会話では書き込まない）
+DAY_MEMO_MAX = int(os.getenv('CONVERSATION_DAY_MEMO_MAX', '4096'))
+
+_recorded = OrderedDict()
+_recorded_lock = threading.Lock()
+
+
+def get_table():
+    """DynamoDBのテーブル（最初に使うときに作成し、ウォームスタート時は使い回す）"""
+    return clients.dynamodb_table(DAY_TABLE_NAME)
+
+
+def shard_of(line_id):
+    return str(zlib.crc32(line_id.encode('utf-8')) % DAY_SHARDS)
+
+
+def day_key(timestamp, line_id):
+    """ソートキー（YYYY-MM-DD#lineId）。日付で始まるので、カットオフより前の日を範囲で読める"""
+    return f"{timestamp[:10]}#{line_id}"
+
+
+def record(line_id, timestamp, table=None):
+    """会話を保存した日を索引に書く（このコンテナで書き込み済みなら何もしない）"""
+    key = day_key(timestamp, line_id)
+    with _recorded_lock:
+        if key in _recorded:
+            return
+    item = {'shardKey': shard_of(line_id), 'dayUser': key, 'lineId': line_id}
+    # 会話と同じ保持期間で消えるので、アーカイブが止まっていても索引は際限なく大きくならない
+    expires_at = conversation_store.expires_at()
+    if expires_at:
+        item['expiresAt'] = expires_at
+    (table or get_table()).put_item(Item=item)
+    with _recorded_lock:
+        _recorded[key] = True
+        while len(_recorded) > DAY_MEMO_MAX:
+            _recorded.popitem(last=False)
+
+
+def _query_shard(table, shard, before_day):
+    from boto3.dynamodb.conditions import Key
+
+    kwargs = {
+        'KeyConditionExpression': Key('shardKey').eq(shard) & Key('dayUser').lt(before_day),
+        'ProjectionExpression': 'shardKey, dayUser, lineId'
+    }
+    items = []
+    while True:
+        response = table.query(**kwargs)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return items
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def pending_users(before_day, table=None, max_workers=None):
+    """
+    before_day（YYYY-MM-DD）より前に会話した日が索引に残っているユーザー
+    {lineId: [索引のキー, ...]} を古い日のユーザーから順に返す（シャードは並行して読む）
+    """
+    table = table or get_table()
+    with ThreadPoolExecutor(max_workers=max_workers or DAY_SHARDS) as executor:
+        shards = executor.map(lambda shard: _query_shard(table, str(shard), before_day), range(DAY_SHARDS))
+        items = [item for shard_items in shards for item in shard_items]
+    users = {}
+    for item in sorted(items, key=lambda item: item['dayUser']):
+        users.setdefault(item['lineId'], []).append({'shardKey': item['shardKey'], 'dayUser': item['dayUser']})
+    return users
+
+
+def clear(keys, table=None):
+    """アーカイブし終えた日のアイテムを削除する"""
+    with (table or get_table()).batch_writer() as batch:
+        for key in keys:
+            batch.delete_item(Key=key)
+
+
+def backfill(conversation_table=None, table=None, dry_run=False):
+    """
+    会話のテーブルをスキャンして索引のアイテムを書き込み、書き込んだ（dry_runなら書き込む）（ユーザー, 日）の数を返す
+    同じアイテムを書くだけなので、何度実行しても、会話の保存と同時に実行しても結果は変わらない
+    """
+    conversation_table = conversation_table or clients.dynamodb_table(conversation_store.CONVERSATION_TABLE_NAME)
+    table = table or get_table()
+    written = set()
+    for items, _ in conversation_store.iter_export_pages(conversation_table):
+        for item in items:
+            key = day_key(item['timestamp'], item['lineId'])
+            if key in written:
+                continue
+            written.add(key)
+            if not dry_run:
+                record(item['lineId'], item['timestamp'], table)
+    logger.info(f"{len(written)}件の（ユーザー, 日）を索引に{'書き込みます（dry run）' if dry_run else '書き込みました'}")
+    return len(written)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run', action='store_true', help='書き込まずに件数だけを数える')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(backfill(dry_run=args.dry_run))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+"""
+会話履歴（linebot-conversation-history）の読み出し
+件数ではなくトークン数の予算で直近の会話を選び、予算から外れた古い会話はユーザーごとの要約にまとめる
+"""
+import logging
+import os
+import time
+from collections import namedtuple
+from datetime import datetime
+
+logger = logging.getLogger()
+
+CONVERSATION_TABLE_NAME = os.getenv('CONVERSATION_TABLE', 'linebot-conversation-history')
+# 会話履歴に使うトークン数の予算（要約を含む）
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '1500'))
+# 1回のクエリで読む会話の件数
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '10'))
+# 1回の要約更新でまとめる会話の最大件数
+SUMMARY_BATCH_TURNS = int(os.getenv('SUMMARY_BATCH_TURNS', '20'))
+# 要約の最大文字数
+SUMMARY_MAX_CHARS = int(os.getenv('SUMMARY_MAX_CHARS', '400'))
+
+# エクスポートで1回のクエリ（スキャン）で読む会話の件数
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', '500'))
+# 会話をテーブルに残す日数（DynamoDBのTTLでexpiresAtを過ぎた会話が削除される。0ならTTLを付けない）
+# アーカイブ（conversationArchiver）はARCHIVE_AFTER_DAYSを過ぎた会話を移すので、それより十分長くする
+CONVERSATION_RETENTION_DAYS = int(os.getenv('CONVERSATION_RETENTION_DAYS', '90'))
+
+# 要約アイテムのソートキー
+# ISO形式のタイムスタンプより前に並ぶので、timestamp > SUMMARY_TIMESTAMP の条件で会話だけを検索できる
+SUMMARY_TIMESTAMP = '#summary'
+
+# messages: モデルに渡す形式の会話履歴（古い順、要約があれば先頭）
+# summary: 要約アイテム（なければNone）
+# overflow: 予算から外れたがまだ要約に含まれていない会話のうち新しいもの（古い順、最大SUMMARY_BATCH_TURNS件）
+ConversationHistory = namedtuple('ConversationHistory', ['messages', 'summary', 'overflow'])
+
+
+def estimate_tokens(text):
+    """
+    トークン数の概算（APIを呼ばずにローカルで計算する）
+    日本語などの全角文字は1文字1トークン、それ以外は4文字1トークンとみなす
+    """
+    if not text:
+        return 0
+    wide = sum(1 for c in text if ord(c) > 0x2E7F)
+    return wide + (len(text) - wide + 3) // 4 + 1
+
+
+def turn_tokens(item):
+    """会話1件（ユーザーの発言と応答）のトークン数の概算"""
+    return estimate_tokens(item.get('user_message')) + estimate_tokens(item.get('assistant_message'))
+
+
+def iter_turns(table, line_id, after=None, newest_first=True, page_size=HISTORY_PAGE_SIZE):
+    """
+    ユーザーの会話をページ単位で読み出すジェネレーター
+    afterを指定するとそのタイムスタンプより新しい会話だけを返す
+    """
+    from boto3.dynamodb.conditions import Key
+    condition = Key('lineId').eq(line_id) & Key('timestamp').gt(after or SUMMARY_TIMESTAMP)
+    kwargs = {
+        'KeyConditionExpression': condition,
+        'ScanIndexForward': not newest_first,
+        'Limit': page_size
+    }
+    while True:
+        response = table.query(**kwargs)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def iter_export_pages(table, line_id=None, start=None, end=None, start_key=None, page_size=EXPORT_PAGE_SIZE):
+    """
+    エクスポート用に会話をページ単位で読み出すジェネレーター
+    lineIdを指定すればそのユーザーの会話を古い順にQueryで、指定しなければ全ユーザーの会話をScanで読む
+    start / end はタイムスタンプの範囲（ISO形式の文字列の前方一致で比べる。要約アイテムは含まない）
+    (会話のリスト, 続きを読むための開始キー（最後のページならNone）) を返し、
+    start_keyに開始キーを渡すと続きから読む
+    """
+    from boto3.dynamodb.conditions import Attr, Key
+    # ISO形式のタイムスタンプは数字で始まるので、'0'〜'9~' の範囲で要約アイテム（'#summary'）を除ける
+    low, high = start or '0', end or '9~'
+    if line_id:
+        read = table.query
+        kwargs = {'KeyConditionExpression': Key('lineId').eq(line_id) & Key('timestamp').between(low, high)}
+    else:
+        # 全ユーザーの会話はテーブル全体を読む（読み込みキャパシティはテーブルの大きさに比例する）
+        read = table.scan
+        kwargs = {'FilterExpression': Attr('timestamp').between(low, high)}
+    kwargs['Limit'] = page_size
+    if start_key:
+        kwargs['ExclusiveStartKey'] = start_key
+    while True:
+        response = read(**kwargs)
+        next_key = response.get('LastEvaluatedKey')
+        yield response['Items'], next_key
+        if not next_key:
+            return
+        kwargs['ExclusiveStartKey'] = next_key
+
+
+def expires_at(now=None, retention_days=CONVERSATION_RETENTION_DAYS):
+    """新しい会話に付けるTTL（エポック秒）。retention_daysが0ならNone"""
+    if retention_days <= 0:
+        return None
+    return int((now or time.time()) + retention_days * 86400)
+
+
+def format_turns(items):
+    """会話アイテム（古い順）をモデルに渡す形式に変換"""
+    formatted_messages = []
+    for msg in items:
+        formatted_messages.append({
+            "role": "user",
+            "content": msg['user_message']
+        })
+        if msg.get('assistant_message'):
+            formatted_messages.append({
+                "role": "assistant",
+                "content": msg['assistant_message']
+            })
+    return formatted_messages
+
+
+def summary_message(summary):
+    return {
+        "role": "system",
+        "content": f"これまでの会話の要約: {summary['summary']}"
+    }
+
+
+def get_summary(table, line_id):
+    """ユーザーの会話の要約アイテムを取得（なければNone）"""
+    response = table.get_item(Key={'lineId': line_id, 'timestamp': SUMMARY_TIMESTAMP})
+    return response.get('Item')
+
+
+def put_summary(table, line_id, summary, covered_until):
+    """要約を保存（covered_untilまでの会話が要約に含まれている）"""
+    item = {
+        'lineId': line_id,
+        'timestamp': SUMMARY_TIMESTAMP,
+        'summary': summary[:SUMMARY_MAX_CHARS],
+        'coveredUntil': covered_until,
+        'updatedAt': datetime.now().isoformat()
+    }
+    table.put_item(Item=item)
+    return item
+
+
+def latest_timestamps(table, line_id, after=None, count=2):
+    """
+    最新の会話のタイムスタンプを新しい順にcount件取得（キャッシュの検証用の軽いクエリ）
+    """
+    from boto3.dynamodb.conditions import Key
+    response = table.query(
+        KeyConditionExpression=Key('lineId').eq(line_id) & Key('timestamp').gt(after or SUMMARY_TIMESTAMP),
+        ProjectionExpression='#ts',
+        ExpressionAttributeNames={'#ts': 'timestamp'},
+        ScanIndexForward=False,
+        Limit=count
+    )
+    return [item['timestamp'] for item in response['Items']]
+
+
+def select_history(summary, turns, token_budget=HISTORY_TOKEN_BUDGET):
+    """
+    新しい順の会話（turns）から、トークン数の予算内に収まる直近の会話を選ぶ
+    (ConversationHistory, 読んだ会話のリスト, turnsを最後まで読んだか) を返す
+    """
+    remaining = token_budget
+    if summary:
+        remaining -= estimate_tokens(summary['summary'])
+
+    consumed = []
+    window = []
+    overflow = []
+    exhausted = True
+    for item in turns:
+        consumed.append(item)
+        if not overflow:
+            tokens = turn_tokens(item)
+            if tokens <= remaining:
+                window.append(item)
+                remaining -= tokens
+                continue
+        # 予算から外れた会話は要約の更新用に一定件数まで集める
+        overflow.append(item)
+        if len(overflow) >= SUMMARY_BATCH_TURNS:
+            exhausted = False
+            break
+
+    window.reverse()
+    overflow.reverse()
+    messages = format_turns(window)
+    if summary:
+        messages.insert(0, summary_message(summary))
+    return ConversationHistory(messages, summary, overflow), consumed, exhausted
+
+
+def summary_batch(table, line_id, history, batch_turns=SUMMARY_BATCH_TURNS):
+    """
+    次に要約へ追加する会話（古い順）
+    要約に含まれていない最も古い会話から最大batch_turns件を返すので、要約は古い会話から順に追いつく
+    overflowがbatch_turns件未満なら、予算から外れた未要約の会話はそれで全部なのでクエリしない
+    """
+    if len(history.overflow) < batch_turns:
+        return list(history.overflow)
+    covered_until = history.summary['coveredUntil'] if history.summary else None
+    newest = history.overflow[-1]['timestamp']
+    batch = []
+    for item in iter_turns(table, line_id, after=covered_until, newest_first=False, page_size=batch_turns):
+        if item['timestamp'] > newest or len(batch) >= batch_turns:
+            break
+        batch.append(item)
+    return batch
+
+
+def build_history(table, line_id, token_budget=HISTORY_TOKEN_BUDGET):
+    """
+    トークン数の予算内に収まる直近の会話をDynamoDBから新しい順に読んで選ぶ
+    要約に含まれている会話は読まないので、会話が長くなっても読み出し量とプロンプトの大きさは一定に収まる
+    (ConversationHistory, 読んだ会話のリスト, 要約以降の会話を全て読んだか) を返す
+    """
+    summary = get_summary(table, line_id)
+    covered_until = summary['coveredUntil'] if summary else None
+    return select_history(summary, iter_turns(table, line_id, after=covered_until), token_budget)
@@ -1,11 +1,15 @@
-import json
 import time
-import boto3
+import clients
+import profile_store
 from botocore.exceptions import ClientError
+from http_response import json_response
 
-# DynamoDBのリソースを作成
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table('LineUserProfiles')  # 使用するテーブル名
+# 使用するテーブル名
+TABLE_NAME = 'LineUserProfiles'
+
+def get_table():
+    """DynamoDBのテーブル（最初に使うときに作成し、ウォームスタート時は使い回す）"""
+    return clients.dynamodb_table(TABLE_NAME)
 
 def lambda_handler(event, context):
     # 受け取るデータ（フロントエンドから送られてくる）
@@ -31,7 +35,7 @@ def lambda_handler(event, context):
 
     try:
         # データをDynamoDBに登録
-        response = table.put_item(
+        response = get_table().put_item(
             Item={
                 'lineId': lineId,
                 'profileId': profileId,
@@ -51,45 +55,40 @@ def lambda_handler(event, context):
                 'illness': illness,
                 'motivation': motivation,
                 'createdAt': str(int(time.time())),  # 作成日時
-                'updatedAt': str(int(time.time()))   # 更新日時
+                'updatedAt': str(int(time.time())),  # 更新日時
+                profile_store.VERSION_ATTRIBUTE: profile_store.new_version()
             }
         )
         
-        return {
-            'statusCode': 200,
-            'body': json.dumps({
-                'message': 'Profile created successfully!',
-                'data': {
-                    'profileId': profileId,
-                    'lineId': lineId,
-                    'birthDate': birthDate,
-                    'gender': gender,
-                    'height': height,
-                    'weight': weight,
-                    'targetWeight': targetWeight,
-                    'targetPeriod': targetPeriod,
-                    'priority': priority,
-                    'pastExperience': pastExperience,
-                    'exerciseFrequency': exerciseFrequency,
-                    'mealFrequency': mealFrequency,
-                    'alcoholFrequency': alcoholFrequency,
-                    'allergies': allergies,
-                    'restrictions': restrictions,
-                    'illness': illness,
-                    'motivation': motivation,
-                    'createdAt': str(int(time.time())),
-                    'updatedAt': str(int(time.time()))
-                }
-            })
-        }
+        return json_response(200, {
+            'message': 'Profile created successfully!',
+            'data': {
+                'profileId': profileId,
+                'lineId': lineId,
+                'birthDate': birthDate,
+                'gender': gender,
+                'height': height,
+                'weight': weight,
+                'targetWeight': targetWeight,
+                'targetPeriod': targetPeriod,
+                'priority': priority,
+                'pastExperience': pastExperience,
+                'exerciseFrequency': exerciseFrequency,
+                'mealFrequency': mealFrequency,
+                'alcoholFrequency': alcoholFrequency,
+                'allergies': allergies,
+                'restrictions': restrictions,
+                'illness': illness,
+                'motivation': motivation,
+                'createdAt': str(int(time.time())),
+                'updatedAt': str(int(time.time()))
+            }
+        })
 
     except ClientError as e:
         # エラーハンドリング
         print(f"Error creating profile: {e}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps({
-                'message': 'Error creating profile',
-                'error': str(e)
-            })
-        }
+        return json_response(500, {
+            'message': 'Error creating profile',
+            'error': str(e)
+        })
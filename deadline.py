@@ -0,0 +1,114 @@
+"""
+Lambdaの残り実行時間から処理の期限（デッドライン）を管理する
+各処理段階の所要時間を記録し、予算に対してどれだけ使ったかをログ（とメトリクス）に出す
+"""
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import metrics
+
+logger = logging.getLogger()
+
+# contextがない場合（ローカル実行など）の予算
+DEFAULT_BUDGET_MS = int(os.getenv('DEFAULT_BUDGET_MS', '25000'))
+# Lambdaのハードタイムアウトに対する安全マージン
+DEADLINE_SAFETY_MS = int(os.getenv('DEADLINE_SAFETY_MS', '500'))
+# モデル呼び出しを打ち切ってから応答を送信し終えるまでに確保しておく時間
+REPLY_RESERVE_MS = int(os.getenv('REPLY_RESERVE_MS', '2000'))
+
+# 時間切れで応答を生成できなかった場合の定型文
+FALLBACK_ANSWER = "申し訳ありません。回答の生成に時間がかかっています。少し時間をおいてもう一度お試しください。"
+# 応答を途中で打ち切った場合に付ける注記
+TRUNCATION_NOTE = "\n\n（時間の都合により回答を途中までにしています）"
+
+# 途中で打ち切った応答を区切る位置とする文字
+SENTENCE_ENDINGS = '。！？!?\n'
+
+
+class Deadline:
+    """処理の期限と、各段階の所要時間"""
+
+    def __init__(self, expires_at, budget_ms):
+        self.expires_at = expires_at
+        self.budget_ms = budget_ms
+        self.started = time.monotonic()
+        self.stages = []
+        self.notes = {}
+
+    @classmethod
+    def from_context(cls, context):
+        """Lambdaのcontextの残り時間から期限を作る"""
+        if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+            remaining_ms = context.get_remaining_time_in_millis()
+        else:
+            remaining_ms = DEFAULT_BUDGET_MS
+        budget_ms = max(0, remaining_ms - DEADLINE_SAFETY_MS)
+        return cls(time.monotonic() + budget_ms / 1000, budget_ms)
+
+    def for_event(self):
+        """同じ期限を共有し、所要時間を別に記録するDeadline（イベントごとに使う）"""
+        return Deadline(self.expires_at, self.remaining_ms())
+
+    def remaining_ms(self, reserve_ms=0):
+        return max(0, (self.expires_at - time.monotonic()) * 1000 - reserve_ms)
+
+    def model_timeout(self):
+        """モデル呼び出しに使える秒数（応答送信の時間を差し引いたもの）"""
+        return self.remaining_ms(REPLY_RESERVE_MS) / 1000
+
+    def model_time_left(self):
+        """モデル呼び出しを続けてよいかどうか"""
+        return self.remaining_ms(REPLY_RESERVE_MS) > 0
+
+    @contextmanager
+    def stage(self, name):
+        """withブロックの所要時間を段階名とともに記録"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stages.append((name, (time.monotonic() - started) * 1000))
+
+    def note(self, key, value):
+        """レポートに含める補足情報（応答の文字数など）を記録"""
+        self.notes[key] = value
+
+    def report(self, label):
+        """
+        各段階が予算のどれだけを使ったかをログに出す
+        METRICS_ENABLEDなら、同じ内容を段階ごとの所要時間のメトリクス（EMF）として1行で出す
+        """
+        budget = self.budget_ms or 1
+        totals = metrics.stage_totals(self.stages)
+        elapsed_ms = (time.monotonic() - self.started) * 1000
+        report = {
+            'deadlineReport': label,
+            'budgetMs': round(self.budget_ms),
+            'remainingMs': round(self.remaining_ms()),
+            'stages': {
+                name: {'ms': round(ms, 1), 'budgetPct': round(ms / budget * 100, 1)}
+                for name, ms in totals.items()
+            },
+            **self.notes
+        }
+        if metrics.METRICS_ENABLED:
+            metrics.emit(label, {**totals, 'elapsed': elapsed_ms}, report)
+        else:
+            logger.info(json.dumps({**report, 'elapsedMs': round(elapsed_ms, 1)}, ensure_ascii=False))
+
+
+def truncated_answer(text):
+    """
+    途中で打ち切ったモデル出力を、読める形の応答にする
+    最後の文の区切りまでで切り、何も残らなければ定型文を返す
+    """
+    cut = max(text.rfind(c) for c in SENTENCE_ENDINGS)
+    if cut >= 0:
+        text = text[:cut + 1]
+    text = text.strip()
+    if not text:
+        return FALLBACK_ANSWER
+    return text + TRUNCATION_NOTE
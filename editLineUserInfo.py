@@ -1,22 +1,16 @@
 import json
-import boto3
+import time
+import clients
+import profile_store
 from botocore.exceptions import ClientError
-from decimal import Decimal
+from http_response import json_response
 
-# DynamoDBのリソースを取得
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table('LineUserProfiles')
+# 使用するテーブル名
+TABLE_NAME = 'LineUserProfiles'
 
-def decimal_to_dict(obj):
-    """
-    Decimal 型を含むオブジェクトをJSONに変換可能な型に変換する関数。
-    """
-    if isinstance(obj, Decimal):
-        if obj % 1 == 0:
-            return int(obj)  # 整数に変換
-        else:
-            return float(obj)  # 小数に変換
-    raise TypeError("Type not serializable")
+def get_table():
+    """DynamoDBのテーブル（最初に使うときに作成し、ウォームスタート時は使い回す）"""
+    return clients.dynamodb_table(TABLE_NAME)
 
 def lambda_handler(event, context):
     # リクエストボディからデータを取得
@@ -48,12 +42,18 @@ def lambda_handler(event, context):
                 attributes_to_update.append(f"{key} = :{key}")
                 expression_attribute_values[f":{key}"] = body[key]
 
+    # 更新日時とバージョンも更新する（プロンプトのキャッシュはバージョンで変更を検知する）
+    attributes_to_update.append("updatedAt = :updatedAt")
+    expression_attribute_values[":updatedAt"] = str(int(time.time()))
+    attributes_to_update.append(f"{profile_store.VERSION_ATTRIBUTE} = :version")
+    expression_attribute_values[":version"] = profile_store.new_version()
+
     # 更新式を作成
     update_expression += ", ".join(attributes_to_update)
 
     try:
         # DynamoDBのテーブルを更新
-        response = table.update_item(
+        response = get_table().update_item(
             Key={
                 'lineId': line_id
             },
@@ -62,20 +62,14 @@ def lambda_handler(event, context):
             ReturnValues="UPDATED_NEW"  # 更新後の新しい値を返す
         )
 
-        return {
-            'statusCode': 200,
-            'body': json.dumps({
-                'message': 'User information updated successfully!',
-                'data': response['Attributes']  # 更新された属性を返す
-            })
-        }
+        return json_response(200, {
+            'message': 'User information updated successfully!',
+            'data': response['Attributes']  # 更新された属性を返す
+        })
 
     except ClientError as e:
         print(e.response['Error']['Message'])
-        return {
-            'statusCode': 500,
-            'body': json.dumps({
-                'message': 'Failed to update user information.',
-                'error': e.response['Error']['Message']
-            })
-        }
+        return json_response(500, {
+            'message': 'Failed to update user information.',
+            'error': e.response['Error']['Message']
+        })
@@ -0,0 +1,167 @@
+"""
+有料プランの利用権（エンタイトルメント）
+Stripeのwebhookで利用権のテーブルに書き込んだ状態（subscriptionStatus・subscriptionPeriodEnd）を、
+メッセージ処理のたびにStripeへ問い合わせずに判定する
+プロフィールの作成（put_item）で消されないよう、利用権はLineUserProfilesとは別のテーブルに持つ
+判定結果はコンテナ内にキャッシュし、キャッシュの期限は契約期間の終わりを超えないようにする
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import clients
+
+logger = logging.getLogger()
+
+# 利用権のテーブル（キーはlineId）
+ENTITLEMENT_TABLE_NAME = os.getenv('ENTITLEMENT_TABLE', 'LineUserEntitlements')
+# 利用権があるとみなすStripeのサブスクリプションの状態
+ACTIVE_STATUSES = ('active', 'trialing')
+# 単発の決済（payment_intent.succeeded）で付与する利用期間（日）
+ONE_TIME_PERIOD_DAYS = int(os.getenv('ONE_TIME_PERIOD_DAYS', '30'))
+# 利用権があるユーザーの判定結果をキャッシュする最大秒数
+ENTITLEMENT_CACHE_SECONDS = int(os.getenv('ENTITLEMENT_CACHE_SECONDS', '600'))
+# 利用権がないユーザーの判定結果をキャッシュする秒数（購入後すぐに使えるように短くする）
+ENTITLEMENT_NEGATIVE_CACHE_SECONDS = int(os.getenv('ENTITLEMENT_NEGATIVE_CACHE_SECONDS', '30'))
+# キャッシュするユーザー数の上限
+ENTITLEMENT_CACHE_MAX_USERS = int(os.getenv('ENTITLEMENT_CACHE_MAX_USERS', '4096'))
+
+# 利用権の判定に使う項目
+ENTITLEMENT_FIELDS = ('subscriptionStatus', 'subscriptionPeriodEnd')
+
+
+def get_table():
+    return clients.dynamodb_table(ENTITLEMENT_TABLE_NAME)
+
+
+def is_entitled(item, now=None):
+    """利用権のアイテムから、現時点で利用権があるか判定する"""
+    if not item or item.get('subscriptionStatus') not in ACTIVE_STATUSES:
+        return False
+    period_end = item.get('subscriptionPeriodEnd')
+    return period_end is None or (now or time.time()) < int(period_end)
+
+
+def materialize(line_id, status, period_end, event_created, subscription_id=None, table=None):
+    """
+    Stripeのイベントから求めた利用権を書き込む
+    Stripeのイベントは順不同で届くので、書き込み済みのものより古いイベントでは上書きしない
+    戻り値は書き込んだかどうか
+    """
+    from botocore.exceptions import ClientError
+
+    values = {
+        ':status': status,
+        ':periodEnd': int(period_end) if period_end is not None else None,
+        ':eventAt': int(event_created)
+    }
+    update = 'SET subscriptionStatus = :status, subscriptionPeriodEnd = :periodEnd, entitlementEventAt = :eventAt'
+    if subscription_id:
+        update += ', subscriptionId = :subscriptionId'
+        values[':subscriptionId'] = subscription_id
+    try:
+        (table or get_table()).update_item(
+            Key={'lineId': line_id},
+            UpdateExpression=update,
+            ConditionExpression='attribute_not_exists(entitlementEventAt) OR entitlementEventAt <= :eventAt',
+            ExpressionAttributeValues=values
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        logger.info(f"より新しいイベントが反映済みのため利用権を更新しません: {line_id}")
+        return False
+    get_cache().invalidate(line_id)
+    return True
+
+
+def from_subscription(subscription):
+    """Stripeのサブスクリプションから (lineId, 状態, 期間の終わり) を取り出す（lineIdはmetadataに入れておく）"""
+    line_id = (subscription.get('metadata') or {}).get('lineId')
+    period_end = subscription.get('current_period_end')
+    if period_end is None:
+        # 新しいAPIバージョンでは期間はサブスクリプションのアイテムごとに持つ
+        items = (subscription.get('items') or {}).get('data') or []
+        period_end = max((item.get('current_period_end') or 0 for item in items), default=None) or None
+    return line_id, subscription.get('status'), period_end
+
+
+class EntitlementCache:
+    """
+    lineIdごとの利用権の判定結果のキャッシュ（プロセス内、ウォームスタート間で保持）
+    エントリの期限は契約期間の終わりを超えないので、期限切れの契約を有効と判定し続けることはない
+    """
+
+    def __init__(self, get_table=get_table, max_users=ENTITLEMENT_CACHE_MAX_USERS,
+                 ttl_seconds=ENTITLEMENT_CACHE_SECONDS, negative_ttl_seconds=ENTITLEMENT_NEGATIVE_CACHE_SECONDS):
+        self._get_table = get_table
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        # lineId -> (利用権があるか, エントリの期限)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0}
+
+    def _load(self, line_id):
+        response = self._get_table().get_item(
+            Key={'lineId': line_id},
+            ProjectionExpression=', '.join(ENTITLEMENT_FIELDS)
+        )
+        return response.get('Item')
+
+    def check(self, line_id):
+        """利用権があるか（キャッシュが有効ならDynamoDBを読まない）"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(line_id)
+            if entry is not None and now < entry[1]:
+                self._entries.move_to_end(line_id)
+                self.counters['hits'] += 1
+                return entry[0]
+            self.counters['misses'] += 1
+
+        item = self._load(line_id)
+        entitled = is_entitled(item, now)
+        if entitled:
+            expires = now + self.ttl_seconds
+            if item.get('subscriptionPeriodEnd') is not None:
+                expires = min(expires, int(item['subscriptionPeriodEnd']))
+        else:
+            expires = now + self.negative_ttl_seconds
+
+        with self._lock:
+            self._entries[line_id] = (entitled, expires)
+            self._entries.move_to_end(line_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+        return entitled
+
+    def invalidate(self, line_id):
+        with self._lock:
+            self._entries.pop(line_id, None)
+
+    def stats(self):
+        return {**self.counters, 'size': len(self._entries)}
+
+
+_cache = None
+
+
+def get_cache():
+    """共有のキャッシュ（ウォームスタート時は同じインスタンスを使い回す）"""
+    global _cache
+    if _cache is None:
+        _cache = EntitlementCache()
+    return _cache
+
+
+def check(line_id):
+    return get_cache().check(line_id)
+
+
+def plan_of(line_id):
+    """レート制限などに使うプラン名（利用権があればpaid、なければfree）"""
+    return 'paid' if check(line_id) else 'free'
@@ -0,0 +1,59 @@
+"""
+Webhookの複数イベントを並行して処理するディスパッチャー
+異なるユーザーのイベントは並行して処理し、同じユーザーのイベントは受信順に処理する
+"""
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+# 同時に処理するユーザー数の上限
+EVENT_CONCURRENCY = int(os.getenv('EVENT_CONCURRENCY', '8'))
+
+
+def user_key(event):
+    """LINEイベントの送信元ユーザーID（取得できなければイベントごとに別扱い）"""
+    source = getattr(event, 'source', None)
+    return getattr(source, 'user_id', None) or id(event)
+
+
+def dispatch_events(events, handler, key=user_key, max_workers=None):
+    """
+    イベントをユーザーごとにまとめ、ユーザー単位で並行して処理する
+    handlerで発生した例外は全イベントの処理後に最初のものを送出する
+    """
+    started = time.perf_counter()
+
+    # 受信順を保ったままユーザーごとにグループ化
+    groups = {}
+    for event in events:
+        groups.setdefault(key(event), []).append(event)
+
+    errors = []
+
+    def run_group(group):
+        for event in group:
+            try:
+                handler(event)
+            except Exception as e:
+                logger.error(f"イベント処理でエラーが発生しました: {e}")
+                errors.append(e)
+
+    workers = max(1, min(max_workers or EVENT_CONCURRENCY, len(groups)))
+    if workers == 1:
+        for group in groups.values():
+            run_group(group)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(run_group, groups.values()))
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    logger.info(
+        f"{len(events)}件のイベント（{len(groups)}ユーザー）を{elapsed_ms:.0f}msで処理しました"
+        f"（並列数: {workers}）"
+    )
+
+    if errors:
+        raise errors[0]
@@ -1,22 +1,14 @@
-import json
-import boto3
+import clients
+import profile_store
 from botocore.exceptions import ClientError
-from decimal import Decimal
+from http_response import json_response, not_modified, request_header
 
-# DynamoDBのリソースを作成
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table('LineUserProfiles')  # 使用するテーブル名
+# 使用するテーブル名
+TABLE_NAME = 'LineUserProfiles'
 
-def decimal_to_dict(obj):
-    """
-    Decimal 型を含むオブジェクトをJSONに変換可能な型に変換する関数。
-    """
-    if isinstance(obj, Decimal):
-        if obj % 1 == 0:
-            return int(obj)  # 整数に変換
-        else:
-            return float(obj)  # 小数に変換
-    raise TypeError("Type not serializable")
+def get_table():
+    """DynamoDBのテーブル（最初に使うときに作成し、ウォームスタート時は使い回す）"""
+    return clients.dynamodb_table(TABLE_NAME)
 
 def lambda_handler(event, context):
     # 受け取るデータ（lineIdをURLパスパラメータとして渡す場合）
@@ -26,51 +18,37 @@ def lambda_handler(event, context):
     headers = {
         'Access-Control-Allow-Origin': '*',  # 必要なら特定のオリジンを指定
         'Access-Control-Allow-Methods': 'GET, OPTIONS',
-        'Access-Control-Allow-Headers': 'Content-Type',
+        'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
+        'Access-Control-Expose-Headers': 'ETag',
     }
 
     if not lineId:
-        return {
-            'statusCode': 400,
-            'headers': headers,
-            'body': json.dumps({
-                'message': 'lineId is required.'
-            })
-        }
+        return json_response(400, {
+            'message': 'lineId is required.'
+        }, headers)
     
     try:
-        # DynamoDBからデータを取得
-        response = table.get_item(
-            Key={'lineId': lineId}
+        # DynamoDBからデータを取得（If-None-Matchが一致すればボディなしの304を返す）
+        profile, etag, unchanged = profile_store.get_profile_if_modified(
+            lineId, request_header(event, 'If-None-Match'), get_table()
         )
         
-        if 'Item' in response:
+        if unchanged:
+            return not_modified({**headers, 'ETag': etag, 'Cache-Control': profile_store.PROFILE_CACHE_CONTROL})
+        if profile is not None:
             # DynamoDBから取得したデータをJSON形式に変換
-            profile = response['Item']
-            return {
-                'statusCode': 200,
-                'headers': headers,  # CORS対応のヘッダーを追加
-                'body': json.dumps({
-                    'message': 'Profile retrieved successfully!',
-                    'data': profile
-                }, default=decimal_to_dict)  # Decimalの処理用にdefault引数を追加
-            }
+            return json_response(200, {
+                'message': 'Profile retrieved successfully!',
+                'data': profile
+            }, {**headers, 'ETag': etag, 'Cache-Control': profile_store.PROFILE_CACHE_CONTROL})
         else:
-            return {
-                'statusCode': 404,
-                'headers': headers,  # CORS対応のヘッダーを追加
-                'body': json.dumps({
-                    'message': 'Profile not found'
-                })
-            }
+            return json_response(404, {
+                'message': 'Profile not found'
+            }, headers)
     
     except ClientError as e:
         # エラーハンドリング
-        return {
-            'statusCode': 500,
-            'headers': headers,  # CORS対応のヘッダーを追加
-            'body': json.dumps({
-                'message': 'Error retrieving profile',
-                'error': str(e)
-            })
-        }
+        return json_response(500, {
+            'message': 'Error retrieving profile',
+            'error': str(e)
+        }, headers)
@@ -0,0 +1,132 @@
+"""
+ウォームスタートしたコンテナ内で会話履歴を保持するキャッシュ
+save_conversationで書き込んだ会話をそのまま追加（ライトスルー）し、次のメッセージでは履歴のクエリを省く
+キャッシュは使うたびに、他のコンテナで書き込まれた会話を見落とさないよう最新のタイムスタンプで検証してから使う
+（検証は最新の数件のキーだけを読むクエリなので、履歴全体を読み直すより軽い）
+HISTORY_CACHE_TRUST_SECONDSを設定した場合だけ、その秒数以内に確かめたキャッシュを検証せずに使う
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+# キャッシュするユーザー数の上限（超えたら最も古く使われたユーザーから捨てる）
+HISTORY_CACHE_MAX_USERS = int(os.getenv('HISTORY_CACHE_MAX_USERS', '256'))
+# ユーザーごとにキャッシュする会話の件数の上限
+HISTORY_CACHE_MAX_TURNS = int(os.getenv('HISTORY_CACHE_MAX_TURNS', '40'))
+# 検証せずに使う秒数（既定の0なら毎回検証する）
+# 設定するとコンテナ間の一貫性を諦めることになり、この間に他のコンテナで書き込まれた会話は次の検証まで履歴に入らない
+HISTORY_CACHE_TRUST_SECONDS = float(os.getenv('HISTORY_CACHE_TRUST_SECONDS', '0'))
+# 検証に使う最新の会話の件数
+VALIDATION_DEPTH = 2
+
+
+class CachedHistory:
+    """1ユーザー分のキャッシュ（turnsは要約以降の会話を新しい順に保持）"""
+
+    def __init__(self, summary, turns, complete, checked_at):
+        self.summary = summary
+        self.turns = turns
+        # Trueなら要約以降の会話を全て保持している
+        self.complete = complete
+        # DynamoDBと一致していることを最後に確かめた時刻（time.monotonic）
+        self.checked_at = checked_at
+
+    @property
+    def covered_until(self):
+        return self.summary['coveredUntil'] if self.summary else None
+
+    def latest_timestamps(self):
+        return [item['timestamp'] for item in self.turns[:VALIDATION_DEPTH]]
+
+
+class HistoryCache:
+
+    def __init__(self, max_users=HISTORY_CACHE_MAX_USERS, max_turns=HISTORY_CACHE_MAX_TURNS,
+                 trust_seconds=HISTORY_CACHE_TRUST_SECONDS):
+        self.max_users = max_users
+        self.max_turns = max_turns
+        self.trust_seconds = trust_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'revalidated': 0, 'misses': 0, 'stale': 0}
+
+    def get(self, line_id, latest_timestamps):
+        """
+        キャッシュを取得
+        latest_timestamps（キャッシュの要約以降の最新の会話のタイムスタンプを取得する関数）で検証し、
+        キャッシュと一致しなければ（他のコンテナで書き込まれていれば）キャッシュを捨ててNoneを返す
+        trust_secondsを0より大きくした場合は、その秒数以内に確かめたキャッシュを検証せずに返す
+        （その間は他のコンテナで書き込まれた会話が履歴に入らず、コンテナ間の鮮度は保証しない）
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(line_id)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            if now - entry.checked_at < self.trust_seconds:
+                self._entries.move_to_end(line_id)
+                self.counters['hits'] += 1
+                return entry
+            covered_until = entry.covered_until
+            expected = entry.latest_timestamps()
+
+        if latest_timestamps(covered_until) != expected:
+            with self._lock:
+                self._entries.pop(line_id, None)
+                self.counters['stale'] += 1
+            return None
+
+        with self._lock:
+            entry.checked_at = now
+            self._entries.move_to_end(line_id)
+            self.counters['revalidated'] += 1
+            return entry
+
+    def put(self, line_id, summary, turns, complete):
+        """DynamoDBから読んだ要約と会話（新しい順）をキャッシュ"""
+        if len(turns) > self.max_turns:
+            turns = turns[:self.max_turns]
+            complete = False
+        with self._lock:
+            self._entries[line_id] = CachedHistory(summary, list(turns), complete, time.monotonic())
+            self._entries.move_to_end(line_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def append(self, line_id, item):
+        """保存した会話をキャッシュに追加（キャッシュがないユーザーは何もしない）"""
+        with self._lock:
+            entry = self._entries.get(line_id)
+            if entry is None:
+                return
+            entry.turns.insert(0, item)
+            # このコンテナが書き込んだ会話なので、キャッシュは最新のまま
+            entry.checked_at = time.monotonic()
+            if len(entry.turns) > self.max_turns:
+                del entry.turns[self.max_turns:]
+                entry.complete = False
+
+    def update_summary(self, line_id, summary):
+        """要約を更新し、要約に含まれた会話をキャッシュから外す"""
+        with self._lock:
+            entry = self._entries.get(line_id)
+            if entry is None:
+                return
+            entry.summary = summary
+            entry.turns = [item for item in entry.turns if item['timestamp'] > summary['coveredUntil']]
+
+    def stats(self):
+        with self._lock:
+            lookups = sum(self.counters.values())
+            hits = self.counters['hits'] + self.counters['revalidated']
+            return {
+                **self.counters,
+                'users': len(self._entries),
+                'turns': sum(len(entry.turns) for entry in self._entries.values()),
+                'hitRate': round(hits / lookups, 3) if lookups else 0.0
+            }
@@ -0,0 +1,94 @@
+"""
+ハンドラーのレスポンスのJSONエンコード
+DynamoDBの型（Decimal・セット・バイナリ）をエンコードと同じ1回の走査で変換する
+orjsonがインストールされていればそちらを使う（JSON_BACKEND=json で標準ライブラリに固定できる）
+条件付きGET（ETag / If-None-Match）のヘルパーもここに置く
+"""
+import base64
+import hashlib
+import json
+import os
+from decimal import Decimal
+
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'auto')
+
+try:
+    if JSON_BACKEND == 'json':
+        raise ImportError
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj):
+    """
+    JSONエンコーダーが扱えない型の変換（エンコード中に該当する値だけで呼ばれる）
+    Decimalは整数ならint、小数ならfloatに変換する
+    """
+    if isinstance(obj, Decimal):
+        integer = int(obj)
+        return integer if integer == obj else float(obj)
+    if isinstance(obj, (set, frozenset)):
+        # DynamoDBのセットは順序を持たないので、レスポンスが安定するように並べる
+        return sorted(obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return base64.b64encode(obj).decode('ascii')
+    # boto3.dynamodb.types.Binary（boto3を読み込まずに判定する）
+    value = getattr(obj, 'value', None)
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError(f"Type not serializable: {type(obj).__name__}")
+
+
+def encode_json(obj):
+    """DynamoDBのアイテムを含むオブジェクトをJSON文字列にエンコード"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=_default).decode('utf-8')
+        except orjson.JSONEncodeError:
+            # orjsonは64ビットを超える整数（DynamoDBの数値は38桁まで）を扱えないので、標準ライブラリでエンコードする
+            pass
+    return json.dumps(obj, default=_default, ensure_ascii=False, separators=(',', ':'))
+
+
+def json_response(status_code, body, headers=None):
+    """API Gateway / Lambdaのレスポンスを作る"""
+    response = {
+        'statusCode': status_code,
+        'body': encode_json(body)
+    }
+    if headers is not None:
+        response['headers'] = headers
+    return response
+
+
+def make_etag(*parts):
+    """値から弱いETagを作る（キーの順序に関係なく、同じ値なら同じETagになる）"""
+    material = json.dumps(parts, default=_default, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    digest = hashlib.sha1(material.encode('utf-8')).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def request_header(event, name):
+    """リクエストヘッダーの値（API Gatewayのヘッダー名は大文字小文字が揃っていないので区別せずに探す）"""
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Matchのいずれかのタグが一致するか（弱い比較）"""
+    if not if_none_match or not etag:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag.removeprefix('W/') in {tag.removeprefix('W/') for tag in tags}
+
+
+def not_modified(headers=None):
+    """304 Not Modified（ボディなし）"""
+    response = {'statusCode': 304, 'body': ''}
+    if headers is not None:
+        response['headers'] = headers
+    return response
@@ -0,0 +1,198 @@
+"""
+イベントの重複処理を防ぐための処理済みイベントの記録
+DynamoDBの条件付き書き込みで「最初に処理を始めたもの」だけが処理し、再送や重複は処理せずに応答する
+処理済みのキーはコンテナ内にも保持し、ウォームスタート時の再送はDynamoDBを読まずに判定する
+StripeのwebhookとLINEのWebhookイベント（webhookEventId）の両方で使う
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import clients
+
+logger = logging.getLogger()
+
+IDEMPOTENCY_TABLE = os.getenv('IDEMPOTENCY_TABLE', 'ProcessedEvents')
+# 処理済みの記録を残す秒数（Stripeは最大3日間再送するので、それより長くする）
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', str(7 * 86400)))
+# 処理中のまま止まった（タイムアウトなど）記録を、別の実行が引き継げるようになるまでの秒数
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv('IDEMPOTENCY_LOCK_SECONDS', '300'))
+# コンテナ内に保持する処理済みのキーの数
+IDEMPOTENCY_SEEN_MAX = int(os.getenv('IDEMPOTENCY_SEEN_MAX', '4096'))
+
+# claim() の結果（IN_PROGRESS・COMPLETEDは記録のstatusと同じ値）
+CLAIMED = 'claimed'
+IN_PROGRESS = 'in_progress'
+COMPLETED = 'completed'
+
+
+class EventInProgress(Exception):
+    """他の実行が処理中のイベント（受信済みにせず、後で再送・再配信させる）"""
+
+
+class IdempotencyStore:
+    """
+    キーごとに1回だけ処理するための記録
+    claim() がCLAIMEDを返した呼び出し元だけが処理し、終わったら complete()、失敗したら release() する
+    COMPLETEDなら処理済みなので受信済みとしてよいが、IN_PROGRESSは他の実行の処理が失敗するかもしれないので、
+    受信済みとせずに再送させる
+    """
+
+    def __init__(self, table=None, ttl_seconds=IDEMPOTENCY_TTL_SECONDS, lock_seconds=IDEMPOTENCY_LOCK_SECONDS,
+                 seen_max=IDEMPOTENCY_SEEN_MAX):
+        self._table = table
+        self.ttl_seconds = ttl_seconds
+        self.lock_seconds = lock_seconds
+        self.seen_max = seen_max
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'claimed': 0, 'seenHits': 0, 'duplicates': 0}
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = clients.dynamodb_table(IDEMPOTENCY_TABLE)
+        return self._table
+
+    def _remember(self, key):
+        with self._lock:
+            self._seen[key] = True
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.seen_max:
+                self._seen.popitem(last=False)
+
+    def _count(self, name):
+        # 複数のスレッドから同時にclaimされるので、カウンターもロックの中で更新する
+        with self._lock:
+            self.counters[name] += 1
+
+    def seen(self, key):
+        """このコンテナで処理済みのキーか（DynamoDBは読まない）"""
+        with self._lock:
+            return key in self._seen
+
+    def claim(self, key):
+        """
+        キーの処理を始めてよければCLAIMED
+        処理済みならCOMPLETED、他の実行が処理中（ロックの期限内）ならIN_PROGRESS
+        """
+        from botocore.exceptions import ClientError
+
+        if self.seen(key):
+            self._count('seenHits')
+            return COMPLETED
+
+        now = int(time.time())
+        try:
+            self.table.put_item(
+                Item={
+                    'idempotencyKey': key,
+                    'status': IN_PROGRESS,
+                    'lockedUntil': now + self.lock_seconds,
+                    'expiresAt': now + self.ttl_seconds
+                },
+                ConditionExpression='attribute_not_exists(idempotencyKey) OR (#status = :in_progress AND lockedUntil < :now)',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={':in_progress': IN_PROGRESS, ':now': now},
+                ReturnValuesOnConditionCheckFailure='ALL_OLD'
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            self._count('duplicates')
+            # 失敗時の既存の記録は型付きの形式（{'S': ...}）で返る
+            status = e.response.get('Item', {}).get('status', {}).get('S')
+            if status == COMPLETED:
+                self._remember(key)
+                return COMPLETED
+            return IN_PROGRESS
+        self._count('claimed')
+        return CLAIMED
+
+    def complete(self, key):
+        """処理が終わったことを記録する"""
+        self.table.update_item(
+            Key={'idempotencyKey': key},
+            UpdateExpression='SET #status = :completed REMOVE lockedUntil',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':completed': COMPLETED}
+        )
+        self._remember(key)
+
+    def release(self, key):
+        """処理に失敗したので記録を消し、再送されたときにもう一度処理できるようにする"""
+        try:
+            self.table.delete_item(Key={'idempotencyKey': key})
+        except Exception as e:
+            # 消せなくてもロックの期限が過ぎれば引き継げる
+            logger.error(f"処理中の記録を削除できませんでした（{key}）: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {**self.counters, 'seenSize': len(self._seen)}
+
+
+_store = None
+
+
+def get_store():
+    """共有の記録（ウォームスタート時は同じインスタンスを使い回す）"""
+    global _store
+    if _store is None:
+        _store = IdempotencyStore()
+    return _store
+
+
+def line_event_key(event):
+    """LINEのWebhookイベントの重複判定に使うキー（webhookEventIdがなければNone）"""
+    event_id = getattr(event, 'webhook_event_id', None)
+    return f"line:{event_id}" if event_id else None
+
+
+def is_redelivery(event):
+    """LINEが再送したイベントか（deliveryContext.isRedelivery）"""
+    return bool(getattr(getattr(event, 'delivery_context', None), 'is_redelivery', False))
+
+
+def claim_line_event(event, store=None):
+    """
+    LINEのWebhookイベントを処理してよいか判定する
+    重複は条件付き書き込み1回（処理済みならコンテナ内の記録だけ）で破棄する
+    他の実行が処理中ならEventInProgressを送出する（その処理が失敗しても取りこぼさないよう、呼び出し元は失敗として扱う）
+    戻り値は (処理してよいか, 処理後にfinish_line_eventへ渡すキー)
+    """
+    key = line_event_key(event)
+    if key is None:
+        return True, None
+    store = store or get_store()
+    try:
+        state = store.claim(key)
+    except Exception as e:
+        # 判定できないときは処理を止めない
+        logger.error(f"イベントの重複判定でエラーが発生しました（{key}）: {e}")
+        return True, None
+    if state == CLAIMED:
+        if is_redelivery(event):
+            logger.info(f"再送されたイベントを処理します（最初の配信は処理されていません）: {key}")
+        return True, key
+    if state == IN_PROGRESS:
+        raise EventInProgress(key)
+    logger.info(f"重複したイベントを破棄します: {key}（再送: {is_redelivery(event)}）")
+    return False, None
+
+
+def finish_line_event(key, succeeded=True, store=None):
+    """処理が終わったイベントを処理済みにする（失敗したら記録を消して再送時に処理できるようにする）"""
+    if key is None:
+        return
+    store = store or get_store()
+    if not succeeded:
+        store.release(key)
+        return
+    try:
+        store.complete(key)
+    except Exception as e:
+        # 記録できなくてもロックの期限までは重複を防げる
+        logger.error(f"処理済みの記録に失敗しました（{key}）: {e}")
@@ -1,11 +1,20 @@
-import json
 import logging
 import os
 import sys
-import boto3
-from linebot import LineBotApi, WebhookHandler
+from linebot import WebhookParser
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
+import clients
+import entitlements
+import event_dispatcher
+import idempotency
+import llm_providers
+import metrics
+from http_response import json_response
+import prompt_builder
+import rate_limit
+import response_cache
+from deadline import Deadline, FALLBACK_ANSWER, truncated_answer
 
 # ログ設定
 logger = logging.getLogger()
@@ -15,88 +24,176 @@ logger.setLevel(logging.INFO)
 CHANNEL_ACCESS_TOKEN = os.getenv('CHANNEL_ACCESS_TOKEN')
 CHANNEL_SECRET = os.getenv('CHANNEL_SECRET')
 
+# Webhookイベントの重複（LINEの再送など）をwebhookEventIdで判定し、2回目以降は処理しない
+EVENT_DEDUP_ENABLED = os.getenv('EVENT_DEDUP_ENABLED', 'true').lower() == 'true'
+# モデル呼び出しの回数の上限に達したユーザーへの応答
+RATE_LIMITED_MESSAGE = os.getenv(
+    'RATE_LIMITED_MESSAGE',
+    'メッセージが多いため、少し時間をおいてから再度お試しください。'
+)
+
 if not CHANNEL_ACCESS_TOKEN or not CHANNEL_SECRET:
     logger.error('LINE環境変数が設定されていません。')
     sys.exit(1)
 
-line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN)
-webhook_handler = WebhookHandler(CHANNEL_SECRET)
+line_bot_api = clients.line_bot_api(CHANNEL_ACCESS_TOKEN)
+webhook_parser = WebhookParser(CHANNEL_SECRET)
 
-# Bedrockクライアントの初期化
-bedrock = boto3.client(
-    service_name='bedrock-runtime',
-    region_name='us-east-1'
-)
+# ユーザーのプロフィールからシステムプロンプトを組み立てる（組み立て済みのものはキャッシュする）
+# テーブルは最初に使うときに作成する
+prompt_cache = prompt_builder.PromptCache(lambda: clients.dynamodb_table('LineUserProfiles'))
+
+# モデルのプロバイダー（LLM_PROVIDERSで順序の変更や、他のプロバイダーへのフォールバックを設定する）
+llm_router = llm_providers.router_from_env('bedrock')
+
+def get_system_prompt(line_id):
+    """ユーザーのプロフィールを反映したシステムプロンプトを取得"""
+    try:
+        return prompt_cache.get_prompt(line_id)
+    except Exception as e:
+        logger.error(f"プロフィールの取得エラー: {str(e)}")
+        return prompt_builder.BASE_PROMPT
+
+def get_claude_response(user_input, system_message=prompt_builder.BASE_PROMPT, deadline=None, use_cache=True):
+    """
+    Claudeからの応答をストリーミングで取得（LLM_PROVIDERSで他のプロバイダーへのフォールバックも設定できる）
+    デッドラインまでに生成し終わらない場合は、そこまでの出力を整えて返す
+    use_cache=Falseで応答キャッシュを使わずに必ずモデルを呼び出す
+    """
+    deadline = deadline or Deadline.from_context(None)
+    try:
+        # 同じ質問への応答がキャッシュにあればモデルを呼ばない
+        # システムプロンプトはプロフィールの項目（prompt_builder.PROFILE_FIELDS）から組み立てたものなので、
+        # キーにはプロンプトを通してそれらの項目が入り、プロフィールが同じユーザーの間でだけ応答を共有する
+        cache_key, cached_answer = response_cache.lookup(system_message, user_input, use_cache=use_cache)
+        if cached_answer is not None:
+            deadline.note('cache', 'hit')
+            return cached_answer
+
+        messages = [
+            {
+                "role": "user",
+                "content": user_input
+            }
+        ]
+        metrics.log_payload('Request messages', messages)
+
+        completion = llm_router.generate(system_message, messages, deadline, max_tokens=500)
+        deadline.note('provider', completion.provider)
+        if completion.hedged:
+            deadline.note('hedged', True)
+        if completion.truncated:
+            deadline.note('truncated', True)
+            return truncated_answer(completion.text)
 
-def get_claude_response(user_input):
+        answer = completion.text
+        if not answer:
+            return FALLBACK_ANSWER
+        # 最後まで生成できた応答だけをキャッシュする
+        response_cache.store(cache_key, answer)
+        return answer
+
+    except Exception as e:
+        # エラーの内容はユーザーに見せない
+        logger.error(f"モデル呼び出しエラー: {str(e)}")
+        return FALLBACK_ANSWER
+
+def handle_event(event, deadline=None):
+    """Webhookイベントを種類に応じたハンドラーに振り分ける"""
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        handle_message(event, deadline.for_event() if deadline else None)
+
+def claim_event(event):
+    """イベントを処理してよいか（EVENT_DEDUP_ENABLEDが無効なら常に処理する）"""
+    if not EVENT_DEDUP_ENABLED:
+        return True, None
+    return idempotency.claim_line_event(event)
+
+def within_rate_limit(user_id):
+    """モデルを呼び出してよいか（プランごとの上限。判定できないときは止めない）"""
     try:
-        system_message = "あなたは世界一のフィットネスコーチです、私の質問と基本情報を元に痩せるまでの完璧な私専用のパーソナルアドバイスをしてください。性別: male、年齢: 34歳、身長: 175cm、体重: 70kg、目標体重: 65kg、目標期間: 6 months、食事回数: 3 meals a day、運動頻度: 3 times a week (gym)"
-        # Bedrock用のリクエストボディを作成
-        body = json.dumps({
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 500,
-            "messages": [
-                {
-                    "role": "assistant",
-                    "content": system_message
-                },
-                {
-                    "role": "user",
-                    "content": user_input
-                }
-            ]
-        })
-        
-        logger.info(f"Request body: {body}")
-        
-        # Bedrockを呼び出してレスポンスを取得
-        response = bedrock.invoke_model(
-            modelId='anthropic.claude-3-haiku-20240307-v1:0',
-            body=body.encode('utf-8')
-        )
-        
-        response_body = json.loads(response['body'].read().decode('utf-8'))
-        return response_body['choices'][0]['message']['content']
-    
+        return rate_limit.allow_user(user_id, entitlements.plan_of(user_id))
     except Exception as e:
-        logger.error(f"Bedrockエラー: {str(e)}")
-        return f"エラーが発生しました: {str(e)}"
+        logger.error(f"レート制限の確認でエラーが発生しました: {e}")
+        return True
 
-@webhook_handler.add(MessageEvent, message=TextMessage)
-def handle_message(event):
+def handle_message(event, deadline=None):
+    deadline = deadline or Deadline.from_context(None)
+    # 同じイベントの再送ではモデルの呼び出しも会話の保存もしない
+    # 他の実行が処理中ならEventInProgressが送出され、Webhookはエラーを返して（ワーカーは失敗として）再送させる
+    with deadline.stage('dedup'):
+        processing, event_key = claim_event(event)
+    if not processing:
+        deadline.note('duplicate', True)
+        deadline.report('lambda_function')
+        return
+    try:
+        _handle_message(event, deadline)
+    except Exception:
+        idempotency.finish_line_event(event_key, succeeded=False)
+        raise
+    idempotency.finish_line_event(event_key)
+
+def _handle_message(event, deadline):
     try:
         # ユーザーのメッセージ内容
         user_message = event.message.text
 
+        # 上限に達したユーザーにはモデルを呼び出さずに応答する
+        with deadline.stage('rate_limit'):
+            allowed = within_rate_limit(event.source.user_id)
+        if not allowed:
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=RATE_LIMITED_MESSAGE))
+            deadline.note('rateLimited', True)
+            deadline.report('lambda_function')
+            return
+
+        # ユーザーのプロフィールを反映したシステムプロンプト
+        with deadline.stage('prompt'):
+            system_message = get_system_prompt(event.source.user_id)
+
         # Claudeからの応答を取得
-        answer = get_claude_response(user_message)
-        logger.info(f"Claude response: {answer}")
+        with deadline.stage('model'):
+            answer = get_claude_response(user_message, system_message, deadline)
+        deadline.note('answerChars', len(answer))
+        metrics.log_payload('Claude response', answer)
 
         # 応答メッセージをLINEに送信
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=answer))
+        with deadline.stage('reply'):
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=answer))
 
     except Exception as e:
         logger.error(f"handle_message関数でエラーが発生しました: {e}")
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text="エラーが発生しました。"))
 
+    deadline.report('lambda_function')
+
 def lambda_handler(event, context):
+    deadline = Deadline.from_context(context)
+
     signature = event['headers'].get('x-line-signature')
     if not signature:
-        return {'statusCode': 400, 'body': json.dumps('Missing signature')}
+        return json_response(400, 'Missing signature')
 
     body = event['body']
-    logger.info(f"Webhook body: {body}")
+    metrics.log_payload('Webhook body', body)
 
     try:
-        webhook_handler.handle(body, signature)
+        # 署名の検証（とイベントの組み立て）
+        with deadline.stage('signature'):
+            events = webhook_parser.parse(body, signature)
+        with deadline.stage('dispatch'):
+            event_dispatcher.dispatch_events(events, lambda e: handle_event(e, deadline))
     except InvalidSignatureError:
         logger.error("署名が無効です。")
-        return {'statusCode': 400, 'body': json.dumps('Invalid signature')}
+        return json_response(400, 'Invalid signature')
     except LineBotApiError as e:
         logger.error(f"LINE APIエラー: {e.message}")
-        return {'statusCode': 500, 'body': json.dumps('LINE API error')}
+        return json_response(500, 'LINE API error')
     except Exception as e:
         logger.error(f"予期しないエラーが発生しました: {e}")
-        return {'statusCode': 500, 'body': json.dumps('Internal server error')}
+        return json_response(500, 'Internal server error')
+    finally:
+        deadline.report('lambda_function.webhook')
 
-    return {'statusCode': 200, 'body': json.dumps('Success')}
\ No newline at end of file
+    return json_response(200, 'Success')
\ No newline at end of file
@@ -1,15 +1,30 @@
+import asyncio
 import json
 import logging
 import os
 import sys
-import openai
-from linebot import LineBotApi, WebhookHandler
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from linebot import WebhookParser
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
-import requests
-import boto3
+import time
 from datetime import datetime
-from boto3.dynamodb.conditions import Key
+import clients
+import conversation_days
+import conversation_store
+import entitlements
+import event_dispatcher
+import idempotency
+import history_cache
+import llm_providers
+import metrics
+from http_response import json_response
+from deadline import Deadline, FALLBACK_ANSWER, truncated_answer
+import message_queue
+import rate_limit
+import response_cache
 
 # ログ設定
 logger = logging.getLogger()
@@ -20,92 +35,273 @@ CHANNEL_ACCESS_TOKEN = os.getenv('CHANNEL_ACCESS_TOKEN')
 CHANNEL_SECRET = os.getenv('CHANNEL_SECRET')
 OPENAI_API_KEY = os.environ['OPENAI_API_KEY']
 
+# Webhookの処理モード
+# inline: Webhook内で応答まで処理する / deferred: イベントをキューに積んで即時に200を返し、ワーカーで処理する
+WEBHOOK_MODE = os.getenv('WEBHOOK_MODE', 'inline')
+# リプライトークンを使う猶予（秒）。これを過ぎたイベントにはプッシュメッセージで応答する
+REPLY_TOKEN_TTL_SECONDS = int(os.getenv('REPLY_TOKEN_TTL_SECONDS', '50'))
+# メッセージ処理パイプライン
+# sync: 従来通り逐次処理する / async: ローディング表示・会話履歴・プロフィール取得を並行して行う
+MESSAGE_PIPELINE = os.getenv('MESSAGE_PIPELINE', 'sync')
+
+# 有料プランの利用権があるユーザーだけにAIコーチを使わせるか
+REQUIRE_SUBSCRIPTION = os.getenv('REQUIRE_SUBSCRIPTION', 'false').lower() == 'true'
+SUBSCRIPTION_REQUIRED_MESSAGE = os.getenv(
+    'SUBSCRIPTION_REQUIRED_MESSAGE',
+    'AIコーチのご利用には有料プランへの登録が必要です。メニューの「プラン登録」からお手続きください。'
+)
+
+# Webhookイベントの重複（LINEの再送など）をwebhookEventIdで判定し、2回目以降は処理しない
+EVENT_DEDUP_ENABLED = os.getenv('EVENT_DEDUP_ENABLED', 'true').lower() == 'true'
+# モデル呼び出しの回数の上限に達したユーザーへの応答
+RATE_LIMITED_MESSAGE = os.getenv(
+    'RATE_LIMITED_MESSAGE',
+    'メッセージが多いため、少し時間をおいてから再度お試しください。'
+)
+
+# LINEの表示名をコンテナ内にキャッシュする秒数（表示名の変更はこの時間が過ぎてから応答に反映される）
+DISPLAY_NAME_CACHE_SECONDS = int(os.getenv('DISPLAY_NAME_CACHE_SECONDS', '3600'))
+# 表示名をキャッシュするユーザー数の上限
+DISPLAY_NAME_CACHE_MAX_USERS = int(os.getenv('DISPLAY_NAME_CACHE_MAX_USERS', '1024'))
+
+LOADING_URL = 'https://api.line.me/v2/bot/chat/loading/start'
+
 if not CHANNEL_ACCESS_TOKEN or not CHANNEL_SECRET:
     logger.error('LINE環境変数が設定されていません。')
     sys.exit(1)
 
-# OpenAI APIキーの設定
-openai.api_key = OPENAI_API_KEY
+line_bot_api = clients.line_bot_api(CHANNEL_ACCESS_TOKEN)
+webhook_parser = WebhookParser(CHANNEL_SECRET)
+
+def get_conversation_table():
+    """会話履歴のDynamoDBテーブル（最初に使うときに作成する）"""
+    return clients.dynamodb_table(conversation_store.CONVERSATION_TABLE_NAME)
+
+# モデルのプロバイダー（LLM_PROVIDERSで順序の変更や、他のプロバイダーへのフォールバックを設定する）
+llm_router = llm_providers.router_from_env('openai')
+
+# ウォームスタート間で保持する会話履歴のキャッシュ
+conversation_cache = history_cache.HistoryCache()
+
+# ウォームスタート間で保持する表示名のキャッシュ（user_id -> (表示名, 取得した時刻)）
+_display_names = OrderedDict()
+_display_names_lock = threading.Lock()
+
+# 同期パイプラインで、表示名を会話履歴の取得と並行して取得するためのスレッド
+_prefetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='prefetch')
+
+# 非同期パイプラインのイベントループ（専用のスレッドで動かし続ける）とaiohttpのクライアント
+# メッセージごとにループとSessionを作り直すと接続を使い回せないので、コンテナ内で共有する
+_async_loop = None
+_async_loop_lock = threading.Lock()
+_async_clients = None
+
+def run_async(coro):
+    """
+    コルーチンをコンテナで共有するイベントループで実行し、結果を待つ
+    複数のユーザーのイベントを処理するスレッドから同時に呼び出せる
+    """
+    global _async_loop
+    with _async_loop_lock:
+        if _async_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='async-pipeline', daemon=True).start()
+            _async_loop = loop
+    return asyncio.run_coroutine_threadsafe(coro, _async_loop).result()
+
+async def async_clients():
+    """
+    (aiohttpのSession, AsyncLineBotApi)
+    共有のイベントループ上で最初に使うときに作り、以降は同じ接続プールを使う
+    """
+    global _async_clients
+    if _async_clients is None:
+        # 非同期パイプラインを使う場合だけ読み込む
+        import aiohttp
+        from linebot import AsyncLineBotApi
+        from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+
+        session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(
+            connect=clients.HTTP_CONNECT_TIMEOUT, sock_read=clients.HTTP_READ_TIMEOUT
+        ))
+        _async_clients = (session, AsyncLineBotApi(CHANNEL_ACCESS_TOKEN, AiohttpAsyncHttpClient(session)))
+    return _async_clients
+
+def build_chatgpt_messages(user_input, conversation_history, user_name=None):
+    """
+    ChatGPTに送信するメッセージを組み立てる
+    """
+    system_message = "あなたはLINEチャットボットのアシスタントです。ユーザーとの会話履歴を考慮しながら、親切で自然な返答をしてください。"
+    if user_name:
+        system_message += f"ユーザーの名前は{user_name}さんです。"
+
+    # システムメッセージを追加
+    messages = [
+        {
+            "role": "system",
+            "content": system_message
+        }
+    ]
+    
+    # 会話履歴を追加
+    messages.extend(conversation_history)
+    
+    # 現在の入力を追加
+    messages.append({"role": "user", "content": user_input})
+    return messages
 
-line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN)
-webhook_handler = WebhookHandler(CHANNEL_SECRET)
+def cacheable_messages(user_input, conversation_history, user_name=None, use_cache=True):
+    """
+    モデルに送信するメッセージ
+    応答キャッシュを使う質問では、キャッシュした応答を他のユーザーにも返すので、表示名も会話履歴も含めない
+    """
+    if response_cache.cacheable(user_input, use_cache):
+        return build_chatgpt_messages(user_input, [])
+    return build_chatgpt_messages(user_input, conversation_history, user_name)
 
-# DynamoDB クライアントの初期化
-dynamodb = boto3.resource('dynamodb')
-conversation_table = dynamodb.Table('linebot-conversation-history')
+def completion_answer(completion, deadline):
+    """ルーターの結果をユーザーへの応答にする（打ち切った応答は文の区切りまでにする）"""
+    deadline.note('provider', completion.provider)
+    if completion.hedged:
+        deadline.note('hedged', True)
+    if completion.truncated:
+        deadline.note('truncated', True)
+        return truncated_answer(completion.text)
+    if not completion.text:
+        logger.error("ChatGPTから応答がありませんでした")
+        return None
+    return completion.text
 
-def get_chatgpt_response(user_input, conversation_history):
+def get_chatgpt_response(user_input, conversation_history, deadline=None, use_cache=True, user_name=None):
     """
-    ChatGPTからの応答を取得
+    ChatGPTからの応答をストリーミングで取得（LLM_PROVIDERSで他のプロバイダーへのフォールバックも設定できる）
+    デッドラインまでに生成し終わらない場合は、そこまでの出力を整えて返す
+    use_cache=Falseで応答キャッシュを使わずに必ずモデルを呼び出す
     """
+    deadline = deadline or Deadline.from_context(None)
     try:
-        # システムメッセージを追加
-        messages = [
-            {
-                "role": "system",
-                "content": "あなたはLINEチャットボットのアシスタントです。ユーザーとの会話履歴を考慮しながら、親切で自然な返答をしてください。"
-            }
-        ]
-        
-        # 会話履歴を追加
-        messages.extend(conversation_history)
-        
-        # 現在の入力を追加
-        messages.append({"role": "user", "content": user_input})
+        messages = cacheable_messages(user_input, conversation_history, user_name, use_cache)
+
+        # 同じ質問への応答がキャッシュにあればモデルを呼ばない
+        cache_key, cached_answer = response_cache.lookup(messages[0]['content'], user_input, use_cache=use_cache)
+        if cached_answer is not None:
+            deadline.note('cache', 'hit')
+            return cached_answer
         
-        logger.info(f"Sending messages to ChatGPT: {messages}")
+        metrics.log_payload('Sending messages to ChatGPT', messages)
         
-        # ChatGPT APIを呼び出してレスポンスを取得
-        response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            max_tokens=500,
-            temperature=0.7
+        completion = llm_router.generate(messages[0]['content'], messages[1:], deadline, max_tokens=500)
+        answer = completion_answer(completion, deadline)
+        if answer is None:
+            return "申し訳ありません。応答を生成できませんでした。"
+        if not completion.truncated:
+            # 最後まで生成できた応答だけをキャッシュする
+            response_cache.store(cache_key, answer)
+        return answer
+    
+    except Exception as e:
+        # エラーの内容はユーザーに見せない
+        logger.error(f"ChatGPTエラー: {str(e)}")
+        return FALLBACK_ANSWER
+
+async def get_chatgpt_response_async(user_input, conversation_history, user_name=None, deadline=None,
+                                     use_cache=True):
+    """
+    ChatGPTからの応答を非同期で取得
+    ルーターはプロバイダーをスレッドで呼び出すので、イベントループを止めないようにスレッドで待つ
+    """
+    deadline = deadline or Deadline.from_context(None)
+    try:
+        messages = cacheable_messages(user_input, conversation_history, user_name, use_cache)
+
+        # 共有キャッシュはDynamoDBを読むのでスレッドで実行する
+        cache_key, cached_answer = await asyncio.to_thread(
+            response_cache.lookup, messages[0]['content'], user_input, None, use_cache
         )
+        if cached_answer is not None:
+            deadline.note('cache', 'hit')
+            return cached_answer
         
-        if response.choices and len(response.choices) > 0:
-            return response.choices[0].message.content
-        else:
-            logger.error("ChatGPTから応答がありませんでした")
+        completion = await asyncio.to_thread(
+            llm_router.generate, messages[0]['content'], messages[1:], deadline, 500
+        )
+        answer = completion_answer(completion, deadline)
+        if answer is None:
             return "申し訳ありません。応答を生成できませんでした。"
+        if not completion.truncated:
+            await asyncio.to_thread(response_cache.store, cache_key, answer)
+        return answer
     
     except Exception as e:
         logger.error(f"ChatGPTエラー: {str(e)}")
-        return f"エラーが発生しました: {str(e)}"
+        return FALLBACK_ANSWER
 
-def get_conversation_history(line_id, limit=5):
+def get_conversation_history(line_id, token_budget=conversation_store.HISTORY_TOKEN_BUDGET):
     """
-    指定されたユーザーの会話履歴を取得
+    指定されたユーザーの会話履歴を、トークン数の予算内で新しいものから取得
+    コンテナ内のキャッシュを直前に読み書きしていれば、要約と会話のクエリを省く
     """
     try:
-        response = conversation_table.query(
-            KeyConditionExpression=Key('lineId').eq(line_id),
-            ScanIndexForward=False,  # 新しい順
-            Limit=limit
+        history = None
+        entry = conversation_cache.get(
+            line_id,
+            lambda after: conversation_store.latest_timestamps(get_conversation_table(), line_id, after)
         )
-        
-        # 古い順に並び替え（タイムスタンプで昇順ソート）
-        messages = sorted(response['Items'], key=lambda x: x['timestamp'])
-        
-        # ChatGPTに送信する形式に変換
-        formatted_messages = []
-        for msg in messages:
-            formatted_messages.append({
-                "role": "user", 
-                "content": msg['user_message']
-            })
-            if msg.get('assistant_message'):
-                formatted_messages.append({
-                    "role": "assistant", 
-                    "content": msg['assistant_message']
-                })
-        
-        logger.info(f"Retrieved conversation history: {formatted_messages}")
-        return formatted_messages
+        if entry is not None:
+            history, _, exhausted = conversation_store.select_history(entry.summary, entry.turns, token_budget)
+            if exhausted and not entry.complete:
+                # キャッシュにある会話だけでは予算を埋められないのでDynamoDBから読み直す
+                history = None
+
+        if history is None:
+            history, turns, complete = conversation_store.build_history(get_conversation_table(), line_id, token_budget)
+            conversation_cache.put(line_id, history.summary, turns, complete)
+
+        metrics.log_payload('Retrieved conversation history', history.messages)
+        return history
     
     except Exception as e:
         logger.error(f"会話履歴の取得エラー: {str(e)}")
-        return []
+        return conversation_store.ConversationHistory([], None, [])
+
+def refresh_summary(line_id, history, deadline):
+    """
+    予算から外れた古い会話を、ユーザーごとの要約に追加でまとめる
+    要約に含まれていない最も古い会話から1回にSUMMARY_BATCH_TURNS件ずつ進める
+    応答の送信後に呼び出すので、ユーザーへの応答時間には影響しない
+    応答と同じルーター（フォールバック・サーキットブレーカー）で生成し、デッドラインで打ち切られた要約は保存しない
+    """
+    if not history.overflow:
+        return
+    try:
+        batch = conversation_store.summary_batch(get_conversation_table(), line_id, history)
+        previous = history.summary['summary'] if history.summary else 'なし'
+        turns = "\n".join(
+            f"ユーザー: {item['user_message']}\nアシスタント: {item.get('assistant_message', '')}"
+            for item in batch
+        )
+        completion = llm_router.generate(
+            (
+                "あなたは会話の要約係です。これまでの要約と新しい会話をまとめて、"
+                "ユーザーの目標・体の状態・好み・約束事など今後の会話に必要な情報を"
+                f"{conversation_store.SUMMARY_MAX_CHARS}文字以内で要約してください。"
+            ),
+            [{"role": "user", "content": f"これまでの要約:\n{previous}\n\n新しい会話:\n{turns}"}],
+            deadline,
+            max_tokens=300
+        )
+        if completion.truncated or not completion.text:
+            # 途中までの要約で会話を要約済みにしない（次のメッセージで改めて要約する）
+            logger.warning(f"会話の要約を生成しきれなかったため更新しません: {line_id}")
+            return
+        summary_item = conversation_store.put_summary(
+            get_conversation_table(), line_id, completion.text, batch[-1]['timestamp']
+        )
+        conversation_cache.update_summary(line_id, summary_item)
+        logger.info(f"会話の要約を更新しました: {line_id}（{len(batch)}件、{completion.provider}）")
+    
+    except Exception as e:
+        logger.error(f"会話の要約の更新エラー: {str(e)}")
 
 def save_conversation(line_id, user_message, assistant_message):
     """
@@ -113,106 +309,397 @@ def save_conversation(line_id, user_message, assistant_message):
     """
     try:
         timestamp = datetime.now().isoformat()
-        conversation_table.put_item(
-            Item={
-                'lineId': line_id,
-                'timestamp': timestamp,
-                'user_message': user_message,
-                'assistant_message': assistant_message
-            }
-        )
+        item = {
+            'lineId': line_id,
+            'timestamp': timestamp,
+            'user_message': user_message,
+            'assistant_message': assistant_message
+        }
+        # 保持期間を過ぎた会話はDynamoDBのTTLで削除される（それまでにアーカイブに移す）
+        expires_at = conversation_store.expires_at()
+        if expires_at:
+            item['expiresAt'] = expires_at
+        get_conversation_table().put_item(Item=item)
+        # 次のメッセージで履歴を読み直さなくて済むようにキャッシュにも書き込む
+        conversation_cache.append(line_id, item)
         logger.info(f"会話を保存しました: {line_id}")
     
     except Exception as e:
         logger.error(f"会話の保存エラー: {str(e)}")
+        return
+
+    try:
+        # アーカイブの実行時にテーブルをスキャンせずに済むよう、会話のあった日を索引に書く
+        conversation_days.record(line_id, timestamp)
+    except Exception as e:
+        logger.error(f"会話の日の索引の保存エラー: {str(e)}")
+
+def loading_request(user_id):
+    """ローディングインジケーター開始APIのヘッダーとペイロード"""
+    headers = {
+        'Content-Type': 'application/json; charset=UTF-8',
+        'Authorization': f'Bearer {CHANNEL_ACCESS_TOKEN}'
+    }
+    payload = {
+        'chatId': user_id,
+        'loadingSeconds': 20
+    }
+    return headers, payload
 
 def start_loading(user_id):
     """LINEのローディングインジケーターを開始"""
     try:
-        url = 'https://api.line.me/v2/bot/chat/loading/start'
-        headers = {
-            'Content-Type': 'application/json; charset=UTF-8',
-            'Authorization': f'Bearer {CHANNEL_ACCESS_TOKEN}'
-        }
-        payload = {
-            'chatId': user_id,
-            'loadingSeconds': 20
-        }
+        headers, payload = loading_request(user_id)
         
-        response = requests.post(url, headers=headers, json=payload)
+        # 共有のSessionを使い、メッセージごとのTLSハンドシェイクを省く
+        response = clients.http_session().post(
+            LOADING_URL, headers=headers, json=payload, timeout=clients.http_timeout()
+        )
         response.raise_for_status()
         logger.info("ローディング開始")
         
     except Exception as e:
         logger.error(f"ローディング開始エラー: {str(e)}")
 
-@webhook_handler.add(MessageEvent, message=TextMessage)
-def handle_message(event):
+async def start_loading_async(session, user_id):
+    """LINEのローディングインジケーターを非同期で開始"""
+    try:
+        headers, payload = loading_request(user_id)
+        
+        async with session.post(LOADING_URL, headers=headers, json=payload) as response:
+            response.raise_for_status()
+        logger.info("ローディング開始")
+        
+    except Exception as e:
+        logger.error(f"ローディング開始エラー: {str(e)}")
+
+def cached_display_name(user_id):
+    """キャッシュした表示名（DISPLAY_NAME_CACHE_SECONDSを過ぎていれば、またはなければNone）"""
+    with _display_names_lock:
+        entry = _display_names.get(user_id)
+        if entry is None or time.monotonic() - entry[1] > DISPLAY_NAME_CACHE_SECONDS:
+            return None
+        _display_names.move_to_end(user_id)
+        return entry[0]
+
+def remember_display_name(user_id, display_name):
+    with _display_names_lock:
+        _display_names[user_id] = (display_name, time.monotonic())
+        _display_names.move_to_end(user_id)
+        while len(_display_names) > DISPLAY_NAME_CACHE_MAX_USERS:
+            _display_names.popitem(last=False)
+
+def get_display_name(user_id):
+    """LINEのプロフィールから表示名を取得（キャッシュを優先する。取得できなければNone）"""
+    display_name = cached_display_name(user_id)
+    if display_name is not None:
+        return display_name
+    try:
+        display_name = line_bot_api.get_profile(user_id).display_name
+    except Exception as e:
+        logger.error(f"プロフィール取得エラー: {str(e)}")
+        return None
+    remember_display_name(user_id, display_name)
+    return display_name
+
+async def get_display_name_async(async_line_bot_api, user_id):
+    """LINEのプロフィールから表示名を取得（キャッシュを優先する。取得できなければNone）"""
+    display_name = cached_display_name(user_id)
+    if display_name is not None:
+        return display_name
+    try:
+        profile = await async_line_bot_api.get_profile(user_id)
+    except Exception as e:
+        logger.error(f"プロフィール取得エラー: {str(e)}")
+        return None
+    remember_display_name(user_id, profile.display_name)
+    return profile.display_name
+
+def can_reply(event):
+    """リプライトークンの猶予内かどうか"""
+    elapsed = time.time() - event.timestamp / 1000
+    return bool(event.reply_token) and elapsed < REPLY_TOKEN_TTL_SECONDS
+
+def send_reply(event, text):
+    """
+    イベントに応答を送信
+    リプライトークンの猶予内ならreply、過ぎていれば（ワーカーでの遅延処理など）pushで送る
+    """
+    message = TextSendMessage(text=text)
+    if can_reply(event):
+        try:
+            line_bot_api.reply_message(event.reply_token, message)
+            return
+        except LineBotApiError as e:
+            logger.warning(f"リプライに失敗したためプッシュで送信します: {e.message}")
+    line_bot_api.push_message(event.source.user_id, message)
+
+async def send_reply_async(async_line_bot_api, event, text):
+    """send_replyの非同期版"""
+    message = TextSendMessage(text=text)
+    if can_reply(event):
+        try:
+            await async_line_bot_api.reply_message(event.reply_token, message)
+            return
+        except LineBotApiError as e:
+            logger.warning(f"リプライに失敗したためプッシュで送信します: {e.message}")
+    await async_line_bot_api.push_message(event.source.user_id, message)
+
+def handle_event(event, deadline=None):
+    """Webhookイベントを種類に応じたハンドラーに振り分ける"""
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        handle_message(event, deadline.for_event() if deadline else None)
+
+def has_entitlement(user_id):
+    """有料プランの利用権があるか（REQUIRE_SUBSCRIPTIONが無効なら常にTrue）"""
+    if not REQUIRE_SUBSCRIPTION:
+        return True
+    try:
+        return entitlements.check(user_id)
+    except Exception as e:
+        # 判定できないときは利用を止めない
+        logger.error(f"利用権の確認でエラーが発生しました: {e}")
+        return True
+
+def claim_event(event):
+    """イベントを処理してよいか（EVENT_DEDUP_ENABLEDが無効なら常に処理する）"""
+    if not EVENT_DEDUP_ENABLED:
+        return True, None
+    return idempotency.claim_line_event(event)
+
+def within_rate_limit(user_id):
+    """モデルを呼び出してよいか（プランごとの上限。判定できないときは止めない）"""
+    try:
+        return rate_limit.allow_user(user_id, entitlements.plan_of(user_id))
+    except Exception as e:
+        logger.error(f"レート制限の確認でエラーが発生しました: {e}")
+        return True
+
+def handle_message(event, deadline=None):
+    deadline = deadline or Deadline.from_context(None)
+    # 同じイベントの再送ではモデルの呼び出しも会話の保存もしない
+    # 他の実行が処理中ならEventInProgressが送出され、Webhookはエラーを返して（ワーカーは失敗として）再送させる
+    with deadline.stage('dedup'):
+        processing, event_key = claim_event(event)
+    if not processing:
+        deadline.note('duplicate', True)
+        deadline.report('linePersonalTrainerAI')
+        return
+    try:
+        _handle_message(event, deadline)
+    except Exception:
+        idempotency.finish_line_event(event_key, succeeded=False)
+        raise
+    idempotency.finish_line_event(event_key)
+
+def _handle_message(event, deadline):
+    with deadline.stage('entitlement'):
+        entitled = has_entitlement(event.source.user_id)
+    if not entitled:
+        send_reply(event, SUBSCRIPTION_REQUIRED_MESSAGE)
+        deadline.note('entitled', False)
+        deadline.report('linePersonalTrainerAI')
+        return
+    with deadline.stage('rate_limit'):
+        allowed = within_rate_limit(event.source.user_id)
+    if not allowed:
+        send_reply(event, RATE_LIMITED_MESSAGE)
+        deadline.note('rateLimited', True)
+        deadline.report('linePersonalTrainerAI')
+        return
+    if MESSAGE_PIPELINE == 'async':
+        run_async(handle_message_async(event, deadline))
+    else:
+        handle_message_sync(event, deadline)
+    deadline.report('linePersonalTrainerAI')
+
+def handle_message_sync(event, deadline):
     try:
         user_message = event.message.text
         user_id = event.source.user_id
+
+        # 表示名（非同期パイプラインと同じプロンプトにする）は、ローディングの開始と会話履歴の取得と並行して取得する
+        display_name_future = _prefetch_executor.submit(get_display_name, user_id)
         
         # ローディングを開始
-        start_loading(user_id)
+        with deadline.stage('loading'):
+            start_loading(user_id)
         
         # 会話履歴を取得
-        conversation_history = get_conversation_history(user_id)
-        logger.info(f"Conversation history length: {len(conversation_history)}")
+        with deadline.stage('history'):
+            history = get_conversation_history(user_id)
+        logger.info(f"Conversation history length: {len(history.messages)}")
+
+        # 表示名の取得を待つ（キャッシュにあるか、会話履歴の取得中に終わっていれば待たない）
+        with deadline.stage('profile'):
+            user_name = display_name_future.result()
         
         # ChatGPTからの応答を取得
-        answer = get_chatgpt_response(user_message, conversation_history)
-        logger.info(f"ChatGPT response: {answer}")
+        with deadline.stage('model'):
+            answer = get_chatgpt_response(user_message, history.messages, deadline, user_name=user_name)
+        deadline.note('answerChars', len(answer))
+        metrics.log_payload('ChatGPT response', answer)
         
         # 会話を保存
-        save_conversation(user_id, user_message, answer)
+        with deadline.stage('save'):
+            save_conversation(user_id, user_message, answer)
         
         # 応答メッセージをLINEに送信
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=answer)
-        )
+        with deadline.stage('reply'):
+            send_reply(event, answer)
+        
+        # 予算から外れた会話を要約にまとめる
+        with deadline.stage('summary'):
+            refresh_summary(user_id, history, deadline)
     
     except Exception as e:
         logger.error(f"handle_message関数でエラーが発生しました: {e}")
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="エラーが発生しました。しばらく待ってから再度お試しください。")
-        )
+        send_reply(event, "エラーが発生しました。しばらく待ってから再度お試しください。")
+
+async def handle_message_async(event, deadline):
+    """
+    handle_messageの非同期版
+    互いに独立したI/O（ローディング表示・会話履歴・プロフィール）を並行して行い、
+    ChatGPTの呼び出しだけがそれらの結果を待つ
+    """
+    user_message = event.message.text
+    user_id = event.source.user_id
+
+    session, async_line_bot_api = await async_clients()
+    try:
+        # DynamoDBはboto3のクライアントをスレッドで実行する
+        with deadline.stage('prefetch'):
+            _, history, user_name = await asyncio.gather(
+                start_loading_async(session, user_id),
+                asyncio.to_thread(get_conversation_history, user_id),
+                get_display_name_async(async_line_bot_api, user_id)
+            )
+        logger.info(f"Conversation history length: {len(history.messages)}")
+
+        with deadline.stage('model'):
+            answer = await get_chatgpt_response_async(user_message, history.messages, user_name, deadline)
+        deadline.note('answerChars', len(answer))
+        metrics.log_payload('ChatGPT response', answer)
+
+        # 会話の保存と応答の送信も互いに独立しているので並行して行う
+        with deadline.stage('save_and_reply'):
+            await asyncio.gather(
+                asyncio.to_thread(save_conversation, user_id, user_message, answer),
+                send_reply_async(async_line_bot_api, event, answer)
+            )
+
+        with deadline.stage('summary'):
+            await asyncio.to_thread(refresh_summary, user_id, history, deadline)
+
+    except Exception as e:
+        logger.error(f"handle_message_async関数でエラーが発生しました: {e}")
+        await send_reply_async(async_line_bot_api, event, "エラーが発生しました。しばらく待ってから再度お試しください。")
+
+def enqueue_events(body, signature, deadline=None):
+    """
+    署名を検証し、Webhookのイベントをキューに積む
+    モデル呼び出しなどの重い処理はworker_handlerで行う
+    """
+    deadline = deadline or Deadline.from_context(None)
+    with deadline.stage('signature'):
+        valid = webhook_parser.signature_validator.validate(body, signature)
+    if not valid:
+        raise InvalidSignatureError('Invalid signature. signature=' + signature)
+
+    events = json.loads(body).get('events', [])
+    if events:
+        with deadline.stage('enqueue'):
+            message_queue.get_queue().send_batch(events)
+    logger.info(f"{len(events)}件のイベントをキューに追加しました")
+
+def process_queued_event(payload, deadline=None):
+    """キューから取り出したイベント（Webhookのevents要素）を処理"""
+    if payload.get('type') != 'message' or payload.get('message', {}).get('type') != 'text':
+        return
+    handle_message(MessageEvent.new_from_json_dict(payload), deadline.for_event() if deadline else None)
+
+def worker_handler(event, context):
+    """
+    キューに積まれたイベントを処理するワーカーのエントリーポイント
+    SQSトリガーの場合はRecordsを処理し、それ以外（定期実行やローカル実行）は設定されたキューから取り出して処理する
+    処理に失敗したメッセージと、他の実行が処理中のメッセージは、batchItemFailuresで返して再配信させる
+    """
+    deadline = Deadline.from_context(context)
+    if 'Records' in event:
+        queue = None
+        messages = message_queue.messages_from_sqs_event(event)
+    else:
+        queue = message_queue.get_queue()
+        messages = queue.receive(event.get('maxMessages', 10))
+
+    failures = []
+    # 失敗したメッセージのあるFIFOキューのメッセージグループ
+    failed_groups = set()
+
+    def fail(message):
+        failures.append({'itemIdentifier': message.message_id})
+        # キューから直接受信した場合は、SQSの再配信と同じように後でもう一度受信できるように戻す
+        if queue is not None:
+            queue.release(message)
+
+    def process(message):
+        # FIFOキューでは、同じグループの前のメッセージが失敗したら後のメッセージも処理せずに返し、順序を保つ
+        if message.group is not None and message.group in failed_groups:
+            fail(message)
+            return
+        try:
+            process_queued_event(message.body, deadline)
+            if queue is not None:
+                queue.delete(message)
+            return
+        except idempotency.EventInProgress as e:
+            logger.info(f"他の実行が処理中のため後で処理します: {e}")
+        except Exception as e:
+            logger.error(f"キューのイベント処理でエラーが発生しました: {e}")
+        fail(message)
+        if message.group is not None:
+            failed_groups.add(message.group)
+
+    # ユーザー（FIFOキューではメッセージグループ）ごとの順序を保ったまま並行して処理
+    event_dispatcher.dispatch_events(
+        messages,
+        process,
+        key=lambda message: message.group or message.body.get('source', {}).get('userId') or message.message_id
+    )
+
+    logger.info(f"{len(messages)}件のイベントを処理しました（失敗: {len(failures)}件）")
+    # SQSの部分的なバッチ失敗レスポンス
+    return {'batchItemFailures': failures}
 
 def lambda_handler(event, context):
+    deadline = Deadline.from_context(context)
     try:
         signature = event['headers'].get('x-line-signature')
         if not signature:
-            return {
-                'statusCode': 400,
-                'body': json.dumps('署名が見つかりません。')
-            }
+            return json_response(400, '署名が見つかりません。')
 
         body = event['body']
-        logger.info(f"Webhook body: {body}")
+        metrics.log_payload('Webhook body', body)
 
-        webhook_handler.handle(body, signature)
+        if WEBHOOK_MODE == 'deferred':
+            enqueue_events(body, signature, deadline)
+        else:
+            # 署名の検証（とイベントの組み立て）
+            with deadline.stage('signature'):
+                events = webhook_parser.parse(body, signature)
+            with deadline.stage('dispatch'):
+                event_dispatcher.dispatch_events(events, lambda e: handle_event(e, deadline))
         
-        return {
-            'statusCode': 200,
-            'body': json.dumps('Success')
-        }
+        return json_response(200, 'Success')
         
     except InvalidSignatureError:
         logger.error("署名が無効です。")
-        return {
-            'statusCode': 400,
-            'body': json.dumps('署名が無効です。')
-        }
+        return json_response(400, '署名が無効です。')
     except LineBotApiError as e:
         logger.error(f"LINE APIエラー: {e.message}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps('LINE APIエラーが発生しました。')
-        }
+        return json_response(500, 'LINE APIエラーが発生しました。')
     except Exception as e:
         logger.error(f"予期しないエラーが発生しました: {e}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps('サーバーエラーが発生しました。')
-        }
\ No newline at end of file
+        return json_response(500, 'サーバーエラーが発生しました。')
+    finally:
+        deadline.report('linePersonalTrainerAI.webhook')
\ No newline at end of file
@@ -0,0 +1,441 @@
+"""
+モデル呼び出しのプロバイダー（Bedrock Claude / OpenAI）の共通インターフェース
+プロバイダーごとの最初のチャンクまでの時間を記録し、
+失敗が続いたプロバイダーはサーキットブレーカーで一定時間使わずにすぐ次のプロバイダーへ切り替える
+ヘッジングを有効にすると、最初のプロバイダーがp95の時間内に応答し始めないときに次のプロバイダーにも同時に問い合わせ、
+先に応答し始めた方を使う
+"""
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque, namedtuple
+
+logger = logging.getLogger()
+
+# 使うプロバイダーの順序（カンマ区切り。先頭から順にフォールバックする）
+LLM_PROVIDERS = os.getenv('LLM_PROVIDERS')
+# ordered: LLM_PROVIDERSの順 / latency: 最初のチャンクまでの時間（p50）が短い順
+LLM_ROUTING = os.getenv('LLM_ROUTING', 'ordered')
+# 最初のプロバイダーが遅いときに次のプロバイダーにも同時に問い合わせるか
+LLM_HEDGING_ENABLED = os.getenv('LLM_HEDGING_ENABLED', 'false').lower() == 'true'
+# 記録する最初のチャンクまでの時間の件数（プロバイダーごと）
+LLM_LATENCY_WINDOW = int(os.getenv('LLM_LATENCY_WINDOW', '200'))
+# p95をヘッジングの待ち時間に使うのに必要な記録の件数（足りないときはLLM_HEDGE_DEFAULT_DELAY_MS）
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', '20'))
+LLM_HEDGE_DEFAULT_DELAY_MS = int(os.getenv('LLM_HEDGE_DEFAULT_DELAY_MS', '2000'))
+# ヘッジングの待ち時間の下限（p95が短すぎて常に2つ呼び出すことにならないように）
+LLM_HEDGE_MIN_DELAY_MS = int(os.getenv('LLM_HEDGE_MIN_DELAY_MS', '300'))
+# 続けて失敗したらサーキットを開く回数と、開いている秒数
+LLM_BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', '3'))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.getenv('LLM_BREAKER_COOLDOWN_SECONDS', '30'))
+
+BEDROCK_MODEL_ID = os.getenv('BEDROCK_MODEL_ID', 'anthropic.claude-3-haiku-20240307-v1:0')
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+
+# ルーターの結果（truncated: デッドラインや途中の失敗で打ち切ったか）
+Completion = namedtuple('Completion', ['text', 'provider', 'truncated', 'hedged'])
+
+
+class ProviderUnavailable(RuntimeError):
+    """どのプロバイダーからも応答を得られなかった"""
+
+
+class Provider:
+    """
+    プロバイダーの共通インターフェース
+    stream() は応答のテキストを少しずつ返すジェネレーター
+    messagesはuser/assistantのメッセージのリスト、systemはシステムプロンプト
+    """
+    name = 'provider'
+
+    def stream(self, system, messages, max_tokens=500, timeout=None):
+        raise NotImplementedError
+
+
+class BedrockClaudeProvider(Provider):
+    """Bedrock上のClaude（invoke_model_with_response_stream）"""
+
+    def __init__(self, model_id=BEDROCK_MODEL_ID, name='bedrock'):
+        self.model_id = model_id
+        self.name = name
+
+    @staticmethod
+    def to_anthropic(system, messages):
+        """
+        OpenAI形式のメッセージをAnthropicの形式にする
+        systemのメッセージ（会話の要約など）はシステムプロンプトに含め、同じroleが続くメッセージはまとめる
+        """
+        system_parts = [system] + [m['content'] for m in messages if m['role'] == 'system']
+        converted = []
+        for message in messages:
+            if message['role'] == 'system':
+                continue
+            if converted and converted[-1]['role'] == message['role']:
+                converted[-1]['content'] += '\n' + message['content']
+            else:
+                converted.append({'role': message['role'], 'content': message['content']})
+        return '\n\n'.join(system_parts), converted
+
+    def stream(self, system, messages, max_tokens=500, timeout=None):
+        import clients
+
+        system, messages = self.to_anthropic(system, messages)
+        body = json.dumps({
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": max_tokens,
+            "system": system,
+            "messages": messages
+        })
+        # チャンク間のタイムアウトはclients.BEDROCK_READ_TIMEOUTで設定している
+        response = clients.bedrock_client().invoke_model_with_response_stream(
+            modelId=self.model_id,
+            body=body.encode('utf-8')
+        )
+        for stream_event in response['body']:
+            chunk = json.loads(stream_event['chunk']['bytes'])
+            if chunk.get('type') == 'content_block_delta':
+                yield chunk['delta'].get('text', '')
+
+
+class OpenAIChatProvider(Provider):
+    """OpenAIのChat Completions（ストリーミング）"""
+
+    def __init__(self, model=OPENAI_MODEL, temperature=0.7, name='openai'):
+        self.model = model
+        self.temperature = temperature
+        self.name = name
+
+    def stream(self, system, messages, max_tokens=500, timeout=None):
+        # SDKの読み込みは重いので、実際に呼び出すときまで遅らせる
+        import openai
+        openai.api_key = openai.api_key or os.getenv('OPENAI_API_KEY')
+
+        response = openai.ChatCompletion.create(
+            model=self.model,
+            messages=[{"role": "system", "content": system}] + list(messages),
+            max_tokens=max_tokens,
+            temperature=self.temperature,
+            stream=True,
+            request_timeout=max(1, timeout or 30)
+        )
+        for chunk in response:
+            if chunk.choices:
+                yield chunk.choices[0].delta.get('content') or ''
+
+
+class FakeProvider(Provider):
+    """
+    オフラインで試すためのプロバイダー
+    最初のチャンクまでの時間・チャンク間の時間・失敗する割合と、
+    一部の呼び出しだけが遅くなる（tail_rateの割合でtail_msかかる）テールレイテンシを指定できる
+    """
+
+    def __init__(self, name, text='これはテスト用の応答です。', first_chunk_ms=100, chunk_ms=5, chunk_chars=4,
+                 error_rate=0.0, jitter=0.0, tail_rate=0.0, tail_ms=0, rng=None):
+        self.name = name
+        self.text = text
+        self.first_chunk_ms = first_chunk_ms
+        self.chunk_ms = chunk_ms
+        self.chunk_chars = chunk_chars
+        self.error_rate = error_rate
+        self.jitter = jitter
+        self.tail_rate = tail_rate
+        self.tail_ms = tail_ms
+        self.rng = rng or random.Random()
+        self.calls = 0
+
+    def stream(self, system, messages, max_tokens=500, timeout=None):
+        self.calls += 1
+        delay = self.first_chunk_ms * (1 + self.rng.uniform(-self.jitter, self.jitter))
+        if self.rng.random() < self.tail_rate:
+            delay = self.tail_ms
+        time.sleep(max(0, delay) / 1000)
+        if self.rng.random() < self.error_rate:
+            raise RuntimeError(f"{self.name}: 擬似的なエラー")
+        for start in range(0, len(self.text), self.chunk_chars):
+            yield self.text[start:start + self.chunk_chars]
+            time.sleep(self.chunk_ms / 1000)
+
+
+class LatencyTracker:
+    """プロバイダーごとの最初のチャンクまでの時間（秒）の直近の記録"""
+
+    def __init__(self, window=LLM_LATENCY_WINDOW):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self._samples.setdefault(name, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, name, q):
+        """q（0〜1）の分位点。記録がなければNone"""
+        with self._lock:
+            samples = sorted(self._samples.get(name, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def count(self, name):
+        with self._lock:
+            return len(self._samples.get(name, ()))
+
+    def hedge_delay(self, name):
+        """ヘッジングを始めるまでに待つ秒数（十分な記録があればp95）"""
+        if self.count(name) < LLM_HEDGE_MIN_SAMPLES:
+            return LLM_HEDGE_DEFAULT_DELAY_MS / 1000
+        return max(LLM_HEDGE_MIN_DELAY_MS / 1000, self.percentile(name, 0.95))
+
+    def stats(self):
+        return {
+            name: {
+                'samples': self.count(name),
+                'p50Ms': round(self.percentile(name, 0.5) * 1000),
+                'p95Ms': round(self.percentile(name, 0.95) * 1000)
+            }
+            for name in list(self._samples)
+        }
+
+
+class CircuitBreaker:
+    """
+    続けてfailure_threshold回失敗したら開き、cooldown秒の間は呼び出させない
+    期間が過ぎたら1回だけ試し（半開）、成功すれば閉じ、失敗すればまた開く
+    """
+
+    def __init__(self, failure_threshold=LLM_BREAKER_FAILURES, cooldown_seconds=LLM_BREAKER_COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.cooldown_seconds:
+            return 'open'
+        return 'half_open'
+
+    def allow(self):
+        """呼び出してよいか（半開のときは試行を1つだけ許す）"""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def abandon(self):
+        """結果を見ずに打ち切った呼び出し（ヘッジングで負けた方）は成功とも失敗とも数えない"""
+        with self._lock:
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+class _Attempt:
+    """スレッドで実行中の1つのプロバイダーへの呼び出し"""
+
+    def __init__(self, provider, events):
+        self.provider = provider
+        self.events = events
+        self.cancelled = threading.Event()
+        self.started = time.monotonic()
+        self.first_chunk_at = None
+
+    def run(self, system, messages, max_tokens, timeout):
+        stream = None
+        try:
+            stream = self.provider.stream(system, messages, max_tokens, timeout)
+            for text in stream:
+                if self.cancelled.is_set():
+                    return
+                self.events.put((self, 'chunk', text))
+            self.events.put((self, 'done', None))
+        except Exception as e:
+            self.events.put((self, 'error', e))
+        finally:
+            if stream is not None and hasattr(stream, 'close'):
+                stream.close()
+
+
+class ProviderRouter:
+    """
+    プロバイダーを順に（またはヘッジングで同時に）呼び出し、最初に応答し始めたものの出力を返す
+    デッドラインまでに生成し終わらない場合は、そこまでの出力を返す（truncated=True）
+    """
+
+    def __init__(self, providers, routing=LLM_ROUTING, hedging=LLM_HEDGING_ENABLED, tracker=None, breakers=None):
+        if not providers:
+            raise ValueError('プロバイダーが指定されていません')
+        self.providers = list(providers)
+        self.routing = routing
+        self.hedging = hedging
+        self.tracker = tracker or LatencyTracker()
+        self.breakers = breakers or {provider.name: CircuitBreaker() for provider in self.providers}
+
+    def candidates(self):
+        """サーキットが開いていないプロバイダーを、呼び出す順に並べたもの"""
+        providers = self.providers
+        if self.routing == 'latency':
+            # 記録が少ないプロバイダーは設定の順で後ろに回す
+            def p50(provider):
+                if self.tracker.count(provider.name) < LLM_HEDGE_MIN_SAMPLES:
+                    return float('inf')
+                return self.tracker.percentile(provider.name, 0.5)
+            providers = sorted(providers, key=p50)
+        return [provider for provider in providers if self.breakers[provider.name].state != 'open']
+
+    def _start(self, provider, events, system, messages, max_tokens, deadline):
+        attempt = _Attempt(provider, events)
+        threading.Thread(
+            target=attempt.run,
+            args=(system, messages, max_tokens, deadline.model_timeout()),
+            daemon=True
+        ).start()
+        return attempt
+
+    def generate(self, system, messages, deadline, max_tokens=500):
+        """
+        応答を生成してCompletionを返す
+        どのプロバイダーからも応答を得られなければProviderUnavailable
+        """
+        candidates = self.candidates()
+        if not candidates:
+            raise ProviderUnavailable('すべてのプロバイダーのサーキットが開いています')
+
+        events = queue.Queue()
+        running = []
+        errors = []
+        hedged = False
+        winner = None
+        parts = []
+
+        def start_next():
+            """次のプロバイダーの呼び出しを始め、ヘッジングを始める時刻を返す（始められなければNone）"""
+            while candidates:
+                provider = candidates.pop(0)
+                # 半開のプロバイダーは、他の実行が試している間は使わない
+                if self.breakers[provider.name].allow():
+                    running.append(self._start(provider, events, system, messages, max_tokens, deadline))
+                    return time.monotonic() + self.tracker.hedge_delay(provider.name)
+            return None
+
+        hedge_at = start_next()
+        if hedge_at is None:
+            raise ProviderUnavailable('すべてのプロバイダーのサーキットが開いています')
+        while True:
+            can_hedge = winner is None and self.hedging and candidates
+            wait = deadline.model_timeout()
+            if can_hedge:
+                wait = min(wait, max(0, hedge_at - time.monotonic()))
+            try:
+                attempt, kind, value = events.get(timeout=wait) if wait > 0 else events.get_nowait()
+            except queue.Empty:
+                if not deadline.model_time_left():
+                    break
+                if not can_hedge:
+                    continue
+                # 応答し始めるのが遅いので次のプロバイダーにも問い合わせる
+                logger.warning(f"{running[-1].provider.name}の応答が遅いため{candidates[0].name}にも問い合わせます")
+                hedge_at = start_next()
+                hedged = hedged or hedge_at is not None
+                continue
+
+            if winner is not None and attempt is not winner:
+                continue
+            name = attempt.provider.name
+            if kind == 'chunk':
+                if winner is None:
+                    winner = attempt
+                    attempt.first_chunk_at = time.monotonic()
+                    self.tracker.record(name, attempt.first_chunk_at - attempt.started)
+                    # 遅れた方の呼び出しは読み捨てる
+                    for other in running:
+                        if other is not attempt:
+                            other.cancelled.set()
+                            self.breakers[other.provider.name].abandon()
+                parts.append(value)
+                if not deadline.model_time_left():
+                    logger.warning("デッドラインに達したため応答を打ち切ります")
+                    break
+            elif kind == 'done':
+                if winner is None:
+                    # 空の応答で終わった
+                    self.tracker.record(name, time.monotonic() - attempt.started)
+                    for other in running:
+                        if other is not attempt:
+                            other.cancelled.set()
+                            self.breakers[other.provider.name].abandon()
+                self.breakers[name].record_success()
+                return Completion(''.join(parts), name, False, hedged)
+            else:
+                logger.error(f"{name}の呼び出しでエラーが発生しました: {value}")
+                self.breakers[name].record_failure()
+                errors.append(f"{name}: {value}")
+                if winner is not None:
+                    # 途中まで生成できた応答を返す
+                    return Completion(''.join(parts), name, True, hedged)
+                running.remove(attempt)
+                if not running:
+                    if not deadline.model_time_left():
+                        break
+                    hedge_at = start_next()
+                    if hedge_at is None:
+                        break
+
+        # デッドラインに達した
+        for attempt in running:
+            attempt.cancelled.set()
+        if winner is not None:
+            # 応答し始めてはいたので、プロバイダーは正常とみなす
+            self.breakers[winner.provider.name].record_success()
+            return Completion(''.join(parts), winner.provider.name, True, hedged)
+        for attempt in running:
+            # 応答し始めもしなかったプロバイダーは失敗として数える
+            self.breakers[attempt.provider.name].record_failure()
+            errors.append(f"{attempt.provider.name}: タイムアウト")
+        raise ProviderUnavailable('; '.join(errors) or 'デッドラインに達しました')
+
+    def stats(self):
+        return {
+            'latency': self.tracker.stats(),
+            'breakers': {name: breaker.state for name, breaker in self.breakers.items()}
+        }
+
+
+# LLM_PROVIDERSに書ける名前
+PROVIDER_FACTORIES = {
+    'bedrock': BedrockClaudeProvider,
+    'openai': OpenAIChatProvider
+}
+
+
+def router_from_env(default_providers):
+    """LLM_PROVIDERS（未設定ならdefault_providers）からルーターを作る"""
+    names = [name.strip() for name in (LLM_PROVIDERS or default_providers).split(',') if name.strip()]
+    unknown = [name for name in names if name not in PROVIDER_FACTORIES]
+    if unknown:
+        raise ValueError(f"不明なプロバイダーです: {unknown}")
+    return ProviderRouter([PROVIDER_FACTORIES[name]() for name in names])
@@ -0,0 +1,548 @@
+"""
+ハンドラーの負荷テスト（デプロイせずにスループットとテールレイテンシを測る）
+署名付きのLINEのWebhookイベント・Stripeのwebhookイベント・API Gatewayのプロフィールや体重記録のリクエスト・
+通知の定期実行・会話履歴のエクスポートの呼び出しを作り、
+実際のlambda_handlerを、ローカルの代替（motoのDynamoDBとS3、LINE/OpenAI/Bedrockの代わりのHTTPサーバー）に対して
+指定した並行数で呼び出す
+
+シナリオごとに新しいPythonプロセスで実行し、次の値を表示する
+- p50/p95/p99と平均の応答時間、スループット（リクエスト/秒）、エラー（ステータス400以上）の数
+- コールドスタート（ハンドラーモジュールの読み込み＋最初の1リクエスト）
+- プロセスの最大RSS
+乱数のシードとリクエストの内容を固定し、--repeatの中央値を使うので、実行ごとの結果を比べられる
+--outputで結果を保存し、次の実行で--baselineに渡すと差分を表示する
+
+必要なパッケージ: moto[dynamodb,s3]、各ハンドラーの依存パッケージ（line-bot-sdk、openai、stripe、boto3）
+コールドスタートはmotoが読み込んだboto3を含まないので、SDKの読み込み時間はstartup_profile.pyで確認する
+
+使い方: python loadtest.py --requests 500 --concurrency 8 --model-first-chunk-ms 300 [シナリオ ...]
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import importlib
+import json
+import os
+import random
+import resource
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHANNEL_SECRET = 'loadtest-channel-secret'
+STRIPE_WEBHOOK_SECRET = 'whsec_loadtest'
+AWS_REGION = 'ap-northeast-1'
+
+# シナリオ名 -> 呼び出すハンドラーモジュール
+SCENARIOS = {
+    'line-claude': 'lambda_function',
+    'line-chatgpt': 'linePersonalTrainerAI',
+    'stripe-webhook': 'subscriptionManagement',
+    'profile-get': 'userprofile',
+    'profile-post': 'userprofile',
+    'profile-info-get': 'getLineUserInfo',
+    'profile-edit': 'editLineUserInfo',
+    'profile-create': 'createLineUserProfile',
+    'weight-records': 'weightrecords',
+    'notification-dispatch': 'notificationDispatcher',
+    'conversation-export': 'conversationExport',
+}
+
+# (テーブル名, パーティションキー, ソートキー)
+TABLES = [
+    ('LineUserProfiles', 'lineId', None),
+    ('linebot-conversation-history', 'lineId', 'timestamp'),
+    ('LineConversationDays', 'shardKey', 'dayUser'),
+    ('ProcessedEvents', 'idempotencyKey', None),
+    ('LineNotificationSlots', 'slotKey', 'lineId'),
+    ('LineUserEntitlements', 'lineId', None),
+    ('LineNotificationLog', 'runId', 'batch'),
+    ('LineWeightRecords', 'lineId', 'month'),
+]
+
+# エクスポートの書き出し先（motoのS3）
+EXPORT_BUCKET = 'loadtest-exports'
+# エクスポートのシナリオで、ユーザーごとに用意しておく会話の件数
+EXPORT_TURNS_PER_USER = 50
+# 通知のシナリオで、全ユーザーに設定しておく通知時刻
+NOTIFICATION_TIME = '07:30'
+
+# 結果の表に出す項目と、ベースラインとの比較で「小さいほど良い」か
+REPORT_FIELDS = [
+    ('p50Ms', True), ('p95Ms', True), ('p99Ms', True), ('meanMs', True),
+    ('throughputRps', False), ('coldStartMs', True), ('peakRssMb', True),
+]
+
+
+class UpstreamStandIn(BaseHTTPRequestHandler):
+    """
+    LINE Messaging API・OpenAI・Bedrock Runtimeの代わり
+    モデルの応答は、最初のチャンクまでfirst_chunk_ms待ち、以降chunk_msごとにチャンクを送る
+    """
+    protocol_version = 'HTTP/1.1'
+    line_latency = 0.0
+    first_chunk = 0.0
+    chunk_interval = 0.0
+    chunks = 10
+    calls = {}
+    lock = threading.Lock()
+
+    def _count(self, name):
+        with UpstreamStandIn.lock:
+            UpstreamStandIn.calls[name] = UpstreamStandIn.calls.get(name, 0) + 1
+
+    def _json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, content_type, frames):
+        """チャンク形式（Transfer-Encoding: chunked）で少しずつ送る"""
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        time.sleep(self.first_chunk)
+        for i, frame in enumerate(frames):
+            if i:
+                time.sleep(self.chunk_interval)
+            self.wfile.write(f"{len(frame):x}\r\n".encode() + frame + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _answer_parts(self):
+        return [f"回答の一部{i}です。" for i in range(self.chunks)]
+
+    def do_GET(self):
+        if self.path.startswith('/v2/bot/profile/'):
+            self._count('line')
+            time.sleep(self.line_latency)
+            return self._json(200, {'userId': self.path.rsplit('/', 1)[-1], 'displayName': 'テスト'})
+        self._json(404, {})
+
+    def do_POST(self):
+        request = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.startswith('/v2/bot/'):
+            self._count('line')
+            time.sleep(self.line_latency)
+            return self._json(200, {})
+        if self.path == '/v1/chat/completions':
+            self._count('openai')
+            if not json.loads(request).get('stream'):
+                time.sleep(self.first_chunk)
+                return self._json(200, {
+                    'id': 'chatcmpl-loadtest', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-4o-mini',
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': '要約です。'},
+                                 'finish_reason': 'stop'}]
+                })
+            frames = [
+                b'data: ' + json.dumps({
+                    'id': 'chatcmpl-loadtest', 'object': 'chat.completion.chunk', 'created': 0,
+                    'model': 'gpt-4o-mini',
+                    'choices': [{'index': 0, 'delta': {'content': part}, 'finish_reason': None}]
+                }, ensure_ascii=False).encode() + b'\n\n'
+                for part in self._answer_parts()
+            ] + [b'data: [DONE]\n\n']
+            return self._stream('text/event-stream', frames)
+        if self.path.startswith('/model/') and self.path.endswith('/invoke-with-response-stream'):
+            self._count('bedrock')
+            chunks = [{'type': 'message_start'}] + [
+                {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': part}}
+                for part in self._answer_parts()
+            ] + [{'type': 'message_stop'}]
+            return self._stream('application/vnd.amazon.eventstream', [eventstream_frame(c) for c in chunks])
+        self._json(404, {})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def eventstream_frame(chunk):
+    """Bedrockのストリーミング応答（application/vnd.amazon.eventstream）の1メッセージ"""
+    payload = json.dumps({'bytes': base64.b64encode(json.dumps(chunk).encode()).decode()}).encode()
+    headers = b''
+    for name, value in ((':event-type', 'chunk'), (':content-type', 'application/json'), (':message-type', 'event')):
+        headers += bytes([len(name)]) + name.encode() + bytes([7]) + struct.pack('>H', len(value)) + value.encode()
+    prelude = struct.pack('>II', 12 + len(headers) + len(payload) + 4, len(headers))
+    message = prelude + struct.pack('>I', zlib.crc32(prelude)) + headers + payload
+    return message + struct.pack('>I', zlib.crc32(message))
+
+
+def start_upstream(args):
+    UpstreamStandIn.line_latency = args.line_latency_ms / 1000
+    UpstreamStandIn.first_chunk = args.model_first_chunk_ms / 1000
+    UpstreamStandIn.chunk_interval = args.model_chunk_ms / 1000
+    UpstreamStandIn.chunks = args.model_chunks
+    server = ThreadingHTTPServer(('127.0.0.1', 0), UpstreamStandIn)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def user_id(index):
+    return f"U{index:032x}"
+
+
+def line_request(i, rng, users):
+    """署名付きのLINEのWebhook（テキストメッセージ1件）"""
+    body = json.dumps({
+        'destination': 'Uloadtest',
+        'events': [{
+            'type': 'message',
+            'mode': 'active',
+            'timestamp': int(time.time() * 1000),
+            'source': {'type': 'user', 'userId': user_id(rng.randrange(users))},
+            'webhookEventId': f"01LOADTEST{i:016d}",
+            'deliveryContext': {'isRedelivery': False},
+            'replyToken': f"reply-{i}",
+            'message': {'id': str(i), 'type': 'text', 'quoteToken': f"q{i}", 'text': f"今日のトレーニングメニュー{i}は？"}
+        }]
+    }, ensure_ascii=False)
+    signature = base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+    return {'headers': {'x-line-signature': signature}, 'body': body}
+
+
+def stripe_request(i, rng, users):
+    """署名付きのStripeのwebhook（payment_intent.succeeded）"""
+    payload = json.dumps({
+        'id': f"evt_loadtest_{i:08d}",
+        'object': 'event',
+        'created': int(time.time()),
+        'type': 'payment_intent.succeeded',
+        'data': {'object': {
+            'id': f"pi_loadtest_{i:08d}", 'object': 'payment_intent', 'amount': 1980,
+            'metadata': {'lineId': user_id(rng.randrange(users))}
+        }}
+    })
+    timestamp = int(time.time())
+    signature = hmac.new(STRIPE_WEBHOOK_SECRET.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return {'path': '/webhook', 'headers': {'Stripe-Signature': f"t={timestamp},v1={signature}"}, 'body': payload}
+
+
+def profile_body(line_id):
+    return {
+        'lineId': line_id, 'birthDate': '1990-01-01', 'gender': 'female', 'height': 160, 'weight': 55,
+        'targetWeight': 50, 'targetPeriod': '3months', 'priority': 'diet', 'motivation': 'high'
+    }
+
+
+def profile_get_request(i, rng, users):
+    return {
+        'requestContext': {'http': {'method': 'GET'}},
+        'queryStringParameters': {'lineId': user_id(rng.randrange(users))},
+        'pathParameters': {},
+        'headers': {}
+    }
+
+
+def profile_post_request(i, rng, users):
+    return {
+        'requestContext': {'http': {'method': 'POST'}},
+        'body': json.dumps(profile_body(user_id(rng.randrange(users))))
+    }
+
+
+def profile_info_get_request(i, rng, users):
+    return {'pathParameters': {'lineId': user_id(rng.randrange(users))}, 'headers': {}}
+
+
+def profile_edit_request(i, rng, users):
+    return {
+        'pathParameters': {'lineId': user_id(rng.randrange(users))},
+        'body': json.dumps({'weight': 55 - i % 5, 'motivation': f'update-{i}'})
+    }
+
+
+def profile_create_request(i, rng, users):
+    return {
+        **profile_body(user_id(rng.randrange(users))),
+        'targetPeriod': '3months', 'priority': 'diet', 'pastExperience': 'none', 'exerciseFrequency': 'weekly',
+        'mealFrequency': '3', 'alcoholFrequency': 'none', 'allergies': 'none', 'restrictions': 'none',
+        'illness': 'none'
+    }
+
+
+def weight_records_request(i, rng, users):
+    """体重記録の書き込みと取得を半分ずつ"""
+    line_id = user_id(rng.randrange(users))
+    if rng.random() < 0.5:
+        day = f"2025-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}"
+        return {'httpMethod': 'POST', 'body': json.dumps({'lineId': line_id, 'date': day, 'weight': 50 + rng.random() * 10})}
+    return {'httpMethod': 'GET', 'queryStringParameters': {'lineId': line_id, 'from': '2025-01-01', 'to': '2025-12-31'}}
+
+
+def notification_request(i, rng, users):
+    """1スロット分の送信（リクエストごとに別の実行IDにして、毎回全員に送る）"""
+    return {'slot': NOTIFICATION_TIME, 'date': f"loadtest-{i}"}
+
+
+def conversation_export_request(i, rng, users):
+    return {'lineId': user_id(rng.randrange(users)), 'format': 'ndjson' if i % 2 else 'csv'}
+
+
+REQUEST_BUILDERS = {
+    'line-claude': line_request,
+    'line-chatgpt': line_request,
+    'stripe-webhook': stripe_request,
+    'profile-get': profile_get_request,
+    'profile-post': profile_post_request,
+    'profile-info-get': profile_info_get_request,
+    'profile-edit': profile_edit_request,
+    'profile-create': profile_create_request,
+    'weight-records': weight_records_request,
+    'notification-dispatch': notification_request,
+    'conversation-export': conversation_export_request,
+}
+
+
+def create_tables(users):
+    import boto3
+    dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION)
+    for name, hash_key, range_key in TABLES:
+        keys = [(hash_key, 'HASH')] + ([(range_key, 'RANGE')] if range_key else [])
+        dynamodb.create_table(
+            TableName=name,
+            KeySchema=[{'AttributeName': key, 'KeyType': key_type} for key, key_type in keys],
+            AttributeDefinitions=[{'AttributeName': key, 'AttributeType': 'S'} for key, _ in keys],
+            BillingMode='PAY_PER_REQUEST'
+        )
+    with dynamodb.Table('LineUserProfiles').batch_writer() as batch:
+        for index in range(users):
+            batch.put_item(Item=profile_body(user_id(index)))
+
+
+def seed_scenario(scenario, users):
+    """シナリオが読むデータ（通知時刻の索引・エクスポートする会話・S3のバケット）を用意する"""
+    import boto3
+    dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION)
+    if scenario == 'notification-dispatch':
+        import notification_slots
+        table = dynamodb.Table(notification_slots.SLOT_TABLE_NAME)
+        for index in range(users):
+            notification_slots.update_slot(user_id(index), None, NOTIFICATION_TIME, table)
+    elif scenario == 'conversation-export':
+        boto3.client('s3', region_name=AWS_REGION).create_bucket(
+            Bucket=EXPORT_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION}
+        )
+        with dynamodb.Table('linebot-conversation-history').batch_writer() as batch:
+            for index in range(users):
+                for turn in range(EXPORT_TURNS_PER_USER):
+                    batch.put_item(Item={
+                        'lineId': user_id(index),
+                        'timestamp': f"2025-01-01T00:{turn // 60:02d}:{turn % 60:02d}",
+                        'user_message': f"質問{turn}",
+                        'assistant_message': f"回答{turn}"
+                    })
+
+
+def point_to_upstream(module, upstream):
+    """ハンドラーが使うLINE APIとBedrockの送信先を代替のサーバーに向ける"""
+    line_bot_api = getattr(module, 'line_bot_api', None)
+    if line_bot_api is not None:
+        line_bot_api.endpoint = upstream
+        line_bot_api.data_endpoint = upstream
+    if hasattr(module, 'LOADING_URL'):
+        module.LOADING_URL = f"{upstream}/v2/bot/chat/loading/start"
+    # 非同期パイプラインのAsyncLineBotApi（コンテナで共有するもの）も代替に向ける
+    if getattr(module, 'MESSAGE_PIPELINE', None) == 'async':
+        _, async_line_bot_api = module.run_async(module.async_clients())
+        async_line_bot_api.endpoint = upstream
+        async_line_bot_api.data_endpoint = upstream
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def run_worker(scenario, args, result_path):
+    """子プロセス: 代替を起動し、1つのシナリオを実行して結果をresult_pathに書く"""
+    upstream = start_upstream(args)
+    os.environ.update({
+        'CHANNEL_ACCESS_TOKEN': 'loadtest-token',
+        'CHANNEL_SECRET': CHANNEL_SECRET,
+        'OPENAI_API_KEY': 'sk-loadtest',
+        'OPENAI_API_BASE': f"{upstream}/v1",
+        'STRIPE_SECRET_KEY': 'sk_test_loadtest',
+        'STRIPE_WEBHOOK_SECRET': STRIPE_WEBHOOK_SECRET,
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'AWS_DEFAULT_REGION': AWS_REGION,
+        'BEDROCK_REGION': AWS_REGION,
+        'LINE_API_BASE': upstream,
+        'EXPORT_BUCKET': EXPORT_BUCKET,
+        'EXPORT_TOKEN_SECRET': 'loadtest-export-secret',
+    })
+
+    from moto import mock_aws
+    mock = mock_aws()
+    mock.start()
+    create_tables(args.users)
+    seed_scenario(scenario, args.users)
+
+    import boto3
+    import clients
+    # Bedrockは代替のサーバーに送る（motoはこのURLを扱わないので、そのまま送信される）
+    clients._clients['bedrock'] = boto3.client(
+        'bedrock-runtime', region_name=AWS_REGION, endpoint_url=upstream,
+        config=clients.aws_config(read_timeout=clients.BEDROCK_READ_TIMEOUT)
+    )
+
+    rng = random.Random(args.seed)
+    build = REQUEST_BUILDERS[scenario]
+    requests = [build(i, rng, args.users) for i in range(args.warmup + args.requests + 1)]
+
+    started = time.perf_counter()
+    module = importlib.import_module(SCENARIOS[scenario])
+    point_to_upstream(module, upstream)
+    module.lambda_handler(requests[0], None)
+    cold_start_ms = (time.perf_counter() - started) * 1000
+
+    def invoke(event):
+        call_started = time.perf_counter()
+        try:
+            response = module.lambda_handler(event, None)
+        except Exception as e:
+            # 例外で失敗を返すハンドラー（通知の定期実行など）はステータス500として数える
+            return (time.perf_counter() - call_started) * 1000, 500, repr(e)
+        return (time.perf_counter() - call_started) * 1000, response.get('statusCode', 200), response.get('body')
+
+    for event in requests[1:args.warmup + 1]:
+        invoke(event)
+    UpstreamStandIn.calls.clear()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(invoke, requests[args.warmup + 1:]))
+    elapsed = time.perf_counter() - started
+    mock.stop()
+
+    latencies = sorted(ms for ms, _, _ in results)
+    errors = [body for _, status, body in results if status >= 400]
+    result = {
+        'scenario': scenario,
+        'requests': len(results),
+        'errors': len(errors),
+        # エラーの原因を調べるための最初のエラーの応答
+        'firstError': errors[0] if errors else None,
+        'p50Ms': percentile(latencies, 0.5),
+        'p95Ms': percentile(latencies, 0.95),
+        'p99Ms': percentile(latencies, 0.99),
+        'meanMs': statistics.fmean(latencies),
+        'throughputRps': len(results) / elapsed,
+        'coldStartMs': cold_start_ms,
+        # Linuxのru_maxrssはKB
+        'peakRssMb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'upstreamCalls': dict(UpstreamStandIn.calls)
+    }
+    with open(result_path, 'w') as f:
+        json.dump(result, f)
+
+
+def run_scenario(scenario, args):
+    """シナリオを新しいプロセスで--repeat回実行し、各値の中央値を返す"""
+    runs = []
+    for _ in range(args.repeat):
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            result_path = f.name
+        command = [sys.executable, os.path.abspath(__file__), '--worker', scenario, '--result', result_path] + [
+            f"--{name.replace('_', '-')}={value}" for name, value in vars(args).items()
+            if name in WORKER_OPTIONS
+        ]
+        completed = subprocess.run(
+            command, cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+        )
+        if completed.returncode != 0:
+            error = completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'unknown error'
+            os.unlink(result_path)
+            return {'scenario': scenario, 'error': error}
+        with open(result_path) as f:
+            runs.append(json.load(f))
+        os.unlink(result_path)
+
+    summary = dict(runs[-1])
+    for name, _ in REPORT_FIELDS + [('errors', True)]:
+        summary[name] = statistics.median(run[name] for run in runs)
+    summary['runs'] = len(runs)
+    return summary
+
+
+def print_results(results, baseline=None):
+    baseline = {r['scenario']: r for r in (baseline or []) if 'error' not in r}
+    print(f"{'シナリオ':<24}" + ''.join(f"{name:>15}" for name, _ in REPORT_FIELDS) + f"{'errors':>8}")
+    for r in results:
+        if 'error' in r:
+            print(f"{r['scenario']:<24}  実行に失敗しました: {r['error']}")
+            continue
+        print(f"{r['scenario']:<24}" + ''.join(f"{r[name]:>15.1f}" for name, _ in REPORT_FIELDS) + f"{r['errors']:>8.0f}")
+        if r.get('firstError'):
+            print(f"{'  first error':<24}  {r['firstError']}")
+        base = baseline.get(r['scenario'])
+        if base:
+            deltas = []
+            for name, lower_is_better in REPORT_FIELDS:
+                change = (r[name] - base[name]) / base[name] * 100 if base[name] else 0.0
+                worse = change > 0 if lower_is_better else change < 0
+                deltas.append(f"{change:>+13.1f}%{'!' if worse and abs(change) >= 10 else ' '}")
+            print(f"{'  vs baseline':<24}" + ''.join(deltas))
+
+
+# 子プロセスにそのまま渡すオプション
+WORKER_OPTIONS = (
+    'requests', 'warmup', 'concurrency', 'users', 'seed',
+    'line_latency_ms', 'model_first_chunk_ms', 'model_chunk_ms', 'model_chunks'
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS), help=f"{', '.join(SCENARIOS)}")
+    parser.add_argument('--requests', type=int, default=300, help='計測するリクエスト数')
+    parser.add_argument('--warmup', type=int, default=20, help='計測前に送るリクエスト数')
+    parser.add_argument('--concurrency', type=int, default=8, help='同時に呼び出す数')
+    parser.add_argument('--users', type=int, default=200, help='リクエストに使うユーザー数')
+    parser.add_argument('--seed', type=int, default=1, help='乱数のシード')
+    parser.add_argument('--line-latency-ms', type=float, default=30, help='LINE APIの代替の応答時間')
+    parser.add_argument('--model-first-chunk-ms', type=float, default=300, help='モデルの最初のチャンクまでの時間')
+    parser.add_argument('--model-chunk-ms', type=float, default=20, help='モデルのチャンク間の時間')
+    parser.add_argument('--model-chunks', type=int, default=10, help='モデルの応答のチャンク数')
+    parser.add_argument('--repeat', type=int, default=1, help='各シナリオの実行回数（中央値を表示）')
+    parser.add_argument('--output', help='結果を保存するJSONファイル')
+    parser.add_argument('--baseline', help='比較する以前の結果（--outputで保存したもの）')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args, args.result)
+        return
+
+    unknown = [scenario for scenario in args.scenarios if scenario not in SCENARIOS]
+    if unknown:
+        parser.error(f"不明なシナリオです: {unknown}")
+
+    results = [run_scenario(scenario, args) for scenario in args.scenarios]
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'options': {name: getattr(args, name) for name in WORKER_OPTIONS}, 'results': results},
+                      f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
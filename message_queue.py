@@ -0,0 +1,237 @@
+"""
+Webhookイベントを後段のワーカーで処理するためのキュー
+本番ではSQS、テストやローカル実行ではプロセス内またはローカルファイルのキューを使う
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque, namedtuple
+
+logger = logging.getLogger()
+
+# キューから取り出したメッセージ
+# receiptは削除時に使う。groupはFIFOキューのMessageGroupId、attemptsはこのメッセージを受信した回数
+QueueMessage = namedtuple('QueueMessage', ['message_id', 'body', 'receipt', 'group', 'attempts'], defaults=[None, 1])
+
+# ローカルのキューで、この回数受信しても処理できなかったメッセージはデッドレターに移す（SQSのmaxReceiveCountに相当）
+QUEUE_MAX_RECEIVES = int(os.getenv('QUEUE_MAX_RECEIVES', '5'))
+
+# ローカルファイルのキューで、受信したまま削除も返却もされないメッセージを再び受信できるようにするまでの秒数
+# （SQSの可視性タイムアウトに相当。処理中にプロセスが落ちた場合に使う）
+LOCAL_QUEUE_VISIBILITY_SECONDS = int(os.getenv('LOCAL_QUEUE_VISIBILITY_SECONDS', '300'))
+
+
+class SQSQueue:
+    """SQSを使ったキュー"""
+
+    # SendMessageBatch / ReceiveMessage の1回あたりの上限
+    BATCH_SIZE = 10
+
+    def __init__(self, queue_url, sqs_client=None):
+        if sqs_client is None:
+            import clients
+            sqs_client = clients.aws_client('sqs')
+        self.queue_url = queue_url
+        self.sqs = sqs_client
+        # FIFOキューの場合はユーザー単位で順序を保証する
+        self.fifo = queue_url.endswith('.fifo')
+
+    def _entry(self, index, body):
+        entry = {
+            'Id': str(index),
+            'MessageBody': json.dumps(body, ensure_ascii=False)
+        }
+        if self.fifo:
+            entry['MessageGroupId'] = body.get('source', {}).get('userId') or 'default'
+            entry['MessageDeduplicationId'] = body.get('webhookEventId') or uuid.uuid4().hex
+        return entry
+
+    def send_batch(self, bodies):
+        for start in range(0, len(bodies), self.BATCH_SIZE):
+            chunk = bodies[start:start + self.BATCH_SIZE]
+            response = self.sqs.send_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[self._entry(i, body) for i, body in enumerate(chunk)]
+            )
+            if response.get('Failed'):
+                raise RuntimeError(f"SQSへの送信に失敗しました: {response['Failed']}")
+
+    def receive(self, max_messages=10):
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, self.BATCH_SIZE),
+            WaitTimeSeconds=0,
+            AttributeNames=['MessageGroupId', 'ApproximateReceiveCount']
+        )
+        return [
+            QueueMessage(m['MessageId'], json.loads(m['Body']), m['ReceiptHandle'],
+                         m.get('Attributes', {}).get('MessageGroupId'),
+                         int(m.get('Attributes', {}).get('ApproximateReceiveCount', 1)))
+            for m in response.get('Messages', [])
+        ]
+
+    def delete(self, message):
+        self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message.receipt)
+
+    def release(self, message):
+        # 削除しなければ可視性タイムアウトの後に再配信される（回数の上限はキューのリドライブポリシーに任せる）
+        pass
+
+
+class InMemoryQueue:
+    """プロセス内キュー（テスト用）"""
+
+    def __init__(self):
+        self._messages = deque()
+        self._lock = threading.Lock()
+        # QUEUE_MAX_RECEIVES回受信しても処理できなかったメッセージ
+        self.dead_letters = []
+
+    def send_batch(self, bodies):
+        with self._lock:
+            for body in bodies:
+                message_id = uuid.uuid4().hex
+                self._messages.append(QueueMessage(message_id, body, message_id))
+
+    def receive(self, max_messages=10):
+        with self._lock:
+            count = min(max_messages, len(self._messages))
+            return [self._messages.popleft() for _ in range(count)]
+
+    def delete(self, message):
+        # receiveした時点でキューから外れているので何もしない
+        pass
+
+    def release(self, message):
+        """処理できなかったメッセージをキューに戻す（上限の回数に達したらデッドレターに移す）"""
+        with self._lock:
+            if message.attempts >= QUEUE_MAX_RECEIVES:
+                logger.error(f"{message.attempts}回処理できなかったためデッドレターに移します: {message.message_id}")
+                self.dead_letters.append(message)
+                return
+            self._messages.append(message._replace(attempts=message.attempts + 1))
+
+    def __len__(self):
+        return len(self._messages)
+
+
+class LocalFileQueue:
+    """
+    ディレクトリを使ったキュー（ローカル実行用）
+    1メッセージ1ファイルで保存し、受信中のものは .processing に名前を変える
+    処理できなかったメッセージは受信した回数をファイル名に付けて .json に戻し、
+    上限の回数に達したものは .dead に名前を変えて残す
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def send_batch(self, bodies):
+        for body in bodies:
+            name = f"{time.time_ns():020d}-{uuid.uuid4().hex}"
+            tmp_path = os.path.join(self.directory, name + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(body, f, ensure_ascii=False)
+            os.rename(tmp_path, os.path.join(self.directory, name + '.json'))
+
+    @staticmethod
+    def _parse_name(name):
+        """ファイル名を、メッセージの名前と受信済みの回数に分ける（例: 「<名前>.2.json」は2回受信済み）"""
+        stem = name.rsplit('.', 1)[0]
+        base, _, received = stem.partition('.')
+        return base, int(received or 0)
+
+    def _reclaim_expired(self):
+        # 可視性タイムアウトを過ぎても削除されていないメッセージを、受信できる状態に戻す
+        expires_before = time.time() - LOCAL_QUEUE_VISIBILITY_SECONDS
+        for name in os.listdir(self.directory):
+            if not name.endswith('.processing'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < expires_before:
+                    os.rename(path, path[:-len('.processing')] + '.json')
+            except FileNotFoundError:
+                continue
+
+    def receive(self, max_messages=10):
+        self._reclaim_expired()
+        messages = []
+        for name in sorted(os.listdir(self.directory)):
+            if len(messages) >= max_messages:
+                break
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            processing_path = path[:-len('.json')] + '.processing'
+            try:
+                # 他のワーカーが先に取った場合はrenameに失敗する
+                os.rename(path, processing_path)
+            except FileNotFoundError:
+                continue
+            # 受信した時刻を記録し、可視性タイムアウトの起点にする
+            os.utime(processing_path)
+            base, received = self._parse_name(name)
+            with open(processing_path, encoding='utf-8') as f:
+                messages.append(QueueMessage(base, json.load(f), processing_path, None, received + 1))
+        return messages
+
+    def delete(self, message):
+        try:
+            os.remove(message.receipt)
+        except FileNotFoundError:
+            pass
+
+    def release(self, message):
+        """処理できなかったメッセージをキューに戻す（上限の回数に達したらデッドレターに移す）"""
+        path = os.path.join(self.directory, message.message_id)
+        if message.attempts >= QUEUE_MAX_RECEIVES:
+            logger.error(f"{message.attempts}回処理できなかったためデッドレターに移します: {message.message_id}")
+            target = path + '.dead'
+        else:
+            # 名前の先頭（送信時刻）は変えないので、戻したメッセージは後から送られたものより先に受信される
+            target = f"{path}.{message.attempts}.json"
+        try:
+            os.rename(message.receipt, target)
+        except FileNotFoundError:
+            pass
+
+
+_queue = None
+
+
+def get_queue():
+    """
+    環境変数に応じたキューを返す（ウォームスタート時は同じインスタンスを使い回す）
+    EVENT_QUEUE_URL があればSQS、EVENT_QUEUE_DIR があればローカルファイル、EVENT_QUEUE=memory ならプロセス内キュー
+    プロセス内キューのイベントは実行が終わると失われるので、明示的に選んだときだけ使い、
+    どれも設定されていなければエラーにする（Webhookは500を返し、LINEの再送を待つ）
+    """
+    global _queue
+    if _queue is None:
+        queue_url = os.getenv('EVENT_QUEUE_URL')
+        queue_dir = os.getenv('EVENT_QUEUE_DIR')
+        if queue_url:
+            _queue = SQSQueue(queue_url)
+        elif queue_dir:
+            _queue = LocalFileQueue(queue_dir)
+        elif os.getenv('EVENT_QUEUE') == 'memory':
+            logger.warning("プロセス内キューを使用します（実行が終わるとイベントは失われます）")
+            _queue = InMemoryQueue()
+        else:
+            raise RuntimeError('キューが設定されていません（EVENT_QUEUE_URL / EVENT_QUEUE_DIR / EVENT_QUEUE=memory）')
+    return _queue
+
+
+def messages_from_sqs_event(event):
+    """SQSトリガーのLambdaイベントからメッセージを取り出す"""
+    return [
+        QueueMessage(record['messageId'], json.loads(record['body']), record.get('receiptHandle'),
+                     record.get('attributes', {}).get('MessageGroupId'),
+                     int(record.get('attributes', {}).get('ApproximateReceiveCount', 1)))
+        for record in event.get('Records', [])
+    ]
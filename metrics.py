@@ -0,0 +1,77 @@
+"""
+処理段階ごとの所要時間のメトリクスと、ペイロード（Webhookの本文・モデルへの入力・応答）のログ
+メトリクスはCloudWatchのEmbedded Metric Format（EMF）の1行として標準出力に書き、ログからメトリクスを作らせる
+ペイロードは大きく、メッセージごとに出すとCPUとログの取り込みのコストがかかるので、
+DEBUGが有効なときか、PAYLOAD_LOG_SAMPLE_RATEの割合でサンプリングしたときだけ組み立てて出す
+"""
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+logger = logging.getLogger()
+
+# EMFでメトリクスを出すか（無効なら従来通りJSONのログだけを出す）
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'LinePersonalTrainer')
+# ペイロードをログに出す割合（0〜1。DEBUGが有効なときは常に出す）
+PAYLOAD_LOG_SAMPLE_RATE = float(os.getenv('PAYLOAD_LOG_SAMPLE_RATE', '0'))
+# ログに出すペイロードの最大文字数
+PAYLOAD_LOG_MAX_CHARS = int(os.getenv('PAYLOAD_LOG_MAX_CHARS', '2000'))
+
+
+def stage_totals(stages):
+    """(段階名, ミリ秒) のリストを段階ごとの合計にする（同じ段階が複数回あれば足す）"""
+    totals = {}
+    for name, ms in stages:
+        totals[name] = totals.get(name, 0.0) + ms
+    return totals
+
+
+def emf_document(service, values, properties=None, timestamp_ms=None):
+    """
+    EMFのドキュメント
+    valuesの各項目（ミリ秒）を「<名前>Ms」のメトリクスとし、Serviceをディメンションにする
+    propertiesはメトリクスにはせず、ログの検索用に同じ行に含める
+    """
+    metrics = {f"{name}Ms": round(ms, 1) for name, ms in values.items()}
+    return {
+        '_aws': {
+            'Timestamp': timestamp_ms or int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Service']],
+                'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in metrics]
+            }]
+        },
+        'Service': service,
+        **(properties or {}),
+        **metrics
+    }
+
+
+def emit(service, values, properties=None):
+    """EMFの1行を標準出力に書く（Lambdaのログの形式に関係なくそのままCloudWatchに取り込まれる）"""
+    line = json.dumps(emf_document(service, values, properties), ensure_ascii=False, default=str)
+    sys.stdout.write(line + '\n')
+
+
+def log_payload(label, payload):
+    """
+    ペイロードをログに出す（出さないときは組み立ても文字列化もしない）
+    payloadに関数を渡すと、出すときだけ呼び出して値を作る
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        level = logging.DEBUG
+    elif PAYLOAD_LOG_SAMPLE_RATE > 0 and random.random() < PAYLOAD_LOG_SAMPLE_RATE:
+        level = logging.INFO
+    else:
+        return
+    if callable(payload):
+        payload = payload()
+    text = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False, default=str)
+    if len(text) > PAYLOAD_LOG_MAX_CHARS:
+        text = f"{text[:PAYLOAD_LOG_MAX_CHARS]}…（全{len(text)}文字）"
+    logger.log(level, '%s: %s', label, text)
@@ -0,0 +1,253 @@
+"""
+通知時刻（notificationTime）に合わせてLINEの通知を送る定期実行のハンドラー
+EventBridgeのスケジュール（NOTIFICATION_SLOT_MINUTES 分ごと）で起動し、現在のスロットのユーザーに
+multicast（1回500人まで）で送信する。送信結果はバッチごとに宛先のlineIdの範囲（最初と最後）で記録し、
+再実行されても送信済みの範囲のユーザーには送らない（実行の間にスロットのユーザーが増減しても、送信済みの判定はずれない）
+"""
+import bisect
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import clients
+import notification_slots
+from deadline import Deadline
+from rate_limit import TokenBucket
+
+# ロガーの設定
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+CHANNEL_ACCESS_TOKEN = os.getenv('CHANNEL_ACCESS_TOKEN')
+# LINE APIのベースURL（ローカルのスタンドインに向けるときに変更する）
+LINE_API_BASE = os.getenv('LINE_API_BASE', 'https://api.line.me')
+# 送信結果を記録するテーブル
+NOTIFICATION_LOG_TABLE = os.getenv('NOTIFICATION_LOG_TABLE', 'LineNotificationLog')
+# 送信結果の保存期間（日）
+NOTIFICATION_LOG_TTL_DAYS = int(os.getenv('NOTIFICATION_LOG_TTL_DAYS', '30'))
+NOTIFICATION_MESSAGE = os.getenv(
+    'NOTIFICATION_MESSAGE',
+    'トレーニングの時間です！今日の体重と食事を記録して、目標に一歩近づきましょう💪'
+)
+
+# multicastの1回あたりの宛先の上限（LINE APIの制限）
+MULTICAST_LIMIT = 500
+# 同時に送信するmulticastの数
+NOTIFY_CONCURRENCY = int(os.getenv('NOTIFY_CONCURRENCY', '8'))
+# 1秒あたりのmulticastの上限（LINE APIのレート制限より低くしておく）
+MULTICAST_RATE_PER_SECOND = float(os.getenv('MULTICAST_RATE_PER_SECOND', '100'))
+# 429・5xx・通信エラーの再試行回数
+MULTICAST_MAX_RETRIES = int(os.getenv('MULTICAST_MAX_RETRIES', '3'))
+# 新しいバッチの送信を始めない残り時間（ミリ秒）
+DISPATCH_RESERVE_MS = int(os.getenv('DISPATCH_RESERVE_MS', '5000'))
+
+# スロットの時刻の基準（日本時間）
+JST = timezone(timedelta(hours=9))
+
+
+def get_log_table():
+    return clients.dynamodb_table(NOTIFICATION_LOG_TABLE)
+
+
+def current_slot(event):
+    """
+    送信するスロットの (実行ID, スロット) を返す
+    event['slot'] があればそれを使い、なければEventBridgeの time（なければ現在時刻）から決める
+    実行IDは「日付Tスロット」で、同じスロットの再実行では同じ値になる
+    """
+    if event.get('time'):
+        now = datetime.fromisoformat(event['time'].replace('Z', '+00:00')).astimezone(JST)
+    else:
+        now = datetime.now(JST)
+    slot = event.get('slot') or notification_slots.slot_of(now.strftime('%H:%M'))
+    run_date = event.get('date') or now.date().isoformat()
+    return f"{run_date}T{slot}", slot
+
+
+def make_batches(line_ids, sent_ranges=()):
+    """
+    送信済みの範囲に含まれないユーザーを500人ずつに分ける
+    lineIdで並べ替えてから分けるので、再実行でも残りのユーザーが同じなら同じバッチになる
+    """
+    firsts = [first for first, _ in sent_ranges]
+    ordered = [line_id for line_id in sorted(set(line_ids)) if not _covered(line_id, sent_ranges, firsts)]
+    return [ordered[start:start + MULTICAST_LIMIT] for start in range(0, len(ordered), MULTICAST_LIMIT)]
+
+
+def _covered(line_id, sent_ranges, firsts):
+    """lineIdが送信済みの範囲（重ならないように並べたもの）に含まれるか"""
+    index = bisect.bisect_right(firsts, line_id) - 1
+    return index >= 0 and line_id <= sent_ranges[index][1]
+
+
+def retry_key(run_id, recipients):
+    """
+    X-Line-Retry-Key（同じキーの再送はLINE側で重複として扱われる）
+    実行IDと宛先から決まるので、Lambdaが再実行されても宛先が同じバッチは同じキーになる
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{run_id}#{','.join(recipients)}"))
+
+
+def send_multicast(recipients, key, bucket, messages, deadline):
+    """
+    multicastを送信し、(HTTPステータス, リクエストID, エラー) を返す
+    429・5xx・通信エラーは同じリトライキーで再試行する
+    レート制限の待ちと再試行の間隔は残り時間（DISPATCH_RESERVE_MSを除く）までにとどめ、
+    1回も送信しないうちに時間切れになったらNoneを返す
+    """
+    url = f"{LINE_API_BASE}/v2/bot/message/multicast"
+    headers = {
+        'Content-Type': 'application/json; charset=UTF-8',
+        'Authorization': f'Bearer {CHANNEL_ACCESS_TOKEN}',
+        'X-Line-Retry-Key': key
+    }
+    payload = json.dumps({'to': recipients, 'messages': messages}, ensure_ascii=False).encode('utf-8')
+    status, request_id, error = None, None, None
+    for attempt in range(MULTICAST_MAX_RETRIES + 1):
+        if not bucket.acquire(timeout=deadline.remaining_ms(DISPATCH_RESERVE_MS) / 1000):
+            break
+        try:
+            response = clients.http_session().post(url, headers=headers, data=payload, timeout=clients.http_timeout())
+        except Exception as e:
+            status, request_id, error = None, None, str(e)
+        else:
+            status = response.status_code
+            request_id = response.headers.get('x-line-request-id')
+            # 409は同じリトライキーのリクエストが受理済み（前回の実行で送信できている）
+            if status in (200, 409):
+                return status, request_id, None
+            error = response.text[:500]
+            if status != 429 and status < 500:
+                return status, request_id, error
+        if attempt < MULTICAST_MAX_RETRIES:
+            backoff = min(2 ** attempt * 0.5, 4)
+            if deadline.remaining_ms(DISPATCH_RESERVE_MS) / 1000 <= backoff:
+                break
+            time.sleep(backoff)
+    if status is None and error is None:
+        return None
+    return status, request_id, error
+
+
+def sent_ranges(run_id, table):
+    """前回までの実行で送信済みの宛先の範囲 (最初のlineId, 最後のlineId) を、重なりをまとめて並べたもの"""
+    from boto3.dynamodb.conditions import Key
+
+    ranges = []
+    kwargs = {
+        'KeyConditionExpression': Key('runId').eq(run_id),
+        'ProjectionExpression': '#batch, firstLineId, #status',
+        'ExpressionAttributeNames': {'#batch': 'batch', '#status': 'status'}
+    }
+    while True:
+        response = table.query(**kwargs)
+        ranges.extend((item['firstLineId'], item['batch']) for item in response['Items'] if item['status'] == 'sent')
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def record_result(table, run_id, recipients, status, request_id, error):
+    """
+    バッチの送信結果を記録する（ソートキーはバッチの最後のlineId）
+    送信済みの範囲のユーザーは次のバッチに入らないので、送信済みの記録が別のバッチの結果で上書きされることはない
+    """
+    item = {
+        'runId': run_id,
+        'batch': recipients[-1],
+        'firstLineId': recipients[0],
+        'status': 'sent' if error is None else 'failed',
+        'recipients': len(recipients),
+        'sentAt': datetime.now(JST).isoformat(),
+        'expiresAt': int(time.time()) + NOTIFICATION_LOG_TTL_DAYS * 86400
+    }
+    if status is not None:
+        item['httpStatus'] = status
+    if request_id:
+        item['requestId'] = request_id
+    if error is not None:
+        item['error'] = error
+        # 失敗したバッチは宛先を残しておき、原因を調べたり再送したりできるようにする
+        item['failedLineIds'] = recipients
+    table.put_item(Item=item)
+
+
+def dispatch_slot(run_id, slot, deadline, slot_table=None, log_table=None, messages=None,
+                  max_workers=None, rate_per_second=None):
+    """
+    スロットのユーザーに通知を送り、送信結果の集計を返す
+    残り時間が DISPATCH_RESERVE_MS を切ったら新しいバッチは送らず、次の実行に回す（deferred）
+    """
+    log_table = log_table or get_log_table()
+    messages = messages or [{'type': 'text', 'text': NOTIFICATION_MESSAGE}]
+    bucket = TokenBucket(rate_per_second or MULTICAST_RATE_PER_SECOND)
+
+    with deadline.stage('members'):
+        members = set(notification_slots.iter_slot_members(slot, slot_table))
+        batches = make_batches(members, sent_ranges(run_id, log_table) if members else ())
+
+    counts = {'sent': 0, 'failed': 0, 'deferred': 0}
+    recipients_sent = 0
+
+    def run_batch(recipients):
+        if deadline.remaining_ms(DISPATCH_RESERVE_MS) <= 0:
+            return 'deferred', 0
+        result = send_multicast(recipients, retry_key(run_id, recipients), bucket, messages, deadline)
+        if result is None:
+            return 'deferred', 0
+        status, request_id, error = result
+        record_result(log_table, run_id, recipients, status, request_id, error)
+        if error is not None:
+            logger.error(f"通知の送信に失敗しました（{run_id} {recipients[0]}〜{recipients[-1]}）: {status} {error}")
+            return 'failed', 0
+        return 'sent', len(recipients)
+
+    with deadline.stage('multicast'):
+        workers = max(1, min(max_workers or NOTIFY_CONCURRENCY, len(batches)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for outcome, delivered in executor.map(run_batch, batches):
+                counts[outcome] += 1
+                recipients_sent += delivered
+
+    summary = {
+        'runId': run_id,
+        'slot': slot,
+        'users': len(members),
+        # 前回までの実行で送信済みだったユーザー
+        'skipped': len(members) - sum(len(batch) for batch in batches),
+        'batches': len(batches),
+        'recipientsSent': recipients_sent,
+        **counts
+    }
+    for key, value in summary.items():
+        deadline.note(key, value)
+    return summary
+
+
+def lambda_handler(event, context):
+    deadline = Deadline.from_context(context)
+    run_id, slot = current_slot(event or {})
+    if not slot:
+        logger.error(f"スロットを決められませんでした: {event}")
+        return {'statusCode': 400, 'body': 'invalid slot'}
+
+    logger.info(f"通知の送信を開始します: {run_id}")
+    summary = dispatch_slot(run_id, slot, deadline)
+    deadline.report('notificationDispatcher')
+
+    # 送れなかったバッチがあれば失敗として返し、EventBridgeの再試行で送り直す
+    if summary['failed'] or summary['deferred']:
+        raise RuntimeError(f"送信できなかったバッチがあります: {summary}")
+    return summary
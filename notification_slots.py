@@ -0,0 +1,143 @@
+"""
+通知時刻（notificationTime）ごとのユーザーの索引
+プロフィールの作成・更新・削除のときに「時間帯（スロット）→ lineId」のアイテムを書き換えておき、
+通知の送信時はテーブルをスキャンせずに、そのスロットのアイテムだけをクエリする
+1つのスロットに数万人が集まっても読み込みが1パーティションに偏らないよう、スロットはシャードに分ける
+索引を入れる前から通知時刻を登録していたユーザーは、backfillで既存のプロフィールから索引に加える
+
+使い方（既存のプロフィールの取り込み）: python notification_slots.py [--dry-run]
+"""
+import argparse
+import logging
+import os
+import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import clients
+
+logger = logging.getLogger()
+
+SLOT_TABLE_NAME = os.getenv('NOTIFICATION_SLOT_TABLE', 'LineNotificationSlots')
+# 通知時刻を持つプロフィールのテーブル（backfillで読む）
+PROFILE_TABLE_NAME = 'LineUserProfiles'
+# スロットの長さ（分）。通知はこの単位でまとめて送る（ディスパッチャーの実行間隔と合わせる）
+SLOT_MINUTES = int(os.getenv('NOTIFICATION_SLOT_MINUTES', '15'))
+# 1スロットあたりのシャード数
+SLOT_SHARDS = int(os.getenv('NOTIFICATION_SLOT_SHARDS', '8'))
+
+_TIME_PATTERN = re.compile(r'^(\d{1,2}):(\d{2})')
+
+
+def get_table():
+    """DynamoDBのテーブル（最初に使うときに作成し、ウォームスタート時は使い回す）"""
+    return clients.dynamodb_table(SLOT_TABLE_NAME)
+
+
+def slot_of(notification_time):
+    """通知時刻（HH:MM）が属するスロット（HH:MM、解釈できなければNone）"""
+    match = _TIME_PATTERN.match(str(notification_time or '').strip())
+    if not match:
+        return None
+    hour, minute = int(match.group(1)), int(match.group(2))
+    if hour > 23 or minute > 59:
+        return None
+    minute -= minute % SLOT_MINUTES
+    return f"{hour:02d}:{minute:02d}"
+
+
+def shard_of(line_id):
+    return zlib.crc32(line_id.encode('utf-8')) % SLOT_SHARDS
+
+
+def slot_key(slot, shard):
+    return f"{slot}#{shard}"
+
+
+def update_slot(line_id, old_time, new_time, table=None):
+    """
+    ユーザーの通知時刻の変更を索引に反映する（new_timeがNoneなら索引から外す）
+    スロットが変わらなければ何もしない
+    """
+    old_slot, new_slot = slot_of(old_time), slot_of(new_time)
+    table = table or get_table()
+    if old_slot and old_slot != new_slot:
+        table.delete_item(Key={'slotKey': slot_key(old_slot, shard_of(line_id)), 'lineId': line_id})
+    if new_slot and (new_slot != old_slot or new_time != old_time):
+        table.put_item(Item={
+            'slotKey': slot_key(new_slot, shard_of(line_id)),
+            'lineId': line_id,
+            'notificationTime': new_time
+        })
+
+
+def _query_shard(table, key):
+    from boto3.dynamodb.conditions import Key
+
+    kwargs = {
+        'KeyConditionExpression': Key('slotKey').eq(key),
+        'ProjectionExpression': 'lineId'
+    }
+    line_ids = []
+    while True:
+        response = table.query(**kwargs)
+        line_ids.extend(item['lineId'] for item in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return line_ids
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def iter_slot_members(slot, table=None, max_workers=None):
+    """スロットのユーザーのlineIdを返すジェネレーター（シャードは並行して読み込み、読めたものから返す）"""
+    table = table or get_table()
+    keys = [slot_key(slot, shard) for shard in range(SLOT_SHARDS)]
+    with ThreadPoolExecutor(max_workers=max_workers or SLOT_SHARDS) as executor:
+        futures = [executor.submit(_query_shard, table, key) for key in keys]
+        for future in as_completed(futures):
+            yield from future.result()
+
+
+def backfill(profile_table=None, table=None, dry_run=False):
+    """
+    既存のプロフィールのnotificationTimeから索引のアイテムを書き込み、書き込んだ（dry_runなら書き込む）件数を返す
+    同じアイテムを書くだけなので、何度実行しても、プロフィールの更新と同時に実行しても結果は変わらない
+    """
+    from boto3.dynamodb.conditions import Attr
+
+    profile_table = profile_table or clients.dynamodb_table(PROFILE_TABLE_NAME)
+    table = table or get_table()
+    kwargs = {
+        'ProjectionExpression': 'lineId, notificationTime',
+        'FilterExpression': Attr('notificationTime').exists()
+    }
+    written = 0
+    with table.batch_writer(overwrite_by_pkeys=['slotKey', 'lineId']) as writer:
+        while True:
+            response = profile_table.scan(**kwargs)
+            for item in response['Items']:
+                slot = slot_of(item['notificationTime'])
+                if not slot:
+                    logger.warning(f"通知時刻を解釈できないため索引に入れません: {item['lineId']} {item['notificationTime']}")
+                    continue
+                if not dry_run:
+                    writer.put_item(Item={
+                        'slotKey': slot_key(slot, shard_of(item['lineId'])),
+                        'lineId': item['lineId'],
+                        'notificationTime': item['notificationTime']
+                    })
+                written += 1
+            if 'LastEvaluatedKey' not in response:
+                return written
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run', action='store_true', help='書き込まずに件数だけを数える')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(f"索引に入れたユーザー: {backfill(dry_run=args.dry_run)}人")
+
+
+if __name__ == '__main__':
+    main()
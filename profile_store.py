@@ -0,0 +1,145 @@
+"""
+LineUserProfilesの読み込み
+複数ユーザー分はBatchGetItem（1回100キーまで）に分けて並行して読み込み、読み込めた分から順に返す
+通知やコーチングのジョブなど、他のハンドラーからも関数として呼び出せる
+1ユーザー分の読み込みはETagによる条件付きGETに対応する
+"""
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import clients
+from http_response import etag_matches, make_etag
+
+logger = logging.getLogger()
+
+# 使用するテーブル名
+TABLE_NAME = 'LineUserProfiles'
+
+# BatchGetItemの1回あたりのキー数の上限（DynamoDBの制限）
+BATCH_GET_LIMIT = 100
+# 同時に実行するBatchGetItemの数
+BATCH_GET_CONCURRENCY = int(os.getenv('BATCH_GET_CONCURRENCY', '4'))
+# UnprocessedKeysを再試行する回数と、待ち時間の基準（秒）
+BATCH_GET_MAX_RETRIES = int(os.getenv('BATCH_GET_MAX_RETRIES', '5'))
+BATCH_GET_BACKOFF_SECONDS = float(os.getenv('BATCH_GET_BACKOFF_SECONDS', '0.05'))
+# 1回のリクエストで指定できるlineIdの上限（HTTPから呼び出す場合）
+BATCH_GET_MAX_IDS = int(os.getenv('BATCH_GET_MAX_IDS', '1000'))
+# プロフィールのGETに付けるCache-Control（ブラウザに保存させつつ、使う前に毎回ETagで確認させる）
+PROFILE_CACHE_CONTROL = os.getenv('PROFILE_CACHE_CONTROL', 'private, no-cache')
+# プロフィールを書き込むたびに変える属性（組み立て済みのプロンプトのキャッシュが変更の検知に使う）
+VERSION_ATTRIBUTE = 'profileVersion'
+
+
+def get_table():
+    """DynamoDBのテーブル（最初に使うときに作成し、ウォームスタート時は使い回す）"""
+    return clients.dynamodb_table(TABLE_NAME)
+
+
+def new_version():
+    """
+    プロフィールのバージョン（ナノ秒単位の時刻）
+    updatedAtは秒単位なので、同じ秒の2回の更新を区別できない
+    """
+    return time.time_ns()
+
+
+def unique_ids(line_ids):
+    """重複と空の値を除く（BatchGetItemは同じキーが含まれているとエラーになる）"""
+    return list(dict.fromkeys(line_id for line_id in line_ids if line_id))
+
+
+def projection(fields):
+    """
+    指定した項目だけを読み込むためのGetItem/BatchGetItemの引数（lineIdは常に含める）
+    項目名は予約語と衝突しないようにExpressionAttributeNamesで渡す
+    """
+    if not fields:
+        return {}
+    names = {f'#p{i}': field for i, field in enumerate(unique_ids(['lineId', *fields]))}
+    return {
+        'ProjectionExpression': ', '.join(names),
+        'ExpressionAttributeNames': names
+    }
+
+
+def _get_chunk(dynamodb, keys, consistent_read=False, fields=None):
+    """
+    1チャンク（100キー以下）を読み込む
+    UnprocessedKeysはジッター付きの指数バックオフで再試行する
+    """
+    request = {'Keys': keys, 'ConsistentRead': consistent_read, **projection(fields)}
+    items = []
+    for attempt in range(BATCH_GET_MAX_RETRIES + 1):
+        response = dynamodb.batch_get_item(RequestItems={TABLE_NAME: request})
+        items.extend(response.get('Responses', {}).get(TABLE_NAME, []))
+        unprocessed = response.get('UnprocessedKeys', {}).get(TABLE_NAME)
+        if not unprocessed or not unprocessed.get('Keys'):
+            return items
+        if attempt == BATCH_GET_MAX_RETRIES:
+            break
+        # UnprocessedKeysには射影の指定も含まれて返ってくる
+        request = unprocessed
+        delay = BATCH_GET_BACKOFF_SECONDS * (2 ** attempt)
+        time.sleep(random.uniform(0, delay))
+
+    raise RuntimeError(f"{len(unprocessed['Keys'])}件のプロフィールを読み込めませんでした（再試行の上限）")
+
+
+def batch_get_profiles(line_ids, consistent_read=False, max_workers=None, dynamodb=None, fields=None):
+    """
+    複数ユーザーのプロフィールを読み込み、読み込めたチャンクから順にアイテムを返すジェネレーター
+    存在しないlineIdは返さない（順序はline_idsの順とは限らない）
+    fieldsを指定するとその項目とlineIdだけを読み込む
+    """
+    line_ids = unique_ids(line_ids)
+    if not line_ids:
+        return
+    dynamodb = dynamodb or clients.dynamodb_resource()
+    chunks = [
+        [{'lineId': line_id} for line_id in line_ids[start:start + BATCH_GET_LIMIT]]
+        for start in range(0, len(line_ids), BATCH_GET_LIMIT)
+    ]
+
+    started = time.perf_counter()
+    workers = max(1, min(max_workers or BATCH_GET_CONCURRENCY, len(chunks)))
+    if workers == 1:
+        for keys in chunks:
+            yield from _get_chunk(dynamodb, keys, consistent_read, fields)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_get_chunk, dynamodb, keys, consistent_read, fields) for keys in chunks]
+            for future in as_completed(futures):
+                yield from future.result()
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    logger.info(f"{len(line_ids)}件のプロフィールを{len(chunks)}回のBatchGetItemで{elapsed_ms:.0f}msで読み込みました")
+
+
+def get_profiles(line_ids, **kwargs):
+    """プロフィールをlineIdをキーにした辞書で返す"""
+    return {item['lineId']: item for item in batch_get_profiles(line_ids, **kwargs)}
+
+
+def profile_etag(item):
+    """
+    プロフィールのETag（内容全体のハッシュ）
+    updatedAtは秒単位で、更新しない経路もあるため、バージョンとしては使わない
+    """
+    return make_etag(item)
+
+
+def get_profile_if_modified(line_id, if_none_match=None, table=None, fields=None):
+    """
+    If-None-Matchを考慮してプロフィールを読み込む（fieldsを指定するとその項目だけを読み込む）
+    戻り値は (アイテム, ETag, 変更なしか)。アイテムが存在しなければ (None, None, False)
+    GetItemの消費容量はProjectionExpressionを付けてもアイテム全体の大きさで決まるため、
+    updatedAtだけを先に読むことはせず1回の読み込みで判定する（変更なしならボディは返さない）
+    """
+    item = (table or get_table()).get_item(Key={'lineId': line_id}, **projection(fields)).get('Item')
+    if item is None:
+        return None, None, False
+    etag = profile_etag(item)
+    return item, etag, etag_matches(if_none_match, etag)
@@ -0,0 +1,144 @@
+"""
+ユーザーのプロフィール（LineUserProfiles）からシステムプロンプトを組み立てる
+組み立てたプロンプトは lineId とプロフィールのバージョン（profileVersion）をキーにキャッシュし、
+使うたびにバージョンだけを読んで、変わっていなければプロフィール全体の読み込みも組み立ても行わない
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+
+from profile_store import VERSION_ATTRIBUTE
+
+logger = logging.getLogger()
+
+# キャッシュするユーザー数の上限
+PROMPT_CACHE_MAX_USERS = int(os.getenv('PROMPT_CACHE_MAX_USERS', '1024'))
+# キャッシュしたプロンプトのバージョンを確認し直すまでの秒数（既定の0なら毎回確認する）
+# 設定すると、その間はプロフィールを編集しても以前のプロンプトで応答する
+PROMPT_REVALIDATE_SECONDS = int(os.getenv('PROMPT_REVALIDATE_SECONDS', '0'))
+
+BASE_PROMPT = "あなたは世界一のフィットネスコーチです、私の質問と基本情報を元に痩せるまでの完璧な私専用のパーソナルアドバイスをしてください。"
+
+# プロンプトに含めるプロフィールの項目（属性名, 表示名, 単位）
+PROFILE_FIELDS = [
+    ('gender', '性別', ''),
+    ('age', '年齢', '歳'),
+    ('height', '身長', 'cm'),
+    ('weight', '体重', 'kg'),
+    ('targetWeight', '目標体重', 'kg'),
+    ('targetPeriod', '目標期間', ''),
+    ('mealFrequency', '食事回数', ''),
+    ('exerciseFrequency', '運動頻度', ''),
+    ('alcoholFrequency', '飲酒頻度', ''),
+    ('allergies', 'アレルギー', ''),
+    ('restrictions', '食事制限', ''),
+    ('illness', '持病・既往歴', ''),
+    ('priority', '優先したいこと', ''),
+    ('motivation', 'きっかけ', ''),
+    ('pastExperience', '過去のダイエット経験', ''),
+]
+
+
+def calculate_age(birth_date, today=None):
+    """生年月日（YYYY-MM-DD）から年齢を計算（解釈できなければNone）"""
+    try:
+        born = datetime.strptime(str(birth_date)[:10], '%Y-%m-%d').date()
+    except ValueError:
+        return None
+    today = today or date.today()
+    return today.year - born.year - ((today.month, today.day) < (born.month, born.day))
+
+
+def render_prompt(profile):
+    """プロフィールからシステムプロンプトを組み立てる"""
+    if not profile:
+        return BASE_PROMPT
+
+    values = dict(profile)
+    if profile.get('birthDate'):
+        values['age'] = calculate_age(profile['birthDate'])
+
+    parts = []
+    for attribute, label, unit in PROFILE_FIELDS:
+        value = values.get(attribute)
+        if value in (None, '', []):
+            continue
+        if isinstance(value, (list, set)):
+            value = '、'.join(str(v) for v in value)
+        parts.append(f"{label}: {value}{unit}")
+
+    if not parts:
+        return BASE_PROMPT
+    return BASE_PROMPT + "、".join(parts)
+
+
+def profile_version(profile):
+    """
+    プロフィールのバージョン（書き込みのたびに変わる値）
+    profileVersionがない以前のアイテムはupdatedAtで代用する
+    """
+    profile = profile or {}
+    return (profile.get(VERSION_ATTRIBUTE), profile.get('updatedAt'))
+
+
+class PromptCache:
+    """
+    lineIdごとに組み立て済みのプロンプトを保持するキャッシュ
+    get_tableはプロフィールのテーブルを返す関数（最初に読むときまでテーブルを作らない）
+    """
+
+    def __init__(self, get_table, max_users=PROMPT_CACHE_MAX_USERS, revalidate_seconds=PROMPT_REVALIDATE_SECONDS):
+        self.get_table = get_table
+        self.max_users = max_users
+        self.revalidate_seconds = revalidate_seconds
+        # lineId -> (バージョン, プロンプト, 確認した時刻)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'revalidated': 0, 'rendered': 0}
+
+    def get_prompt(self, line_id):
+        """ユーザーのシステムプロンプトを返す"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(line_id)
+            if entry is not None and now - entry[2] < self.revalidate_seconds:
+                self._entries.move_to_end(line_id)
+                self.counters['hits'] += 1
+                return entry[1]
+
+        if entry is not None:
+            # バージョンだけを読み、変わっていなければそのまま使う
+            current = profile_version(self.get_table().get_item(
+                Key={'lineId': line_id},
+                ProjectionExpression=f"{VERSION_ATTRIBUTE}, updatedAt"
+            ).get('Item'))
+            if current == entry[0]:
+                self._store(line_id, entry[0], entry[1], now)
+                with self._lock:
+                    self.counters['revalidated'] += 1
+                return entry[1]
+
+        profile = self.get_table().get_item(Key={'lineId': line_id}).get('Item')
+        prompt = render_prompt(profile)
+        self._store(line_id, profile_version(profile), prompt, now)
+        with self._lock:
+            self.counters['rendered'] += 1
+        return prompt
+
+    def invalidate(self, line_id):
+        with self._lock:
+            self._entries.pop(line_id, None)
+
+    def _store(self, line_id, version, prompt, checked_at):
+        with self._lock:
+            self._entries[line_id] = (version, prompt, checked_at)
+            self._entries.move_to_end(line_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {**self.counters, 'users': len(self._entries)}
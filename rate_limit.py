@@ -0,0 +1,197 @@
+"""
+トークンバケットによるレート制限
+外部API（LINEのmulticastなど）の呼び出し頻度を、設定した上限以下に抑える
+ユーザーごとのモデル呼び出しの制限（UserRateLimiter）は、コンテナ内のバケットで先に判定し、
+通ったものだけをDynamoDBの条件付き書き込みで全コンテナ共通のバケットと照合する
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import clients
+
+logger = logging.getLogger()
+
+# ユーザーごとの制限を使うかどうか
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+# 全コンテナ共通のバケットのテーブル（未設定ならコンテナ内のバケットだけで判定する）
+RATE_LIMIT_TABLE = os.getenv('RATE_LIMIT_TABLE')
+# プランごとのバケットの大きさ（capacity）と1時間あたりの補充数（refillPerHour）
+RATE_LIMIT_PLANS = json.loads(os.getenv('RATE_LIMIT_PLANS') or json.dumps({
+    'free': {'capacity': 10, 'refillPerHour': 30},
+    'paid': {'capacity': 30, 'refillPerHour': 240}
+}))
+# コンテナ内に保持するユーザーごとのバケットの数
+RATE_LIMIT_MAX_USERS = int(os.getenv('RATE_LIMIT_MAX_USERS', '4096'))
+
+# プランの設定（interval_ms: トークン1個が補充されるまでのミリ秒）
+Plan = namedtuple('Plan', ['name', 'capacity', 'interval_ms'])
+
+
+class TokenBucket:
+    """
+    1秒あたりrate個のトークンが補充され、最大capacity個まで貯まるバケット
+    複数のスレッドから同時に使える
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """トークンがあれば消費してTrue、なければ待たずにFalse"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1, timeout=None):
+        """
+        トークンが貯まるまで待って消費する
+        timeout秒以内に消費できなければFalse
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+def get_plan(name):
+    """プラン名からバケットの設定を作る（未知のプランはfreeとして扱う）"""
+    config = RATE_LIMIT_PLANS.get(name) or RATE_LIMIT_PLANS['free']
+    return Plan(name, int(config['capacity']), int(3600 * 1000 / float(config['refillPerHour'])))
+
+
+class DynamoDBBucket:
+    """
+    全コンテナ共通のトークンバケット
+    GCRA（トークンバケットと同じ判定になる）で、次のトークンが使えるようになる時刻（tat）だけを保存し、
+    読み込まずに条件付き更新だけで判定する
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def allow(self, key, plan, now_ms=None):
+        from botocore.exceptions import ClientError
+
+        now_ms = now_ms or int(time.time() * 1000)
+        # バケットに貯められる分だけ、tatが現在時刻より先に進むことを許す
+        tolerance_ms = (plan.capacity - 1) * plan.interval_ms
+        expires_at = (now_ms + tolerance_ms + plan.interval_ms) // 1000 + 60
+        attempts = [
+            # しばらく使っていない（バケットが満タン）: tatを現在時刻から進める
+            {
+                'UpdateExpression': 'SET tat = :next, expiresAt = :expiresAt',
+                'ConditionExpression': 'attribute_not_exists(tat) OR tat <= :now',
+                'ExpressionAttributeValues': {
+                    ':now': now_ms, ':next': now_ms + plan.interval_ms, ':expiresAt': expires_at
+                }
+            },
+            # 使っている途中: 許容範囲内ならtatを1トークン分進める（アトミックなADD）
+            {
+                'UpdateExpression': 'ADD tat :interval SET expiresAt = :expiresAt',
+                'ConditionExpression': 'tat <= :limit',
+                'ExpressionAttributeValues': {
+                    ':interval': plan.interval_ms, ':limit': now_ms + tolerance_ms, ':expiresAt': expires_at
+                }
+            },
+        ]
+        for kwargs in attempts:
+            try:
+                self.table.update_item(Key={'bucketKey': key}, **kwargs)
+                return True
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+        return False
+
+
+class UserRateLimiter:
+    """
+    ユーザーごとのモデル呼び出しの制限
+    コンテナ内のバケットが空なら全体のバケットも空なので、DynamoDBを使わずにすぐ拒否する
+    """
+
+    def __init__(self, shared=None, max_users=RATE_LIMIT_MAX_USERS):
+        self.shared = shared
+        self.max_users = max_users
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'allowed': 0, 'localDenied': 0, 'sharedDenied': 0}
+
+    def _local_bucket(self, user_id, plan):
+        with self._lock:
+            entry = self._buckets.get(user_id)
+            if entry is None or entry[0] != plan:
+                entry = (plan, TokenBucket(1000 / plan.interval_ms, plan.capacity))
+                self._buckets[user_id] = entry
+            self._buckets.move_to_end(user_id)
+            while len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+            return entry[1]
+
+    def _count(self, name):
+        # 複数のスレッドから同時に呼ばれるので、カウンターもロックの中で更新する
+        with self._lock:
+            self.counters[name] += 1
+
+    def allow(self, user_id, plan_name='free'):
+        """このユーザーがモデルを呼び出してよければTrue"""
+        plan = get_plan(plan_name)
+        if not self._local_bucket(user_id, plan).try_acquire():
+            self._count('localDenied')
+            return False
+        if self.shared is not None:
+            try:
+                if not self.shared.allow(f"user#{user_id}", plan):
+                    self._count('sharedDenied')
+                    return False
+            except Exception as e:
+                # 共通のバケットが使えないときはコンテナ内の判定だけで続ける
+                logger.error(f"レート制限のテーブルを更新できませんでした: {e}")
+        self._count('allowed')
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {**self.counters, 'users': len(self._buckets)}
+
+
+_user_limiter = None
+
+
+def get_user_limiter():
+    """共有のユーザーごとの制限（ウォームスタート時は同じインスタンスを使い回す）"""
+    global _user_limiter
+    if _user_limiter is None:
+        shared = DynamoDBBucket(clients.dynamodb_table(RATE_LIMIT_TABLE)) if RATE_LIMIT_TABLE else None
+        _user_limiter = UserRateLimiter(shared)
+    return _user_limiter
+
+
+def allow_user(user_id, plan_name='free'):
+    """ユーザーのモデル呼び出しを許可するか（RATE_LIMIT_ENABLEDが無効なら常にTrue）"""
+    if not RATE_LIMIT_ENABLED:
+        return True
+    return get_user_limiter().allow(user_id, plan_name)
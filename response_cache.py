@@ -0,0 +1,201 @@
+"""
+モデル応答のキャッシュ
+同じような質問（「ジムの後は何を食べればいい？」など）に対してモデルを呼ばずに応答する
+プロセス内のLRUキャッシュ（ウォームスタート間で保持）と、DynamoDBの共有キャッシュの2段構成
+キャッシュした応答は他のユーザーにも返すので、キーには正規化した質問と、応答を変えるプロフィールの項目だけを入れ、
+表示名や会話履歴のようなユーザーごとの情報は入れない（キャッシュを使う応答はそれらをプロンプトに含めずに生成する）
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+# キャッシュを使うかどうか
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+# プロセス内キャッシュの最大件数
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '512'))
+# キャッシュの有効期間（秒）
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv('RESPONSE_CACHE_TTL_SECONDS', '86400'))
+# 共有キャッシュのDynamoDBテーブル（未設定ならプロセス内キャッシュのみ）
+RESPONSE_CACHE_TABLE = os.getenv('RESPONSE_CACHE_TABLE')
+
+# 正規化時に取り除く文末の記号
+_TRAILING_PUNCTUATION = re.compile(r'[\s?!.。、,？！…ー〜~]+$')
+_WHITESPACE = re.compile(r'\s+')
+# 前の会話を指す表現（これを含む質問は会話の文脈がないと答えられないので、キャッシュを使わない）
+_CONTEXT_REFERENCE = re.compile(
+    r'^(じゃあ|では|でも)|それ|これ|あれ|その|この|あの|さっき|先ほど|前の|上の|続き|つづき|もっと|他に|ほかに|'
+    r'詳しく|くわしく|さらに'
+)
+
+
+def normalize_text(text):
+    """表記ゆれ（全角/半角・大文字/小文字・空白・文末記号）を吸収する"""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    text = _WHITESPACE.sub(' ', text).strip()
+    return _TRAILING_PUNCTUATION.sub('', text)
+
+
+def refers_to_context(text):
+    """前の会話を指す表現を含むか"""
+    return bool(_CONTEXT_REFERENCE.search(normalize_text(text)))
+
+
+class ResponseCache:
+    """プロセス内のLRUキャッシュと、任意のDynamoDB共有キャッシュ"""
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+                 table=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.table = table
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'memoryHits': 0, 'sharedHits': 0, 'misses': 0, 'bypassed': 0}
+
+    def make_key(self, system_prompt, user_text, profile=None):
+        """
+        キャッシュキーを作る
+        システムプロンプト・応答を変えるプロフィールの項目・正規化したユーザーの入力をハッシュ化する
+        system_promptにはユーザーによらないプロンプトを、profileには応答を変える項目だけを渡す
+        （表示名のように応答を変えない項目を入れると、同じ質問でもユーザーごとに別のキーになる）
+        """
+        material = json.dumps({
+            'system': system_prompt,
+            'profile': profile or {},
+            'text': normalize_text(user_text)
+        }, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """キャッシュされた応答を返す（なければNone）"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, answer = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.counters['memoryHits'] += 1
+                    return answer
+                del self._entries[key]
+
+        answer = self._get_shared(key, now)
+        with self._lock:
+            if answer is None:
+                self.counters['misses'] += 1
+            else:
+                self.counters['sharedHits'] += 1
+        if answer is not None:
+            self._put_memory(key, answer, now)
+        return answer
+
+    def put(self, key, answer):
+        """応答をキャッシュに保存"""
+        now = time.time()
+        self._put_memory(key, answer, now)
+        self._put_shared(key, answer, now)
+
+    def record_bypass(self):
+        with self._lock:
+            self.counters['bypassed'] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters['memoryHits'] + self.counters['sharedHits'] + self.counters['misses']
+            hits = self.counters['memoryHits'] + self.counters['sharedHits']
+            return {
+                **self.counters,
+                'entries': len(self._entries),
+                'hitRate': round(hits / lookups, 3) if lookups else 0.0
+            }
+
+    def _put_memory(self, key, answer, now):
+        with self._lock:
+            self._entries[key] = (now + self.ttl_seconds, answer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _get_shared(self, key, now):
+        if self.table is None:
+            return None
+        try:
+            item = self.table.get_item(Key={'cacheKey': key}).get('Item')
+        except Exception as e:
+            logger.error(f"共有キャッシュの取得エラー: {str(e)}")
+            return None
+        # DynamoDBのTTLによる削除は遅れることがあるので期限を確認する
+        if item and int(item.get('expiresAt', 0)) > now:
+            return item['answer']
+        return None
+
+    def _put_shared(self, key, answer, now):
+        if self.table is None:
+            return
+        try:
+            self.table.put_item(Item={
+                'cacheKey': key,
+                'answer': answer,
+                'expiresAt': int(now + self.ttl_seconds)
+            })
+        except Exception as e:
+            logger.error(f"共有キャッシュの保存エラー: {str(e)}")
+
+
+_cache = None
+
+
+def get_cache():
+    """環境変数に応じたキャッシュを返す（ウォームスタート時は同じインスタンスを使い回す）"""
+    global _cache
+    if _cache is None:
+        table = None
+        if RESPONSE_CACHE_TABLE:
+            import clients
+            table = clients.dynamodb_table(RESPONSE_CACHE_TABLE)
+        _cache = ResponseCache(table=table)
+    return _cache
+
+
+def cache_enabled(use_cache=True):
+    """このリクエストでキャッシュを使うかどうか"""
+    return RESPONSE_CACHE_ENABLED and use_cache
+
+
+def cacheable(user_text, use_cache=True):
+    """
+    この質問にキャッシュを使うかどうか
+    前の会話を指す質問は文脈によって答えが変わるので使わない。使う場合は、会話履歴を含めずに応答を生成する
+    """
+    return cache_enabled(use_cache) and not refers_to_context(user_text)
+
+
+def lookup(system_prompt, user_text, profile=None, use_cache=True):
+    """
+    キャッシュを引く
+    profileには、プロンプトの組み立てに使ったユーザーの情報のうち応答を変える項目だけを渡す
+    (キー, 応答) を返す。キャッシュを使わない場合のキーはNone、見つからなければ応答はNone
+    """
+    cache = get_cache()
+    if not cacheable(user_text, use_cache):
+        cache.record_bypass()
+        return None, None
+    key = cache.make_key(system_prompt, user_text, profile)
+    answer = cache.get(key)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"応答キャッシュ{'ヒット' if answer is not None else 'ミス'}: {cache.stats()}")
+    return key, answer
+
+
+def store(key, answer):
+    """lookupで得たキーに応答を保存（キャッシュを使わない場合は何もしない）"""
+    if key is not None:
+        get_cache().put(key, answer)
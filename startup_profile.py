@@ -0,0 +1,147 @@
+"""
+ハンドラーのコールドスタートのプロファイラー
+各ハンドラーモジュールを新しいPythonプロセスで読み込み、モジュールの読み込み時間・重い依存パッケージ・
+SDKを使わない経路（OPTIONSや404など）の初回呼び出し時間を表示する
+
+使い方: python startup_profile.py [--budget-ms 300] [--repeat 3] [モジュール名 ...]
+--budget-ms を超えたモジュールがあれば終了コード1で終了するので、CIで退行を検出できる
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HANDLER_MODULES = [
+    'createLineUserProfile',
+    'editLineUserInfo',
+    'getLineUserInfo',
+    'lambda_function',
+    'linePersonalTrainerAI',
+    'notificationDispatcher',
+    'subscriptionManagement',
+    'userprofile',
+    'weightrecords',
+]
+
+# SDKやAWSを使わずに応答できる経路の呼び出し（初回呼び出しの時間を測る）
+PROBE_EVENTS = {
+    'userprofile': {'requestContext': {'http': {'method': 'OPTIONS'}}},
+    'getLineUserInfo': {'pathParameters': {}},
+    'subscriptionManagement': {'path': '/unknown'},
+    'lambda_function': {'headers': {}, 'body': ''},
+    'linePersonalTrainerAI': {'headers': {}, 'body': ''},
+    'weightrecords': {'httpMethod': 'OPTIONS'},
+}
+
+# モジュールを読み込むのに必要なダミーの環境変数
+DUMMY_ENV = {
+    'CHANNEL_ACCESS_TOKEN': 'dummy',
+    'CHANNEL_SECRET': 'dummy',
+    'OPENAI_API_KEY': 'dummy',
+    'STRIPE_SECRET_KEY': 'sk_test_dummy',
+    'STRIPE_WEBHOOK_SECRET': 'whsec_dummy',
+    'AWS_DEFAULT_REGION': 'ap-northeast-1',
+}
+
+# 子プロセスで実行するスクリプト
+CHILD_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+module = __import__(sys.argv[1])
+imported = time.perf_counter()
+probe = json.loads(sys.argv[2])
+invoke_ms = None
+if probe is not None:
+    module.lambda_handler(probe, None)
+    invoke_ms = (time.perf_counter() - imported) * 1000
+print(json.dumps({'importMs': (imported - started) * 1000, 'invokeMs': invoke_ms}))
+"""
+
+
+def parse_importtime(stderr, module, top=5):
+    """
+    -X importtime の出力から、重い依存パッケージとその累積時間(ms)を集計
+    標準ライブラリとハンドラー自身は除く（パッケージ内の入れ子は外側の読み込みの時間を使う）
+    """
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        try:
+            _, cumulative_us, name = [part.strip() for part in line.split(':', 1)[1].split('|')]
+        except ValueError:
+            continue
+        package = name.split('.')[0]
+        if package == module or package in sys.stdlib_module_names or package.startswith('_'):
+            continue
+        packages[package] = max(packages.get(package, 0), int(cumulative_us) / 1000)
+    heavy = [(package, ms) for package, ms in packages.items() if ms >= 1]
+    return sorted(heavy, key=lambda item: item[1], reverse=True)[:top]
+
+
+def profile_module(module, repeat):
+    env = {**os.environ, **DUMMY_ENV}
+    probe = json.dumps(PROBE_EVENTS.get(module))
+    runs = []
+    heavy = []
+    for i in range(repeat):
+        command = [sys.executable]
+        if i == 0:
+            command += ['-X', 'importtime']
+        command += ['-c', CHILD_SCRIPT, module, probe]
+        completed = subprocess.run(
+            command, capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        if completed.returncode != 0:
+            error = completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'unknown error'
+            return {'module': module, 'error': error}
+        runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        if i == 0:
+            heavy = parse_importtime(completed.stderr, module)
+
+    # 初回は -X importtime のオーバーヘッドを含むので、2回目以降があればそちらを使う
+    measured = runs[1:] or runs
+    invoke = [run['invokeMs'] for run in measured if run['invokeMs'] is not None]
+    return {
+        'module': module,
+        'importMs': statistics.median(run['importMs'] for run in measured),
+        'invokeMs': statistics.median(invoke) if invoke else None,
+        'heaviest': heavy
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', default=HANDLER_MODULES)
+    parser.add_argument('--repeat', type=int, default=3, help='各モジュールを読み込む回数（中央値を表示）')
+    parser.add_argument('--budget-ms', type=float, help='読み込み＋初回呼び出しの時間の上限')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+    args = parser.parse_args()
+
+    results = [profile_module(module, max(1, args.repeat)) for module in args.modules]
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print(f"{'モジュール':<26}{'読み込み(ms)':>14}{'初回呼び出し(ms)':>18}  重い依存パッケージ(ms)")
+        for r in results:
+            if 'error' in r:
+                print(f"{r['module']:<26}  読み込みに失敗しました: {r['error']}")
+                continue
+            invoke = f"{r['invokeMs']:.1f}" if r['invokeMs'] is not None else '-'
+            heaviest = ', '.join(f"{name} {ms:.0f}" for name, ms in r['heaviest'])
+            print(f"{r['module']:<26}{r['importMs']:>14.1f}{invoke:>18}  {heaviest}")
+
+    over_budget = [
+        r['module'] for r in results
+        if 'error' in r or (args.budget_ms is not None and r['importMs'] + (r['invokeMs'] or 0) > args.budget_ms)
+    ]
+    if over_budget:
+        print(f"予算超過または失敗: {', '.join(over_budget)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
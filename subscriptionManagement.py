@@ -1,7 +1,12 @@
-import stripe
 import json
 import logging
 import os
+import entitlements
+import idempotency
+import message_queue
+import metrics
+from deadline import Deadline
+from http_response import json_response
 
 # ロガーの設定
 logger = logging.getLogger()
@@ -10,57 +15,107 @@ logger.setLevel(logging.INFO)
 # 環境変数から設定を取得
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY')
 STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
+# 'deferred' にするとイベントの処理をキューのワーカー（worker_handler）に任せ、webhookはすぐに応答する
+STRIPE_WEBHOOK_MODE = os.getenv('STRIPE_WEBHOOK_MODE', 'sync')
 
 # 環境変数が設定されているか確認
 if not STRIPE_SECRET_KEY or not STRIPE_WEBHOOK_SECRET:
     logger.error("必要な環境変数が設定されていません")
     raise ValueError("STRIPE_SECRET_KEY と STRIPE_WEBHOOK_SECRET が必要です")
 
-# Stripeのシークレットキーを設定
-stripe.api_key = STRIPE_SECRET_KEY
+_stripe = None
 
-def create_payment_intent(amount, currency='jpy'):
+def get_stripe():
+    """
+    Stripe SDKを読み込んでシークレットキーを設定
+    SDKの読み込みは重いので、404などSDKを使わない経路では読み込まない
+    """
+    global _stripe
+    if _stripe is None:
+        import stripe
+        stripe.api_key = STRIPE_SECRET_KEY
+        _stripe = stripe
+    return _stripe
+
+def create_payment_intent(amount, currency='jpy', line_id=None):
     """
     決済インテントを作成する関数
+    lineIdを指定すると、決済成功時にそのユーザーへ利用権を付与できるようにmetadataに入れる
     """
+    stripe = get_stripe()
     try:
         payment_intent = stripe.PaymentIntent.create(
             amount=amount,  # 金額（日本円の場合は整数）
             currency=currency,
             automatic_payment_methods={
                 'enabled': True,
-            }
+            },
+            metadata={'lineId': line_id} if line_id else {}
         )
         
-        return {
-            'statusCode': 200,
-            'body': json.dumps({
-                'clientSecret': payment_intent.client_secret
-            })
-        }
+        return json_response(200, {
+            'clientSecret': payment_intent.client_secret
+        })
         
     except stripe.error.StripeError as e:
         logger.error(f"Stripeエラー: {str(e)}")
-        return {
-            'statusCode': 400,
-            'body': json.dumps({
-                'error': str(e)
-            })
-        }
+        return json_response(400, {
+            'error': str(e)
+        })
     
     except Exception as e:
         logger.error(f"予期せぬエラー: {str(e)}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps({
-                'error': '内部サーバーエラー'
-            })
-        }
-
-def handle_webhook(event):
+        return json_response(500, {
+            'error': '内部サーバーエラー'
+        })
+
+def handle_payment_succeeded(stripe_event):
+    """
+    決済成功時の処理
+    metadataにlineIdがある単発の決済なら、ONE_TIME_PERIOD_DAYS 日分の利用権を付与する
+    """
+    payment_intent = stripe_event['data']['object']
+    logger.info(f"決済成功: {payment_intent['id']}")
+    line_id = (payment_intent.get('metadata') or {}).get('lineId')
+    if line_id:
+        period_end = stripe_event['created'] + entitlements.ONE_TIME_PERIOD_DAYS * 86400
+        entitlements.materialize(line_id, 'active', period_end, stripe_event['created'])
+
+def handle_subscription_changed(stripe_event):
+    """サブスクリプションの作成・更新・解約を、ユーザーの利用権としてプロフィールに反映する"""
+    subscription = stripe_event['data']['object']
+    line_id, status, period_end = entitlements.from_subscription(subscription)
+    if not line_id:
+        logger.warning(f"サブスクリプションのmetadataにlineIdがありません: {subscription['id']}")
+        return
+    if stripe_event['type'] == 'customer.subscription.deleted':
+        status = 'canceled'
+    entitlements.materialize(line_id, status, period_end, stripe_event['created'], subscription['id'])
+    logger.info(f"利用権を更新しました: {line_id} {status}")
+
+# イベントタイプごとの処理（ここにないイベントは受信だけして何もしない）
+EVENT_HANDLERS = {
+    'payment_intent.succeeded': handle_payment_succeeded,
+    'customer.subscription.created': handle_subscription_changed,
+    'customer.subscription.updated': handle_subscription_changed,
+    'customer.subscription.deleted': handle_subscription_changed,
+}
+
+def process_event(stripe_event):
+    """Stripeのイベントを処理する（webhookから直接、またはキューのワーカーから呼ばれる）"""
+    handler = EVENT_HANDLERS.get(stripe_event['type'])
+    if handler is not None:
+        handler(stripe_event)
+
+def handle_webhook(event, deadline=None):
     """
     Stripeからのwebhookを処理する関数
+    イベントIDで重複を判定し、処理済みのイベント（Stripeの再送など）は処理せずに応答する
+    他の実行が処理中のイベントは、その処理が失敗しても取りこぼさないよう409を返してStripeに再送させる
     """
+    deadline = deadline or Deadline.from_context(None)
+    with deadline.stage('sdk'):
+        stripe = get_stripe()
     try:
         # webhookシークレットを環境変数から取得
         webhook_secret = STRIPE_WEBHOOK_SECRET
@@ -69,35 +124,104 @@ def handle_webhook(event):
         payload = event['body']
         sig_header = event['headers']['Stripe-Signature']
         
-        # イベントを検証
-        stripe_event = stripe.Webhook.construct_event(
-            payload, sig_header, webhook_secret
-        )
+        metrics.log_payload('Stripe webhook body', payload)
         
-        # イベントタイプに応じた処理
-        if stripe_event['type'] == 'payment_intent.succeeded':
-            payment_intent = stripe_event['data']['object']
-            logger.info(f"決済成功: {payment_intent['id']}")
-            # ここに決済成功時の処理を追加
-            
-        return {
-            'statusCode': 200,
-            'body': json.dumps({'received': True})
-        }
+        # イベントを検証
+        with deadline.stage('signature'):
+            stripe_event = stripe.Webhook.construct_event(
+                payload, sig_header, webhook_secret
+            )
+        deadline.note('eventType', stripe_event['type'])
         
     except stripe.error.SignatureVerificationError as e:
         logger.error(f"Webhook署名エラー: {str(e)}")
-        return {
-            'statusCode': 400,
-            'body': json.dumps({'error': 'Invalid signature'})
-        }
+        return json_response(400, {'error': 'Invalid signature'})
         
     except Exception as e:
         logger.error(f"Webhookエラー: {str(e)}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps({'error': 'Webhook handling failed'})
-        }
+        return json_response(500, {'error': 'Webhook handling failed'})
+
+    store = idempotency.get_store()
+    key = f"stripe:{stripe_event['id']}"
+    try:
+        with deadline.stage('claim'):
+            state = store.claim(key)
+        if state == idempotency.COMPLETED:
+            deadline.note('duplicate', True)
+            logger.info(f"処理済みのイベントのため処理しません: {stripe_event['id']}")
+            return json_response(200, {'received': True, 'duplicate': True})
+        if state == idempotency.IN_PROGRESS:
+            deadline.note('inProgress', True)
+            logger.info(f"他の実行が処理中のイベントのため、後で再送させます: {stripe_event['id']}")
+            return json_response(409, {'received': False, 'inProgress': True})
+    except Exception as e:
+        logger.error(f"Webhookエラー: {str(e)}")
+        return json_response(500, {'error': 'Webhook handling failed'})
+
+    try:
+        if STRIPE_WEBHOOK_MODE == 'deferred' and stripe_event['type'] in EVENT_HANDLERS:
+            # 処理はワーカーに任せ、キューに積めた時点で受信済みとする
+            with deadline.stage('enqueue'):
+                message_queue.get_queue().send_batch([json.loads(payload)])
+            logger.info(f"イベントをキューに追加しました: {stripe_event['id']}")
+        else:
+            # 新しいSDKのStripeObjectはdictではない（.getが使えない）ので、ワーカーと同じく検証済みのJSONを渡す
+            with deadline.stage('process'):
+                process_event(json.loads(payload))
+        with deadline.stage('complete'):
+            store.complete(key)
+        return json_response(200, {'received': True})
+        
+    except Exception as e:
+        logger.error(f"Webhookエラー: {str(e)}")
+        # Stripeの再送で処理し直せるように記録を消す
+        store.release(key)
+        return json_response(500, {'error': 'Webhook handling failed'})
+
+def worker_handler(event, context):
+    """
+    キューに積まれたStripeのイベントを処理するワーカーのエントリーポイント
+    SQSの再配信でも同じイベントを2回処理しないように、webhookとは別のキーで重複を判定する
+    他の実行が処理中のメッセージは削除せず、失敗として返して後で再配信させる
+    """
+    if 'Records' in event:
+        queue = None
+        messages = message_queue.messages_from_sqs_event(event)
+    else:
+        queue = message_queue.get_queue()
+        messages = queue.receive(event.get('maxMessages', 10))
+
+    store = idempotency.get_store()
+    failures = []
+    for message in messages:
+        key = f"stripe-process:{message.body['id']}"
+        try:
+            state = store.claim(key)
+            if state == idempotency.IN_PROGRESS:
+                logger.info(f"他の実行が処理中のため後で処理します: {key}")
+                failures.append({'itemIdentifier': message.message_id})
+                if queue is not None:
+                    queue.release(message)
+                continue
+            if state == idempotency.CLAIMED:
+                try:
+                    process_event(message.body)
+                except Exception:
+                    store.release(key)
+                    raise
+                store.complete(key)
+            if queue is not None:
+                queue.delete(message)
+        except Exception as e:
+            logger.error(f"キューのイベント処理でエラーが発生しました: {e}")
+            failures.append({'itemIdentifier': message.message_id})
+            # キューから直接受信した場合は、後でもう一度受信できるように戻す
+            if queue is not None:
+                queue.release(message)
+
+    logger.info(f"{len(messages)}件のイベントを処理しました（失敗: {len(failures)}件）")
+    # SQSの部分的なバッチ失敗レスポンス
+    return {'batchItemFailures': failures}
 
 def lambda_handler(event, context):
     """
@@ -109,20 +233,18 @@ def lambda_handler(event, context):
         
         if path == '/create-payment-intent':
             body = json.loads(event['body'])
-            return create_payment_intent(body['amount'])
+            return create_payment_intent(body['amount'], line_id=body.get('lineId'))
             
         elif path == '/webhook':
-            return handle_webhook(event)
+            deadline = Deadline.from_context(context)
+            try:
+                return handle_webhook(event, deadline)
+            finally:
+                deadline.report('subscriptionManagement.webhook')
             
         else:
-            return {
-                'statusCode': 404,
-                'body': json.dumps({'error': 'Not found'})
-            }
+            return json_response(404, {'error': 'Not found'})
             
     except Exception as e:
         logger.error(f"ハンドラーエラー: {str(e)}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps({'error': '内部サーバーエラー'})
-        }
+        return json_response(500, {'error': '内部サーバーエラー'})
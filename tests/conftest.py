@@ -0,0 +1,42 @@
+"""
+テストの共通設定
+ハンドラーとライブラリはリポジトリ直下のモジュールなので、直下をimportのパスに加える
+AWSを使うテストはmotoのモック（aws fixture）に対して実行し、実際のAWSには接続しない
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+
+@pytest.fixture
+def aws():
+    """motoのモック（共有のクライアントはテストごとに作り直す）"""
+    moto = pytest.importorskip('moto')
+    import clients
+    with moto.mock_aws():
+        clients._clients.clear()
+        yield
+    clients._clients.clear()
+
+
+@pytest.fixture
+def make_table(aws):
+    """motoのDynamoDBにテーブルを作る関数（キーは文字列型）"""
+    import boto3
+
+    def make(name, partition_key, sort_key=None):
+        keys = [(partition_key, 'HASH')] + ([(sort_key, 'RANGE')] if sort_key else [])
+        return boto3.resource('dynamodb').create_table(
+            TableName=name,
+            KeySchema=[{'AttributeName': key, 'KeyType': key_type} for key, key_type in keys],
+            AttributeDefinitions=[{'AttributeName': key, 'AttributeType': 'S'} for key, _ in keys],
+            BillingMode='PAY_PER_REQUEST'
+        )
+    return make
@@ -0,0 +1,201 @@
+"""
+会話のアーカイブ（conversationArchiver）と、アーカイブを含むエクスポート（conversationExport）のテスト
+アーカイブの保存先はローカルのディレクトリ、テーブルとエクスポート先のS3はmotoを使う
+"""
+import gzip
+import json
+
+import pytest
+
+import conversation_archive
+import conversation_days
+import conversationArchiver
+import conversationExport
+
+LINE_ID = 'U1'
+TIMESTAMPS = [
+    '2025-01-05T10:00:00', '2025-01-20T10:00:00', '2025-02-03T10:00:00',
+    '2025-03-01T10:00:00', '2025-03-02T10:00:00'
+]
+CUTOFF = '2025-02-28T00:00:00'
+
+
+class StepDeadline:
+    """remaining_msが呼ばれるたびに、指定した値を順に返すデッドライン（使い切ったら最後の値）"""
+
+    def __init__(self, *values):
+        self.values = list(values)
+
+    def remaining_ms(self, reserve_ms=0):
+        return self.values.pop(0) if len(self.values) > 1 else self.values[0]
+
+
+@pytest.fixture
+def days(make_table, monkeypatch):
+    monkeypatch.setattr(conversation_days, '_recorded', conversation_days.OrderedDict())
+    return make_table('LineConversationDays', 'shardKey', 'dayUser')
+
+
+@pytest.fixture
+def table(make_table, days):
+    table = make_table('linebot-conversation-history', 'lineId', 'timestamp')
+    for i, timestamp in enumerate(TIMESTAMPS):
+        table.put_item(Item={
+            'lineId': LINE_ID, 'timestamp': timestamp, 'user_message': f'q{i}', 'assistant_message': f'a{i}'
+        })
+        conversation_days.record(LINE_ID, timestamp)
+    return table
+
+
+@pytest.fixture
+def store(tmp_path):
+    return conversation_archive.LocalStore(str(tmp_path))
+
+
+def table_timestamps(table):
+    return [item['timestamp'] for item in table.scan()['Items']]
+
+
+def exported(chunks):
+    return [json.loads(line)['timestamp'] for line in gzip.decompress(b''.join(chunks)).decode().splitlines()]
+
+
+def test_archive_moves_old_months(table, store):
+    summary = conversationArchiver.archive_all(table, store, CUTOFF)
+
+    assert summary['turns'] == 3 and summary['segments'] == 2 and summary['complete']
+    assert sorted(table_timestamps(table)) == TIMESTAMPS[3:]
+    assert [item['timestamp'] for item in conversation_archive.read_turns(store, LINE_ID)] == TIMESTAMPS[:3]
+
+
+def test_archive_finds_users_from_day_index_without_scanning(table, store, days, monkeypatch):
+    def scan(**kwargs):
+        raise AssertionError('会話のテーブルをスキャンしました')
+    monkeypatch.setattr(table, 'scan', scan)
+
+    summary = conversationArchiver.archive_all(table, store, CUTOFF)
+
+    assert summary['users'] == 1 and summary['turns'] == 3
+    # アーカイブし終えた日は索引から外れ、カットオフ以降の日だけが残る
+    assert sorted(item['dayUser'][:10] for item in days.scan()['Items']) == ['2025-03-01', '2025-03-02']
+    assert conversationArchiver.users_with_old_turns(CUTOFF) == {}
+
+
+def test_backfill_indexes_existing_turns(table, days, monkeypatch):
+    for item in days.scan()['Items']:
+        days.delete_item(Key={'shardKey': item['shardKey'], 'dayUser': item['dayUser']})
+    monkeypatch.setattr(conversation_days, '_recorded', conversation_days.OrderedDict())
+
+    assert conversation_days.backfill(table, days) == len(TIMESTAMPS)
+    assert list(conversationArchiver.users_with_old_turns(CUTOFF)) == [LINE_ID]
+
+
+def test_archive_checks_deadline_before_each_month(table, store):
+    # 1か月目を書く前は時間があり、2か月目を書く前に時間が足りなくなる
+    deadline = StepDeadline(60000, 60000, 0)
+
+    summary = conversationArchiver.archive_all(table, store, CUTOFF, deadline)
+
+    assert summary['complete'] is False
+    assert summary['turns'] == 2 and summary['segments'] == 1
+    # 書き出さなかった月はテーブルに残り、索引からも外さずに次の実行で移す
+    assert sorted(table_timestamps(table)) == TIMESTAMPS[2:]
+    assert list(conversationArchiver.users_with_old_turns(CUTOFF)) == [LINE_ID]
+
+    summary = conversationArchiver.archive_all(table, store, CUTOFF)
+    assert summary['turns'] == 1 and summary['complete']
+    assert [item['timestamp'] for item in conversation_archive.read_turns(store, LINE_ID)] == TIMESTAMPS[:3]
+
+
+def test_export_reads_archive_then_table(table, store):
+    conversationArchiver.archive_all(table, store, CUTOFF)
+
+    chunks = conversationExport.export_chunks(table, LINE_ID, store=store)
+
+    assert exported(chunks) == TIMESTAMPS
+
+
+def test_export_skips_turns_in_both_archive_and_table(table, store):
+    # セグメントを書いた後、テーブルから削除する前に止まった状態
+    items = table.scan()['Items']
+    conversation_archive.append_turns(store, LINE_ID, '2025-01', [i for i in items if i['timestamp'] < '2025-02'])
+
+    assert exported(conversationExport.export_chunks(table, LINE_ID, store=store)) == TIMESTAMPS
+
+
+def test_export_date_range_spans_archive_and_table(table, store):
+    conversationArchiver.archive_all(table, store, CUTOFF)
+
+    chunks = conversationExport.export_chunks(table, LINE_ID, '2025-01-10', '2025-03-01~', store=store)
+
+    assert exported(chunks) == TIMESTAMPS[1:4]
+
+
+def test_export_resumes_inside_archive(table, store, aws, tmp_path, monkeypatch):
+    import boto3
+    monkeypatch.setattr(conversationExport, 'EXPORT_TOKEN_SECRET', 'test-secret')
+    conversationArchiver.archive_all(table, store, CUTOFF)
+    monkeypatch.setattr(conversation_archive, 'ARCHIVE_URI', str(tmp_path))
+    # 1件書き出すたびに時間切れとみなし、セグメントを区切る
+    monkeypatch.setattr(conversationExport, 'EXPORT_RESERVE_MS', 10 ** 9)
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket='export-bucket', CreateBucketConfiguration={'LocationConstraint': 'ap-northeast-1'})
+
+    state = conversationExport.export_request({'lineId': LINE_ID})
+    parts = []
+    for _ in range(10):
+        result = conversationExport.export_segment(state, StepDeadline(0), table, s3, 'export-bucket')
+        parts.append(s3.get_object(Bucket='export-bucket', Key=result['key'])['Body'].read())
+        if result['complete']:
+            break
+        state = conversationExport.export_request({'token': result['nextToken']})
+
+    assert len(parts) == 4
+    assert exported(parts) == TIMESTAMPS
+
+
+@pytest.fixture
+def export_bucket(aws, monkeypatch):
+    import boto3
+    boto3.client('s3').create_bucket(
+        Bucket='export-bucket', CreateBucketConfiguration={'LocationConstraint': 'ap-northeast-1'}
+    )
+    monkeypatch.setattr(conversationExport, 'EXPORT_BUCKET', 'export-bucket')
+    monkeypatch.setattr(conversationExport, 'EXPORT_TOKEN_SECRET', 'test-secret')
+    return 'export-bucket'
+
+
+@pytest.mark.parametrize('event', [
+    {'httpMethod': 'GET', 'queryStringParameters': None},
+    {'httpMethod': 'GET', 'queryStringParameters': {'format': 'csv'}},
+    {'requestContext': {'http': {'method': 'GET'}}, 'queryStringParameters': {}},
+])
+def test_http_export_requires_line_id(table, export_bucket, event):
+    response = conversationExport.lambda_handler(event, None)
+    assert response['statusCode'] == 400
+
+
+def test_direct_invoke_exports_all_users(table, export_bucket):
+    response = conversationExport.lambda_handler({'format': 'ndjson'}, None)
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['rows'] == len(TIMESTAMPS)
+
+
+def test_tampered_token_is_rejected(table, export_bucket):
+    import base64
+    token = conversationExport.encode_token(conversationExport.export_request({'lineId': LINE_ID}))
+
+    # 状態を書き換えて別のユーザーを書き出させようとしたトークン
+    payload, signature = token.split('.')
+    state = json.loads(base64.urlsafe_b64decode(payload))
+    state['lineId'] = 'U2'
+    forged = base64.urlsafe_b64encode(json.dumps(state).encode()).decode() + '.' + signature
+
+    for bad in (forged, payload, 'not-a-token'):
+        response = conversationExport.lambda_handler(
+            {'httpMethod': 'GET', 'queryStringParameters': {'token': bad}}, None
+        )
+        assert response['statusCode'] == 400
+
+    response = conversationExport.lambda_handler({'httpMethod': 'GET', 'queryStringParameters': {'token': token}}, None)
+    assert response['statusCode'] == 200
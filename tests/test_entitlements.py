@@ -0,0 +1,51 @@
+"""
+entitlementsのテスト
+利用権はプロフィールとは別のテーブルに持つので、プロフィールの作成・更新で消えないことを確かめる
+"""
+import time
+
+import pytest
+
+import entitlements
+
+PROFILE = {
+    'lineId': 'U1', 'birthDate': '1990-01-01', 'gender': 'female', 'height': '160', 'weight': '55',
+    'targetWeight': '50', 'targetPeriod': '3', 'priority': 'diet', 'pastExperience': 'none',
+    'exerciseFrequency': 'weekly', 'mealFrequency': '3', 'alcoholFrequency': 'none', 'allergies': 'none',
+    'restrictions': 'none', 'illness': 'none', 'motivation': 'health'
+}
+
+
+@pytest.fixture
+def tables(make_table, monkeypatch):
+    monkeypatch.setattr(entitlements, '_cache', None)
+    return make_table('LineUserProfiles', 'lineId'), make_table('LineUserEntitlements', 'lineId')
+
+
+def test_profile_create_keeps_entitlement(tables):
+    import createLineUserProfile
+    profiles, _ = tables
+    entitlements.materialize('U1', 'active', time.time() + 3600, 100)
+
+    response = createLineUserProfile.lambda_handler(dict(PROFILE), None)
+
+    assert response['statusCode'] == 200
+    assert entitlements.EntitlementCache().check('U1') is True
+    assert 'subscriptionStatus' not in profiles.get_item(Key={'lineId': 'U1'})['Item']
+
+
+def test_materialize_does_not_create_profile(tables):
+    profiles, _ = tables
+    entitlements.materialize('U2', 'active', time.time() + 3600, 100)
+    assert 'Item' not in profiles.get_item(Key={'lineId': 'U2'})
+
+
+def test_older_event_does_not_overwrite(tables):
+    assert entitlements.materialize('U1', 'canceled', None, 200) is True
+    assert entitlements.materialize('U1', 'active', time.time() + 3600, 100) is False
+    assert entitlements.check('U1') is False
+
+
+def test_expired_period_is_not_entitled(tables):
+    entitlements.materialize('U1', 'active', time.time() - 1, 100)
+    assert entitlements.check('U1') is False
@@ -0,0 +1,37 @@
+"""
+history_cacheのテスト
+既定では使うたびに最新のタイムスタンプで検証し、他のコンテナで書き込まれた会話を見落とさないことを確かめる
+"""
+import history_cache
+
+TURNS = [{'timestamp': '2025-01-01T00:00:02'}, {'timestamp': '2025-01-01T00:00:01'}]
+
+
+def latest(timestamps, calls):
+    def query(after):
+        calls.append(after)
+        return timestamps
+    return query
+
+
+def test_default_validates_every_get():
+    cache = history_cache.HistoryCache()
+    cache.put('U1', None, TURNS, True)
+    calls = []
+
+    assert cache.get('U1', latest(['2025-01-01T00:00:02', '2025-01-01T00:00:01'], calls)) is not None
+    assert cache.get('U1', latest(['2025-01-01T00:00:02', '2025-01-01T00:00:01'], calls)) is not None
+    assert len(calls) == 2
+
+    # 他のコンテナで会話が書き込まれたら、直前に確かめたばかりでもキャッシュを捨てる
+    assert cache.get('U1', latest(['2025-01-01T00:00:03', '2025-01-01T00:00:02'], calls)) is None
+    assert cache.counters['stale'] == 1
+
+
+def test_trust_window_is_opt_in():
+    cache = history_cache.HistoryCache(trust_seconds=60)
+    cache.put('U1', None, TURNS, True)
+    calls = []
+
+    assert cache.get('U1', latest([], calls)) is not None
+    assert calls == []
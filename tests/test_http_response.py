@@ -0,0 +1,43 @@
+from decimal import Decimal
+
+import pytest
+
+import http_response
+
+BACKENDS = ['json', 'orjson']
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, monkeypatch):
+    """標準ライブラリとorjsonの両方のエンコーダーで実行する"""
+    if request.param == 'orjson':
+        orjson = pytest.importorskip('orjson')
+        monkeypatch.setattr(http_response, 'orjson', orjson)
+    else:
+        monkeypatch.setattr(http_response, 'orjson', None)
+    return request.param
+
+
+def test_decimal_integers_and_fractions(backend):
+    assert http_response.encode_json({'a': Decimal('3'), 'b': Decimal('1.5')}) == '{"a":3,"b":1.5}'
+
+
+def test_integers_wider_than_64_bits(backend):
+    # DynamoDBの数値は38桁まで
+    item = {'big': Decimal('12345678901234567890123'), 'max': Decimal('9' * 38), 'plain': 2 ** 70}
+    assert http_response.encode_json(item) == (
+        '{"big":12345678901234567890123,"max":' + '9' * 38 + ',"plain":' + str(2 ** 70) + '}'
+    )
+
+
+def test_sets_are_sorted_and_binary_is_base64(backend):
+    assert http_response.encode_json({'s': {'b', 'a'}, 'bin': b'\x00\x01'}) == '{"s":["a","b"],"bin":"AAE="}'
+
+
+def test_non_ascii_is_not_escaped(backend):
+    assert http_response.encode_json({'name': 'テスト'}) == '{"name":"テスト"}'
+
+
+def test_unsupported_type_raises(backend):
+    with pytest.raises(TypeError):
+        http_response.encode_json({'o': object()})
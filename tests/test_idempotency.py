@@ -0,0 +1,192 @@
+"""
+IdempotencyStoreと、それを使うStripe webhook・ワーカーのテスト
+motoのテーブル（条件付き書き込みをmotoが評価する）に対して、同じイベントを並行に送ったときや、
+処理中のまま止まった記録を引き継いだときに、業務処理が1回だけ実行されることを確かめる
+"""
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import idempotency
+
+WEBHOOK_SECRET = 'whsec_test'
+
+os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test')
+os.environ.setdefault('STRIPE_WEBHOOK_SECRET', WEBHOOK_SECRET)
+
+
+@pytest.fixture
+def table(make_table, monkeypatch):
+    """
+    ProcessedEventsテーブル
+    DynamoDBは同じアイテムへの条件付き書き込みを1つずつ評価するが、motoは並行な呼び出しを直列にしないので、
+    テーブルへの書き込みをロックで直列にしてDynamoDBと同じ振る舞いにする
+    """
+    from moto.dynamodb.models import DynamoDBBackend
+
+    lock = threading.Lock()
+    for name in ('put_item', 'update_item', 'delete_item'):
+        original = getattr(DynamoDBBackend, name)
+
+        def serialized(self, *args, _original=original, **kwargs):
+            with lock:
+                return _original(self, *args, **kwargs)
+        monkeypatch.setattr(DynamoDBBackend, name, serialized)
+    return make_table('ProcessedEvents', 'idempotencyKey')
+
+
+@pytest.fixture
+def store(table, monkeypatch):
+    store = idempotency.IdempotencyStore(table)
+    monkeypatch.setattr(idempotency, '_store', store)
+    return store
+
+
+def test_claim_states(table):
+    first = idempotency.IdempotencyStore(table)
+    assert first.claim('k') == idempotency.CLAIMED
+    # 別のコンテナ（コンテナ内の記録を持たないインスタンス）からの重複
+    assert idempotency.IdempotencyStore(table).claim('k') == idempotency.IN_PROGRESS
+
+    first.complete('k')
+    assert idempotency.IdempotencyStore(table).claim('k') == idempotency.COMPLETED
+    assert first.claim('k') == idempotency.COMPLETED
+
+
+def test_release_allows_reclaim(table):
+    store = idempotency.IdempotencyStore(table)
+    assert store.claim('k') == idempotency.CLAIMED
+    store.release('k')
+    assert idempotency.IdempotencyStore(table).claim('k') == idempotency.CLAIMED
+
+
+def test_concurrent_claims_are_all_counted(table):
+    store = idempotency.IdempotencyStore(table)
+    keys = [f'k{i % 10}' for i in range(40)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(store.claim, keys))
+
+    stats = store.stats()
+    assert stats['claimed'] == 10
+    assert stats['claimed'] + stats['duplicates'] + stats['seenHits'] == len(keys)
+
+
+def test_expired_lock_is_taken_over_once(table):
+    # 処理中のまま止まった実行（ロックの期限は過ぎている）
+    stalled = idempotency.IdempotencyStore(table, lock_seconds=-10)
+    assert stalled.claim('k') == idempotency.CLAIMED
+
+    stores = [idempotency.IdempotencyStore(table) for _ in range(8)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        states = list(executor.map(lambda s: s.claim('k'), stores))
+    assert states.count(idempotency.CLAIMED) == 1
+    assert states.count(idempotency.IN_PROGRESS) == 7
+
+
+def signed_webhook(stripe_event):
+    payload = json.dumps(stripe_event)
+    timestamp = int(time.time())
+    signature = hmac.new(WEBHOOK_SECRET.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return {'path': '/webhook', 'headers': {'Stripe-Signature': f"t={timestamp},v1={signature}"}, 'body': payload}
+
+
+def stripe_event(event_id):
+    return {
+        'id': event_id, 'object': 'event', 'type': 'customer.subscription.updated',
+        'data': {'object': {'id': 'sub_1', 'object': 'subscription', 'metadata': {'lineId': 'U1'}}}
+    }
+
+
+@pytest.fixture
+def webhook(store, monkeypatch):
+    """業務処理を、呼び出し回数を数えて少し待つ処理に置き換えたsubscriptionManagement"""
+    pytest.importorskip('stripe')
+    import subscriptionManagement
+
+    processed = []
+    lock = threading.Lock()
+
+    def process_event(event):
+        time.sleep(0.05)
+        with lock:
+            processed.append(event['id'])
+    monkeypatch.setattr(subscriptionManagement, 'process_event', process_event)
+    monkeypatch.setattr(subscriptionManagement, 'STRIPE_WEBHOOK_MODE', 'sync')
+    return subscriptionManagement, processed
+
+
+def test_concurrent_duplicate_webhooks_process_once(webhook):
+    subscriptionManagement, processed = webhook
+    request = signed_webhook(stripe_event('evt_1'))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        statuses = [r['statusCode'] for r in executor.map(subscriptionManagement.handle_webhook, [request] * 8)]
+
+    assert processed == ['evt_1']
+    # 処理中の重複は受信済みにせず、Stripeに再送させる
+    assert statuses.count(200) >= 1
+    assert set(statuses) <= {200, 409}
+
+    # 処理が終わった後の再送は処理せずに受信済みとする
+    response = subscriptionManagement.handle_webhook(request)
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['duplicate'] is True
+    assert processed == ['evt_1']
+
+
+def test_webhook_in_progress_returns_conflict(webhook, table):
+    subscriptionManagement, processed = webhook
+    idempotency.IdempotencyStore(table).claim('stripe:evt_2')
+
+    response = subscriptionManagement.handle_webhook(signed_webhook(stripe_event('evt_2')))
+
+    assert response['statusCode'] == 409
+    assert processed == []
+
+
+def test_webhook_takes_over_expired_lock(webhook, table):
+    subscriptionManagement, processed = webhook
+    idempotency.IdempotencyStore(table, lock_seconds=-10).claim('stripe:evt_3')
+    request = signed_webhook(stripe_event('evt_3'))
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(subscriptionManagement.handle_webhook, [request] * 4))
+    subscriptionManagement.handle_webhook(request)
+
+    assert processed == ['evt_3']
+
+
+def sqs_event(*event_ids):
+    return {'Records': [
+        {'messageId': f'm-{event_id}', 'body': json.dumps(stripe_event(event_id))} for event_id in event_ids
+    ]}
+
+
+def test_worker_reports_in_progress_as_batch_failure(webhook, table):
+    subscriptionManagement, processed = webhook
+    idempotency.IdempotencyStore(table).claim('stripe-process:evt_5')
+
+    result = subscriptionManagement.worker_handler(sqs_event('evt_4', 'evt_5'), None)
+
+    assert result == {'batchItemFailures': [{'itemIdentifier': 'm-evt_5'}]}
+    assert processed == ['evt_4']
+
+
+def test_worker_redelivery_processes_once(webhook):
+    subscriptionManagement, processed = webhook
+    event = sqs_event('evt_6')
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda e: subscriptionManagement.worker_handler(e, None), [event] * 4))
+    # 処理中で失敗として返ったメッセージの再配信
+    for result in results:
+        if result['batchItemFailures']:
+            assert subscriptionManagement.worker_handler(event, None) == {'batchItemFailures': []}
+
+    assert processed == ['evt_6']
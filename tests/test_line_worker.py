@@ -0,0 +1,225 @@
+"""
+linePersonalTrainerAIのキューのワーカー（worker_handler）のテスト
+他の実行が処理中のイベントや、FIFOキューで前のメッセージが失敗したグループのメッセージを、
+削除させずにbatchItemFailuresで返すことを確かめる
+会話の要約（refresh_summary）がモデルのルーターを通して生成されることも確かめる
+"""
+import json
+import os
+import threading
+
+import pytest
+
+import idempotency
+
+os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+os.environ.setdefault('CHANNEL_ACCESS_TOKEN', 'test')
+os.environ.setdefault('CHANNEL_SECRET', 'test')
+
+
+@pytest.fixture
+def worker(make_table, monkeypatch):
+    pytest.importorskip('linebot')
+    import linePersonalTrainerAI
+
+    table = make_table('ProcessedEvents', 'idempotencyKey')
+    monkeypatch.setattr(idempotency, '_store', idempotency.IdempotencyStore(table))
+    monkeypatch.setattr(linePersonalTrainerAI, 'EVENT_DEDUP_ENABLED', True)
+
+    handled = []
+    lock = threading.Lock()
+
+    def handle(event, deadline):
+        if event.message.text == 'boom':
+            raise RuntimeError('boom')
+        with lock:
+            handled.append(event.message.text)
+    monkeypatch.setattr(linePersonalTrainerAI, '_handle_message', handle)
+    return linePersonalTrainerAI, table, handled
+
+
+def line_event(event_id, user_id, text):
+    return {
+        'type': 'message', 'mode': 'active', 'timestamp': 0, 'replyToken': f'r-{event_id}',
+        'webhookEventId': event_id, 'deliveryContext': {'isRedelivery': False},
+        'source': {'type': 'user', 'userId': user_id},
+        'message': {'type': 'text', 'id': event_id, 'text': text}
+    }
+
+
+def sqs_event(*records, fifo=False):
+    return {'Records': [
+        {
+            'messageId': f'm-{event_id}',
+            'body': json.dumps(line_event(event_id, user_id, text)),
+            'attributes': {'MessageGroupId': user_id} if fifo else {}
+        }
+        for event_id, user_id, text in records
+    ]}
+
+
+def test_in_progress_event_is_reported_as_failure(worker):
+    linePersonalTrainerAI, table, handled = worker
+    # 別のコンテナが処理中のイベント
+    idempotency.IdempotencyStore(table).claim('line:e2')
+
+    result = linePersonalTrainerAI.worker_handler(sqs_event(('e1', 'U1', 'a'), ('e2', 'U2', 'b')), None)
+
+    assert result == {'batchItemFailures': [{'itemIdentifier': 'm-e2'}]}
+    assert handled == ['a']
+
+
+def test_completed_event_is_acknowledged(worker):
+    linePersonalTrainerAI, table, handled = worker
+    store = idempotency.IdempotencyStore(table)
+    store.claim('line:e1')
+    store.complete('line:e1')
+
+    result = linePersonalTrainerAI.worker_handler(sqs_event(('e1', 'U1', 'a')), None)
+
+    assert result == {'batchItemFailures': []}
+    assert handled == []
+
+
+def test_fifo_group_fails_after_first_failure(worker):
+    linePersonalTrainerAI, _, handled = worker
+    event = sqs_event(('e1', 'U1', 'boom'), ('e2', 'U1', 'after'), ('e3', 'U2', 'other'), fifo=True)
+
+    result = linePersonalTrainerAI.worker_handler(event, None)
+
+    assert result == {'batchItemFailures': [{'itemIdentifier': 'm-e1'}, {'itemIdentifier': 'm-e2'}]}
+    assert handled == ['other']
+
+    # 再配信では失敗したメッセージから順に処理する（失敗したイベントの記録は消えている）
+    retry = sqs_event(('e1', 'U1', 'ok'), ('e2', 'U1', 'after'), fifo=True)
+    assert linePersonalTrainerAI.worker_handler(retry, None) == {'batchItemFailures': []}
+    assert handled == ['other', 'ok', 'after']
+
+
+def test_fifo_group_fails_after_in_progress(worker):
+    linePersonalTrainerAI, table, handled = worker
+    idempotency.IdempotencyStore(table).claim('line:e1')
+
+    result = linePersonalTrainerAI.worker_handler(sqs_event(('e1', 'U1', 'a'), ('e2', 'U1', 'b'), fifo=True), None)
+
+    assert result == {'batchItemFailures': [{'itemIdentifier': 'm-e1'}, {'itemIdentifier': 'm-e2'}]}
+    assert handled == []
+
+
+@pytest.fixture
+def summary_table(make_table):
+    return make_table('linebot-conversation-history', 'lineId', 'timestamp')
+
+
+def overflow_history(table, count):
+    import conversation_store
+    turns = [
+        {'lineId': 'U1', 'timestamp': f'2025-01-01T00:00:{i:02d}', 'user_message': f'q{i}', 'assistant_message': f'a{i}'}
+        for i in range(count)
+    ]
+    for item in turns:
+        table.put_item(Item=item)
+    return conversation_store.ConversationHistory([], None, turns)
+
+
+def test_refresh_summary_uses_router(worker, summary_table, monkeypatch):
+    import conversation_store
+    import llm_providers
+    from deadline import Deadline
+
+    linePersonalTrainerAI = worker[0]
+    provider = llm_providers.FakeProvider('fake', text='要約です', first_chunk_ms=0, chunk_ms=0)
+    monkeypatch.setattr(linePersonalTrainerAI, 'llm_router', llm_providers.ProviderRouter([provider], hedging=False))
+
+    linePersonalTrainerAI.refresh_summary('U1', overflow_history(summary_table, 3), Deadline.from_context(None))
+
+    summary = conversation_store.get_summary(summary_table, 'U1')
+    assert provider.calls == 1
+    assert summary['summary'] == '要約です'
+    assert summary['coveredUntil'] == '2025-01-01T00:00:02'
+
+
+def test_refresh_summary_skips_truncated_completion(worker, summary_table, monkeypatch):
+    import conversation_store
+    import llm_providers
+    from deadline import Deadline
+
+    linePersonalTrainerAI = worker[0]
+    router = llm_providers.ProviderRouter([llm_providers.FakeProvider('fake')], hedging=False)
+    monkeypatch.setattr(router, 'generate', lambda *args, **kwargs: llm_providers.Completion('途中', 'fake', True, False))
+    monkeypatch.setattr(linePersonalTrainerAI, 'llm_router', router)
+
+    linePersonalTrainerAI.refresh_summary('U1', overflow_history(summary_table, 3), Deadline.from_context(None))
+
+    assert conversation_store.get_summary(summary_table, 'U1') is None
+
+
+def test_failed_message_is_requeued_without_sqs(worker, monkeypatch):
+    import message_queue
+    linePersonalTrainerAI, _, handled = worker
+    queue = message_queue.InMemoryQueue()
+    monkeypatch.setattr(message_queue, '_queue', queue)
+    queue.send_batch([line_event('e1', 'U1', 'boom'), line_event('e2', 'U2', 'ok')])
+
+    result = linePersonalTrainerAI.worker_handler({}, None)
+
+    assert len(result['batchItemFailures']) == 1
+    assert handled == ['ok']
+    # 失敗したメッセージはキューに戻り、次の実行で受信される
+    [message] = queue.receive()
+    assert message.body['webhookEventId'] == 'e1'
+    assert message.attempts == 2
+
+
+class FakeProfile:
+    def __init__(self, display_name):
+        self.display_name = display_name
+
+
+def test_display_name_is_cached(worker, monkeypatch):
+    linePersonalTrainerAI = worker[0]
+    calls = []
+
+    def get_profile(user_id):
+        calls.append(user_id)
+        return FakeProfile('花子')
+    monkeypatch.setattr(linePersonalTrainerAI.line_bot_api, 'get_profile', get_profile)
+    monkeypatch.setattr(linePersonalTrainerAI, '_display_names', linePersonalTrainerAI.OrderedDict())
+
+    assert linePersonalTrainerAI.get_display_name('U1') == '花子'
+    assert linePersonalTrainerAI.get_display_name('U1') == '花子'
+    assert calls == ['U1']
+
+
+def test_sync_pipeline_fetches_display_name_during_history(worker, monkeypatch):
+    import conversation_store
+    from deadline import Deadline
+    from linebot.models import MessageEvent
+
+    linePersonalTrainerAI = worker[0]
+    monkeypatch.setattr(linePersonalTrainerAI, '_display_names', linePersonalTrainerAI.OrderedDict())
+    profile_started = threading.Event()
+    prompts = []
+
+    def get_profile(user_id):
+        profile_started.set()
+        return FakeProfile('花子')
+
+    def get_history(user_id):
+        # 表示名の取得が会話履歴の取得を待たずに始まっていること
+        assert profile_started.wait(2)
+        return conversation_store.ConversationHistory([], None, [])
+
+    def get_response(user_message, history, deadline, user_name=None):
+        prompts.append(user_name)
+        return '応答'
+    monkeypatch.setattr(linePersonalTrainerAI.line_bot_api, 'get_profile', get_profile)
+    monkeypatch.setattr(linePersonalTrainerAI, 'get_conversation_history', get_history)
+    monkeypatch.setattr(linePersonalTrainerAI, 'get_chatgpt_response', get_response)
+    for name in ('start_loading', 'save_conversation', 'send_reply', 'refresh_summary'):
+        monkeypatch.setattr(linePersonalTrainerAI, name, lambda *args: None)
+
+    event = MessageEvent.new_from_json_dict(line_event('e1', 'U1', 'こんにちは'))
+    linePersonalTrainerAI.handle_message_sync(event, Deadline.from_context(None))
+
+    assert prompts == ['花子']
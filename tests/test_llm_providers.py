@@ -0,0 +1,132 @@
+"""
+llm_providersのサーキットブレーカーとルーター（フォールバック・ヘッジング）のテスト
+プロバイダーはFakeProviderを使い、実際のモデルは呼び出さない
+"""
+import time
+
+import pytest
+
+import llm_providers
+from deadline import Deadline
+from llm_providers import CircuitBreaker, FakeProvider, ProviderRouter, ProviderUnavailable
+
+
+def deadline(budget_ms=5000):
+    return Deadline(time.monotonic() + budget_ms / 1000, budget_ms)
+
+
+def fake(name, **kwargs):
+    kwargs.setdefault('first_chunk_ms', 10)
+    kwargs.setdefault('chunk_ms', 0)
+    return FakeProvider(name, text=f'{name}の応答', **kwargs)
+
+
+def test_breaker_opens_half_opens_and_closes():
+    breaker = CircuitBreaker(failure_threshold=2, cooldown_seconds=0.1)
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert breaker.allow() is False
+
+    time.sleep(0.12)
+    assert breaker.state == 'half_open'
+    # 半開のときは1回だけ試させる
+    assert breaker.allow() is True
+    assert breaker.allow() is False
+
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.allow() is True
+
+
+def test_half_open_failure_reopens():
+    breaker = CircuitBreaker(failure_threshold=3, cooldown_seconds=0.1)
+    for _ in range(3):
+        breaker.record_failure()
+    time.sleep(0.12)
+    assert breaker.allow() is True
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+
+def test_fallback_follows_provider_order():
+    first, second, third = fake('a', error_rate=1.0), fake('b'), fake('c')
+    router = ProviderRouter([first, second, third], hedging=False)
+
+    completion = router.generate('system', [{'role': 'user', 'content': 'hi'}], deadline())
+
+    assert completion.provider == 'b'
+    assert completion.text == 'bの応答'
+    assert (first.calls, second.calls, third.calls) == (1, 1, 0)
+
+
+def test_all_providers_failing_raises():
+    router = ProviderRouter([fake('a', error_rate=1.0), fake('b', error_rate=1.0)], hedging=False)
+    with pytest.raises(ProviderUnavailable):
+        router.generate('system', [], deadline())
+
+
+def test_router_skips_open_breaker_until_half_open_trial_succeeds():
+    failing, backup = fake('a', error_rate=1.0), fake('b')
+    router = ProviderRouter(
+        [failing, backup], hedging=False,
+        breakers={'a': CircuitBreaker(1, 0.2), 'b': CircuitBreaker(1, 0.2)}
+    )
+
+    assert router.generate('system', [], deadline()).provider == 'b'
+    assert router.breakers['a'].state == 'open'
+
+    # サーキットが開いている間は呼び出さない
+    assert router.generate('system', [], deadline()).provider == 'b'
+    assert failing.calls == 1
+
+    # 期間が過ぎたら1回試し、成功すれば閉じる
+    time.sleep(0.25)
+    failing.error_rate = 0.0
+    assert router.generate('system', [], deadline()).provider == 'a'
+    assert failing.calls == 2
+    assert router.breakers['a'].state == 'closed'
+
+
+def test_hedging_uses_faster_provider_and_ignores_loser(monkeypatch):
+    monkeypatch.setattr(llm_providers, 'LLM_HEDGE_DEFAULT_DELAY_MS', 50)
+    slow, fast = fake('slow', first_chunk_ms=800), fake('fast', first_chunk_ms=10)
+    router = ProviderRouter([slow, fast], hedging=True)
+
+    started = time.monotonic()
+    completion = router.generate('system', [], deadline())
+
+    assert time.monotonic() - started < 0.5
+    assert completion.provider == 'fast'
+    assert completion.hedged is True
+    assert completion.text == 'fastの応答'
+    # 負けた方は成功とも失敗とも数えない
+    assert router.breakers['slow'].failures == 0
+    assert router.breakers['slow'].state == 'closed'
+
+
+def test_hedging_keeps_first_provider_when_it_answers_first(monkeypatch):
+    monkeypatch.setattr(llm_providers, 'LLM_HEDGE_DEFAULT_DELAY_MS', 20)
+    primary, hedge = fake('primary', first_chunk_ms=60), fake('hedge', first_chunk_ms=500)
+    router = ProviderRouter([primary, hedge], hedging=True)
+
+    completion = router.generate('system', [], deadline())
+
+    assert completion.provider == 'primary'
+    assert completion.text == 'primaryの応答'
+    assert completion.hedged is True
+    assert hedge.calls == 1
+    assert router.breakers['hedge'].failures == 0
+
+
+def test_hedging_disabled_waits_for_first_provider(monkeypatch):
+    monkeypatch.setattr(llm_providers, 'LLM_HEDGE_DEFAULT_DELAY_MS', 20)
+    primary, backup = fake('primary', first_chunk_ms=100), fake('backup')
+    router = ProviderRouter([primary, backup], hedging=False)
+
+    completion = router.generate('system', [], deadline())
+
+    assert completion.provider == 'primary'
+    assert completion.hedged is False
+    assert backup.calls == 0
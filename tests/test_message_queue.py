@@ -0,0 +1,60 @@
+"""
+message_queueのローカルのキュー（InMemoryQueue / LocalFileQueue）のテスト
+処理できなかったメッセージが、SQSの再配信と同じようにもう一度受信できることを確かめる
+"""
+import os
+
+import pytest
+
+import message_queue
+
+
+@pytest.fixture(params=['memory', 'file'])
+def queue(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(message_queue, 'QUEUE_MAX_RECEIVES', 3)
+    if request.param == 'memory':
+        return message_queue.InMemoryQueue()
+    return message_queue.LocalFileQueue(str(tmp_path))
+
+
+def test_released_message_is_received_again(queue):
+    queue.send_batch([{'id': 'a'}, {'id': 'b'}])
+
+    first, second = queue.receive()
+    assert first.attempts == 1
+    queue.release(first)
+    queue.delete(second)
+
+    [again] = queue.receive()
+    assert again.body == {'id': 'a'}
+    assert again.message_id == first.message_id
+    assert again.attempts == 2
+    queue.delete(again)
+    assert queue.receive() == []
+
+
+def test_message_moves_to_dead_letter_after_max_receives(queue):
+    queue.send_batch([{'id': 'a'}])
+
+    for attempt in range(1, 4):
+        [message] = queue.receive()
+        assert message.attempts == attempt
+        queue.release(message)
+
+    assert queue.receive() == []
+    if isinstance(queue, message_queue.InMemoryQueue):
+        assert [m.body for m in queue.dead_letters] == [{'id': 'a'}]
+    else:
+        assert [name for name in os.listdir(queue.directory) if name.endswith('.dead')]
+
+
+def test_local_file_queue_reclaims_abandoned_message(tmp_path, monkeypatch):
+    queue = message_queue.LocalFileQueue(str(tmp_path))
+    queue.send_batch([{'id': 'a'}])
+    # 受信したまま削除も返却もせずにプロセスが落ちた
+    [message] = queue.receive()
+    assert queue.receive() == []
+
+    monkeypatch.setattr(message_queue, 'LOCAL_QUEUE_VISIBILITY_SECONDS', -1)
+    [again] = queue.receive()
+    assert again.body == {'id': 'a'}
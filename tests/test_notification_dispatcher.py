@@ -0,0 +1,177 @@
+"""
+notificationDispatcherのテスト
+LINEのmulticast APIの代わりにローカルのHTTPサーバーを立て、motoのテーブルに対してdispatch_slotを実行する
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import notification_slots
+from deadline import Deadline
+
+SLOT = '07:30'
+RUN_ID = '2025-01-01T07:30'
+
+
+class LineStandIn:
+    """
+    multicastを受け付けるサーバー
+    受理したリトライキーの再送には409を返し、fail_idsの宛先を含むリクエストには400を返す
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.accepted = {}
+        self.fail_ids = set()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                key = self.headers.get('X-Line-Retry-Key')
+                with stand_in.lock:
+                    stand_in.calls.append((key, payload['to']))
+                    if key in stand_in.accepted:
+                        status = 409
+                    elif stand_in.fail_ids & set(payload['to']):
+                        status = 400
+                    else:
+                        status = 200
+                        stand_in.accepted[key] = payload['to']
+                body = b'{}'
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('x-line-request-id', key)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def delivered(self):
+        """ユーザーごとの受理された回数"""
+        counts = {}
+        for recipients in self.accepted.values():
+            for line_id in recipients:
+                counts[line_id] = counts.get(line_id, 0) + 1
+        return counts
+
+
+@pytest.fixture
+def line_api(monkeypatch):
+    stand_in = LineStandIn()
+    threading.Thread(target=stand_in.server.serve_forever, daemon=True).start()
+    import notificationDispatcher
+    monkeypatch.setattr(notificationDispatcher, 'LINE_API_BASE', stand_in.url)
+    monkeypatch.setattr(notificationDispatcher, 'CHANNEL_ACCESS_TOKEN', 'test')
+    # 少人数で複数のバッチになるように、バッチの上限を小さくする
+    monkeypatch.setattr(notificationDispatcher, 'MULTICAST_LIMIT', 3)
+    monkeypatch.setattr(notificationDispatcher, 'DISPATCH_RESERVE_MS', 0)
+    yield stand_in
+    stand_in.server.shutdown()
+
+
+@pytest.fixture
+def tables(make_table):
+    return (
+        make_table('LineNotificationSlots', 'slotKey', 'lineId'),
+        make_table('LineNotificationLog', 'runId', 'batch'),
+    )
+
+
+def add_members(slot_table, line_ids):
+    for line_id in line_ids:
+        notification_slots.update_slot(line_id, None, SLOT, slot_table)
+
+
+def dispatch(slot_table, log_table, budget_ms=10000, **kwargs):
+    import notificationDispatcher
+    deadline = Deadline(time.monotonic() + budget_ms / 1000, budget_ms)
+    return notificationDispatcher.dispatch_slot(RUN_ID, SLOT, deadline, slot_table, log_table, **kwargs)
+
+
+def test_every_member_is_sent_once(line_api, tables):
+    slot_table, log_table = tables
+    members = [f'U{i:04d}' for i in range(10)]
+    add_members(slot_table, members)
+
+    summary = dispatch(slot_table, log_table)
+
+    assert summary['users'] == 10
+    assert summary['batches'] == 4
+    assert summary['sent'] == 4 and summary['failed'] == 0
+    assert line_api.delivered() == {line_id: 1 for line_id in members}
+
+
+def test_rerun_resumes_by_line_id_when_members_change(line_api, tables):
+    slot_table, log_table = tables
+    add_members(slot_table, [f'U{i:04d}' for i in range(1, 10)])
+    line_api.fail_ids = {'U0005'}
+
+    first = dispatch(slot_table, log_table)
+    assert first['sent'] == 2 and first['failed'] == 1
+
+    # 再実行までにスロットの先頭に入るユーザーが増えても、送信済みのユーザーには送らない
+    add_members(slot_table, ['U0000'])
+    line_api.fail_ids = set()
+    rerun = dispatch(slot_table, log_table)
+
+    assert rerun['skipped'] == 6
+    assert rerun['failed'] == 0
+    assert line_api.delivered() == {f'U{i:04d}': 1 for i in range(10)}
+
+
+def test_rerun_of_failed_batch_reuses_retry_key(line_api, tables):
+    slot_table, log_table = tables
+    add_members(slot_table, [f'U{i:04d}' for i in range(1, 10)])
+    line_api.fail_ids = {'U0005'}
+    dispatch(slot_table, log_table)
+
+    line_api.fail_ids = set()
+    rerun = dispatch(slot_table, log_table)
+
+    assert rerun['sent'] == 1 and rerun['skipped'] == 6
+    keys = {key for key, to in line_api.calls if to == ['U0004', 'U0005', 'U0006']}
+    assert len(keys) == 1
+    assert line_api.delivered() == {f'U{i:04d}': 1 for i in range(1, 10)}
+
+
+def test_rate_limit_wait_is_bounded_by_deadline(line_api, tables):
+    slot_table, log_table = tables
+    add_members(slot_table, [f'U{i:04d}' for i in range(9)])
+
+    started = time.monotonic()
+    # 1回目のmulticastでトークンを使い切り、次のトークンは10秒後（期限の後）になる
+    summary = dispatch(slot_table, log_table, budget_ms=500, max_workers=1, rate_per_second=0.1)
+
+    assert time.monotonic() - started < 2
+    assert summary['sent'] == 1
+    assert summary['deferred'] == 2
+    assert len(line_api.calls) == 1
+
+
+def test_backfill_indexes_existing_profiles(aws, make_table):
+    profiles = make_table('LineUserProfiles', 'lineId')
+    slot_table = make_table('LineNotificationSlots', 'slotKey', 'lineId')
+    profiles.put_item(Item={'lineId': 'U1', 'notificationTime': '07:40'})
+    profiles.put_item(Item={'lineId': 'U2', 'notificationTime': '07:30'})
+    profiles.put_item(Item={'lineId': 'U3', 'notificationTime': '21:00'})
+    profiles.put_item(Item={'lineId': 'U4', 'notificationTime': 'invalid'})
+    profiles.put_item(Item={'lineId': 'U5'})
+
+    assert notification_slots.backfill(profiles, slot_table) == 3
+    # 2回目も同じ結果になる
+    assert notification_slots.backfill(profiles, slot_table) == 3
+
+    assert sorted(notification_slots.iter_slot_members(SLOT, slot_table)) == ['U1', 'U2']
+    assert list(notification_slots.iter_slot_members('21:00', slot_table)) == ['U3']
@@ -0,0 +1,37 @@
+"""
+prompt_builderのキャッシュ（PromptCache）のテスト
+既定では使うたびにプロフィールのバージョンを確かめ、編集した直後のメッセージから新しいプロンプトを使うことを確かめる
+"""
+import pytest
+
+import prompt_builder
+from profile_store import VERSION_ATTRIBUTE
+
+
+@pytest.fixture
+def profiles(make_table):
+    table = make_table('LineUserProfiles', 'lineId')
+    table.put_item(Item={'lineId': 'U1', 'weight': '60', VERSION_ATTRIBUTE: 1})
+    return table
+
+
+def test_profile_edit_is_used_on_next_message(profiles):
+    cache = prompt_builder.PromptCache(lambda: profiles)
+    assert '体重: 60kg' in cache.get_prompt('U1')
+
+    assert '体重: 60kg' in cache.get_prompt('U1')
+    assert cache.counters == {'hits': 0, 'revalidated': 1, 'rendered': 1}
+
+    profiles.put_item(Item={'lineId': 'U1', 'weight': '58', VERSION_ATTRIBUTE: 2})
+    assert '体重: 58kg' in cache.get_prompt('U1')
+    assert cache.counters['rendered'] == 2
+
+
+def test_revalidate_window_is_opt_in(profiles):
+    cache = prompt_builder.PromptCache(lambda: profiles, revalidate_seconds=60)
+    cache.get_prompt('U1')
+    profiles.put_item(Item={'lineId': 'U1', 'weight': '58', VERSION_ATTRIBUTE: 2})
+
+    # 確認し直すまでの間は以前のプロンプトを使う
+    assert '体重: 60kg' in cache.get_prompt('U1')
+    assert cache.counters['hits'] == 1
@@ -0,0 +1,21 @@
+"""
+rate_limitのユーザーごとの制限（UserRateLimiter）のテスト
+複数のスレッドから同時に呼んでも、判定の結果とカウンターが一致することを確かめる
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import rate_limit
+
+
+def test_concurrent_allow_counts_every_call():
+    limiter = rate_limit.UserRateLimiter()
+    users = [f'U{i % 20}' for i in range(400)]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(limiter.allow, users))
+
+    stats = limiter.stats()
+    # freeプランはユーザーごとに満タンのバケット（10個）の分だけ通る
+    assert results.count(True) == stats['allowed'] == 20 * rate_limit.get_plan('free').capacity
+    assert stats['allowed'] + stats['localDenied'] == len(users)
+    assert stats['users'] == 20
@@ -0,0 +1,100 @@
+"""
+response_cacheのテスト
+キーにユーザーごとの情報（表示名・会話履歴）が入らず、同じ質問なら別のユーザーでも同じ応答を使うことを確かめる
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import response_cache
+
+os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+os.environ.setdefault('CHANNEL_ACCESS_TOKEN', 'test')
+os.environ.setdefault('CHANNEL_SECRET', 'test')
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = response_cache.ResponseCache()
+    monkeypatch.setattr(response_cache, '_cache', cache)
+    monkeypatch.setattr(response_cache, 'RESPONSE_CACHE_ENABLED', True)
+    return cache
+
+
+def test_key_ignores_notation():
+    cache = response_cache.ResponseCache()
+    assert cache.make_key('system', 'ジムの後は何を食べればいい？') == cache.make_key('system', 'ジムの後は何を食べればいい')
+    assert cache.make_key('system', 'ＰＦＣバランスとは') == cache.make_key('system', 'pfcバランスとは')
+
+
+def test_key_includes_answer_relevant_profile():
+    cache = response_cache.ResponseCache()
+    assert cache.make_key('system', '質問', {'allergies': 'egg'}) != cache.make_key('system', '質問', {})
+
+
+def test_question_referring_to_context_bypasses(cache):
+    assert response_cache.lookup('system', 'それをもう少し詳しく') == (None, None)
+    assert cache.counters['bypassed'] == 1
+
+
+def test_two_users_share_one_entry(cache, monkeypatch):
+    pytest.importorskip('linebot')
+    import llm_providers
+    import linePersonalTrainerAI
+
+    provider = llm_providers.FakeProvider('fake', text='鶏むね肉がおすすめです', first_chunk_ms=0, chunk_ms=0)
+    monkeypatch.setattr(linePersonalTrainerAI, 'llm_router', llm_providers.ProviderRouter([provider], hedging=False))
+    prompts = []
+    generate = linePersonalTrainerAI.llm_router.generate
+
+    def record(system, messages, *args, **kwargs):
+        prompts.append((system, messages))
+        return generate(system, messages, *args, **kwargs)
+    monkeypatch.setattr(linePersonalTrainerAI.llm_router, 'generate', record)
+
+    first = linePersonalTrainerAI.get_chatgpt_response(
+        'ジムの後は何を食べればいい？', [{'role': 'user', 'content': '昨日は5km走った'}], user_name='花子'
+    )
+    second = linePersonalTrainerAI.get_chatgpt_response(
+        'ジムの後は何を食べればいい', [{'role': 'assistant', 'content': 'お疲れさまです'}] * 6, user_name='太郎'
+    )
+
+    assert first == second == '鶏むね肉がおすすめです'
+    assert provider.calls == 1
+    assert cache.counters['memoryHits'] == 1 and len(cache._entries) == 1
+    # 共有する応答は表示名も会話履歴も含めずに生成する
+    system, messages = prompts[0]
+    assert '花子' not in system
+    assert messages == [{'role': 'user', 'content': 'ジムの後は何を食べればいい？'}]
+
+
+def test_context_question_uses_history_and_name(cache, monkeypatch):
+    pytest.importorskip('linebot')
+    import llm_providers
+    import linePersonalTrainerAI
+
+    router = llm_providers.ProviderRouter([llm_providers.FakeProvider('fake', first_chunk_ms=0)], hedging=False)
+    prompts = []
+    monkeypatch.setattr(router, 'generate', lambda system, messages, *args, **kwargs: prompts.append(
+        (system, messages)) or llm_providers.Completion('はい', 'fake', False, False))
+    monkeypatch.setattr(linePersonalTrainerAI, 'llm_router', router)
+    history = [{'role': 'user', 'content': '昨日は5km走った'}]
+
+    linePersonalTrainerAI.get_chatgpt_response('それはどのくらいの消費カロリー？', history, user_name='花子')
+
+    system, messages = prompts[0]
+    assert '花子' in system
+    assert messages[:-1] == history
+    assert len(cache._entries) == 0
+
+
+def test_concurrent_lookups_are_all_counted(cache):
+    cache.put(cache.make_key('system', '質問0'), '応答')
+    questions = [f'質問{i % 4}' for i in range(200)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda text: response_cache.lookup('system', text), questions))
+
+    stats = cache.stats()
+    assert stats['memoryHits'] == 50
+    assert stats['memoryHits'] + stats['sharedHits'] + stats['misses'] == len(questions)
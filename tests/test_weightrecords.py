@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def handler(make_table):
+    make_table('LineUserProfiles', 'lineId')
+    make_table('LineWeightRecords', 'lineId', 'month')
+    import weightrecords
+    return weightrecords.lambda_handler
+
+
+def post(handler, body):
+    response = handler({'httpMethod': 'POST', 'body': body}, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+@pytest.mark.parametrize('body', [
+    '{"lineId": "U1", "weight": ',
+    '[1, 2]',
+    '"U1"',
+    json.dumps({'lineId': 'U1', 'records': ['65.2']}),
+    json.dumps({'lineId': 'U1', 'records': {'date': '2026-01-01', 'weight': 65}}),
+    json.dumps({'lineId': 'U1', 'records': [{'date': '2026-13-01', 'weight': 65}]}),
+    json.dumps({'lineId': 'U1', 'weight': 'heavy'}),
+    json.dumps({'lineId': 'U1', 'weight': 1000}),
+    json.dumps({'lineId': 'U1'}),
+])
+def test_invalid_bodies_are_rejected_with_400(handler, body):
+    status, _ = post(handler, body)
+    assert status == 400
+
+
+def test_valid_records_are_saved_and_read_back(handler):
+    status, _ = post(handler, json.dumps({'lineId': 'U1', 'records': [
+        {'date': '2026-01-01', 'weight': 65.2}, {'date': '2026-01-02', 'weight': 65.0}
+    ]}))
+    assert status == 200
+    response = handler({'httpMethod': 'GET', 'queryStringParameters': {
+        'lineId': 'U1', 'from': '2026-01-01', 'to': '2026-01-02'
+    }}, None)
+    data = json.loads(response['body'])['data']
+    assert [round(d['weight'], 1) for d in data] == [65.2, 65.0]
+
+
+def test_event_without_method_is_rejected_with_400(handler):
+    response = handler({'requestContext': {}}, None)
+    assert response['statusCode'] == 400
+
+
+def test_unexpected_error_returns_500(handler, monkeypatch):
+    import struct
+    import weight_store
+
+    def broken(*args, **kwargs):
+        raise struct.error('unpack requires a buffer of 124 bytes')
+    monkeypatch.setattr(weight_store, 'read_range', broken)
+
+    response = handler({'httpMethod': 'GET', 'queryStringParameters': {'lineId': 'U1'}}, None)
+    assert response['statusCode'] == 500
+    assert 'unpack' not in response['body']
@@ -1,23 +1,84 @@
 import json
 import time
-import boto3
+import clients
+import notification_slots
+import profile_store
 from botocore.exceptions import ClientError
-from decimal import Decimal
+from http_response import json_response, not_modified, request_header
 
-# DynamoDBのリソースを作成
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table('LineUserProfiles')  # 使用するテーブル名
+# 使用するテーブル名
+TABLE_NAME = 'LineUserProfiles'
 
-def decimal_to_dict(obj):
+# PUTで更新できる項目（GETの fields= で指定できる項目も同じ）
+UPDATEABLE_FIELDS = [
+    'birthDate', 'gender', 'height', 'weight', 'targetWeight', 
+    'targetPeriod', 'motivation', 'pastExperience', 'exerciseFrequency', 
+    'mealFrequency', 'alcoholFrequency', 'allergies', 'restrictions', 
+    'illness', 'priority', 'notificationTime'
+]
+
+def get_table():
+    """DynamoDBのテーブル（最初に使うときに作成し、ウォームスタート時は使い回す）"""
+    return clients.dynamodb_table(TABLE_NAME)
+
+def requested_line_ids(event):
     """
-    Decimal 型を含むオブジェクトをJSONに変換可能な型に変換する関数。
+    複数取得で指定されたlineIdのリスト（指定がなければNone）
+    クエリは lineIds=U1,U2,... 、ボディは {"lineIds": [...]} の形式
     """
-    if isinstance(obj, Decimal):
-        if obj % 1 == 0:
-            return int(obj)  # 整数に変換
-        else:
-            return float(obj)  # 小数に変換
-    raise TypeError("Type not serializable")
+    query = event.get('queryStringParameters') or {}
+    if query.get('lineIds'):
+        return [line_id.strip() for line_id in query['lineIds'].split(',')]
+    body = json.loads(event.get('body') or '{}')
+    if isinstance(body.get('lineIds'), list):
+        return body['lineIds']
+    return None
+
+def requested_fields(event):
+    """
+    GETで返す項目のリスト（指定がなければNone＝全項目）
+    クエリは fields=notificationTime,targetWeight 、ボディは {"fields": [...]} の形式
+    UPDATEABLE_FIELDS にない項目が含まれていればValueErrorを送出する
+    """
+    query = event.get('queryStringParameters') or {}
+    if query.get('fields'):
+        fields = [field.strip() for field in query['fields'].split(',') if field.strip()]
+    else:
+        fields = json.loads(event.get('body') or '{}').get('fields')
+    if not fields or not isinstance(fields, list):
+        return None
+    invalid = [field for field in fields if field not in UPDATEABLE_FIELDS]
+    if invalid:
+        raise ValueError(f"Unknown fields: {', '.join(invalid)}")
+    return fields
+
+def batch_get_response(line_ids, headers, fields=None):
+    """複数ユーザーのプロフィールを読み込み、見つからなかったlineIdと合わせて返す"""
+    line_ids = profile_store.unique_ids(line_ids)
+    if not line_ids:
+        return json_response(400, {'message': 'lineIds is required'}, headers)
+    if len(line_ids) > profile_store.BATCH_GET_MAX_IDS:
+        return json_response(400, {
+            'message': f'Too many lineIds (max {profile_store.BATCH_GET_MAX_IDS})'
+        }, headers)
+
+    profiles = list(profile_store.batch_get_profiles(line_ids, fields=fields))
+    found = {item['lineId'] for item in profiles}
+    return json_response(200, {
+        'message': 'Profiles retrieved successfully!',
+        'data': profiles,
+        'missing': [line_id for line_id in line_ids if line_id not in found]
+    }, headers)
+
+def sync_notification_slot(line_id, old_time, new_time):
+    """
+    通知時刻の索引（notification_slots）を更新する
+    プロフィールの保存は済んでいるので、失敗してもエラーにはせずログに残す
+    """
+    try:
+        notification_slots.update_slot(line_id, old_time, new_time)
+    except Exception as e:
+        print(f"Notification slot update error: {str(e)}")
 
 def lambda_handler(event, context):
     # デバッグ用のログ出力
@@ -27,7 +88,8 @@ def lambda_handler(event, context):
     headers = {
         'Access-Control-Allow-Origin': '*',
         'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-        'Access-Control-Allow-Headers': 'Content-Type',
+        'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
+        'Access-Control-Expose-Headers': 'ETag',
         'Content-Type': 'application/json'
     }
 
@@ -44,37 +106,47 @@ def lambda_handler(event, context):
                                'targetWeight', 'targetPeriod', 'priority', 'motivation']
             for field in required_fields:
                 if field not in body:
-                    return {
-                        'statusCode': 400,
-                        'headers': headers,
-                        'body': json.dumps({'message': f'Missing required field: {field}'})
-                    }
+                    return json_response(400, {'message': f'Missing required field: {field}'}, headers)
             
             # プロフィールIDの生成
             profile_id = f"{body['lineId']}-{str(int(time.time()))}"
             
             # DynamoDBにデータを登録
-            table.put_item(
+            response = get_table().put_item(
                 Item={
                     'lineId': body['lineId'],
                     'profileId': profile_id,
                     'createdAt': str(int(time.time())),
                     'updatedAt': str(int(time.time())),
-                    **body
-                }
+                    **body,
+                    profile_store.VERSION_ATTRIBUTE: profile_store.new_version()
+                },
+                ReturnValues='ALL_OLD'
+            )
+            sync_notification_slot(
+                body['lineId'],
+                response.get('Attributes', {}).get('notificationTime'),
+                body.get('notificationTime')
             )
             
-            return {
-                'statusCode': 200,
-                'headers': headers,
-                'body': json.dumps({
-                    'message': 'Profile created successfully!',
-                    'data': {**body, 'profileId': profile_id}
-                })
-            }
+            return json_response(200, {
+                'message': 'Profile created successfully!',
+                'data': {**body, 'profileId': profile_id}
+            }, headers)
         
         # GETメソッド：プロフィール取得
         elif http_method == 'GET':
+            # 返す項目の指定（fields=notificationTime,targetWeight）
+            try:
+                fields = requested_fields(event)
+            except ValueError as e:
+                return json_response(400, {'message': str(e), 'allowedFields': UPDATEABLE_FIELDS}, headers)
+
+            # 複数ユーザーのプロフィール取得（lineIds=U1,U2,... またはボディの lineIds 配列）
+            line_ids = requested_line_ids(event)
+            if line_ids is not None:
+                return batch_get_response(line_ids, headers, fields)
+
             # クエリパラメータからLineIDを取得
             # デバッグのため、様々な方法で lineId を取得
             line_id = (
@@ -86,37 +158,30 @@ def lambda_handler(event, context):
             print(f"Extracted lineId: {line_id}")
             
             if not line_id:
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({
-                        'message': 'lineId is required',
-                        'details': {
-                            'queryStringParameters': event.get('queryStringParameters'),
-                            'pathParameters': event.get('pathParameters'),
-                            'body': event.get('body')
-                        }
-                    })
-                }
+                return json_response(400, {
+                    'message': 'lineId is required',
+                    'details': {
+                        'queryStringParameters': event.get('queryStringParameters'),
+                        'pathParameters': event.get('pathParameters'),
+                        'body': event.get('body')
+                    }
+                }, headers)
             
-            # DynamoDBからデータを取得
-            response = table.get_item(Key={'lineId': line_id})
+            # DynamoDBからデータを取得（If-None-Matchが一致すればボディなしの304を返す）
+            item, etag, unchanged = profile_store.get_profile_if_modified(
+                line_id, request_header(event, 'If-None-Match'), get_table(), fields=fields
+            )
             
-            if 'Item' in response:
-                return {
-                    'statusCode': 200,
-                    'headers': headers,
-                    'body': json.dumps({
-                        'message': 'Profile retrieved successfully!',
-                        'data': response['Item']
-                    }, default=decimal_to_dict)
-                }
-            else:
-                return {
-                    'statusCode': 404,
-                    'headers': headers,
-                    'body': json.dumps({'message': 'Profile not found'})
-                }
+            if item is None:
+                return json_response(404, {'message': 'Profile not found'}, headers)
+
+            cache_headers = {**headers, 'ETag': etag, 'Cache-Control': profile_store.PROFILE_CACHE_CONTROL}
+            if unchanged:
+                return not_modified(cache_headers)
+            return json_response(200, {
+                'message': 'Profile retrieved successfully!',
+                'data': item
+            }, cache_headers)
         
         # PUTメソッド：プロフィール更新
         elif http_method == 'PUT':
@@ -124,41 +189,39 @@ def lambda_handler(event, context):
             line_id = body.get('lineId')
             
             if not line_id:
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({'message': 'lineId is required'})
-                }
+                return json_response(400, {'message': 'lineId is required'}, headers)
             
             # 更新するデータを準備
             update_parts = []
             expression_attribute_values = {}
 
-            updateable_fields = [
-                'birthDate', 'gender', 'height', 'weight', 'targetWeight', 
-                'targetPeriod', 'motivation', 'pastExperience', 'exerciseFrequency', 
-                'mealFrequency', 'alcoholFrequency', 'allergies', 'restrictions', 
-                'illness', 'priority', 'notificationTime'
-            ]
-
             for key, value in body.items():
-                if key in updateable_fields:
+                if key in UPDATEABLE_FIELDS:
                     update_parts.append(f"#{key} = :{key}")
                     expression_attribute_values[f":{key}"] = value
 
             if update_parts:
                 # 更新式を作成
-                update_expression = "SET " + ", ".join(update_parts) + ", #updatedAt = :updatedAt"
+                update_expression = "SET " + ", ".join(update_parts) + ", #updatedAt = :updatedAt, #version = :version"
                 expression_attribute_values[":updatedAt"] = str(int(time.time()))
+                expression_attribute_values[":version"] = profile_store.new_version()
 
                 # ExpressionAttributeNamesの作成
                 expression_attribute_names = {
-                    f"#{key}": key for key in [field for field in body.keys() if field in updateable_fields]
+                    f"#{key}": key for key in [field for field in body.keys() if field in UPDATEABLE_FIELDS]
                 }
                 expression_attribute_names["#updatedAt"] = "updatedAt"
+                expression_attribute_names["#version"] = profile_store.VERSION_ATTRIBUTE
 
                 try:
-                    response = table.update_item(
+                    # 通知時刻を変える場合は、通知の索引を書き換えるために変更前の値を読んでおく
+                    old_notification_time = None
+                    if 'notificationTime' in body:
+                        old_notification_time = get_table().get_item(
+                            Key={'lineId': line_id}, **profile_store.projection(['notificationTime'])
+                        ).get('Item', {}).get('notificationTime')
+
+                    response = get_table().update_item(
                         Key={
                             'lineId': line_id
                         },
@@ -167,32 +230,22 @@ def lambda_handler(event, context):
                         ExpressionAttributeNames=expression_attribute_names,
                         ReturnValues="UPDATED_NEW"
                     )
+                    if 'notificationTime' in body:
+                        sync_notification_slot(line_id, old_notification_time, body['notificationTime'])
 
-                    return {
-                        'statusCode': 200,
-                        'headers': headers,
-                        'body': json.dumps({
-                            'message': 'User information updated successfully!',
-                            'data': response.get('Attributes', {})
-                        })
-                    }
+                    return json_response(200, {
+                        'message': 'User information updated successfully!',
+                        'data': response.get('Attributes', {})
+                    }, headers)
 
                 except Exception as e:
                     print(f"Update error: {str(e)}")
-                    return {
-                        'statusCode': 500,
-                        'headers': headers,
-                        'body': json.dumps({
-                            'message': 'Failed to update item',
-                            'error': str(e)
-                        })
-                    }
+                    return json_response(500, {
+                        'message': 'Failed to update item',
+                        'error': str(e)
+                    }, headers)
             else:
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({'message': 'No valid fields to update'})
-                }
+                return json_response(400, {'message': 'No valid fields to update'}, headers)
         
         # DELETEメソッド：プロフィール削除
         elif http_method == 'DELETE':
@@ -200,26 +253,19 @@ def lambda_handler(event, context):
             line_id = body.get('lineId')
             
             if not line_id:
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({'message': 'lineId is required'})
-                }
+                return json_response(400, {'message': 'lineId is required'}, headers)
             
             # アイテムの削除
-            table.delete_item(
+            response = get_table().delete_item(
                 Key={'lineId': line_id},
                 ReturnValues='ALL_OLD'
             )
+            sync_notification_slot(line_id, response.get('Attributes', {}).get('notificationTime'), None)
             
-            return {
-                'statusCode': 200,
-                'headers': headers,
-                'body': json.dumps({
-                    'message': 'Item deleted successfully',
-                    'lineId': line_id
-                })
-            }
+            return json_response(200, {
+                'message': 'Item deleted successfully',
+                'lineId': line_id
+            }, headers)
         
         # OPTIONSメソッド：CORS プリフライトリクエスト
         elif http_method == 'OPTIONS':
@@ -231,24 +277,16 @@ def lambda_handler(event, context):
         
         # サポートされていないメソッド
         else:
-            return {
-                'statusCode': 405,
-                'headers': headers,
-                'body': json.dumps({'message': 'Method Not Allowed'})
-            }
+            return json_response(405, {'message': 'Method Not Allowed'}, headers)
     
     except ClientError as e:
         # ClientError の詳細なログ出力
         print(f"ClientError: {str(e)}")
         
-        return {
-            'statusCode': 500,
-            'headers': headers,
-            'body': json.dumps({
-                'message': 'An error occurred',
-                'error': str(e)
-            })
-        }
+        return json_response(500, {
+            'message': 'An error occurred',
+            'error': str(e)
+        }, headers)
     except Exception as e:
         # より詳細なエラーログ
         print(f"Error: {str(e)}")
@@ -256,12 +294,8 @@ def lambda_handler(event, context):
         import traceback
         traceback.print_exc()  # tracebackを表示
 
-        return {
-            'statusCode': 500,
-            'headers': headers,
-            'body': json.dumps({
-                'message': 'Unexpected error',
-                'error': str(e),
-                'type': str(type(e))
-            })
-        }
\ No newline at end of file
+        return json_response(500, {
+            'message': 'Unexpected error',
+            'error': str(e),
+            'type': str(type(e))
+        }, headers)
\ No newline at end of file
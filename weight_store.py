@@ -0,0 +1,272 @@
+"""
+体重記録の時系列データ
+1日1件の体重を、ユーザー×月ごとに1アイテム（31日分のfloat32を詰めたバイナリ）で保存する
+1年分のグラフでも読み込むのは12〜13アイテム（1回のQuery）で済む
+集計（日・週・月ごとの平均と目標体重に対する傾向）はnumpyがあればベクトル演算で行う
+"""
+import logging
+import math
+import os
+import random
+import sys
+import time
+from array import array
+from collections import namedtuple
+from datetime import date, timedelta
+
+import clients
+
+logger = logging.getLogger()
+
+TABLE_NAME = os.getenv('WEIGHT_RECORDS_TABLE', 'LineWeightRecords')
+
+# 1アイテムに入る日数（月の日数に関係なく31枠）
+DAYS_PER_BUCKET = 31
+# 同時に書き込まれたときに読み込みからやり直す回数
+WRITE_MAX_RETRIES = int(os.getenv('WEIGHT_WRITE_MAX_RETRIES', '5'))
+# 傾向の計算に使う直近の日数
+TREND_WINDOW_DAYS = int(os.getenv('WEIGHT_TREND_WINDOW_DAYS', '28'))
+# これより先になる到達見込みは出さない（変化がほとんどない場合）
+MAX_ESTIMATE_DAYS = 3 * 365
+
+RESOLUTIONS = ('daily', 'weekly', 'monthly')
+
+# 期間ごとの集計結果（start: 期間の最初の日）
+Aggregate = namedtuple('Aggregate', ['start', 'average', 'min', 'max', 'count'])
+
+
+_numpy = False
+
+
+def get_numpy():
+    """
+    numpy（インストールされていなければNone）
+    読み込みに時間がかかるので、コールドスタートで読み込まないように集計するときまで遅らせる
+    """
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+
+def get_table():
+    """DynamoDBのテーブル（最初に使うときに作成し、ウォームスタート時は使い回す）"""
+    return clients.dynamodb_table(TABLE_NAME)
+
+
+def month_key(day):
+    return f"{day.year:04d}-{day.month:02d}"
+
+
+def month_start(key):
+    year, month = key.split('-')
+    return date(int(year), int(month), 1)
+
+
+def empty_bucket():
+    return array('f', [math.nan] * DAYS_PER_BUCKET)
+
+
+def pack(values):
+    """float32のリトルエンディアンのバイト列に変換"""
+    if sys.byteorder == 'big':
+        values = array('f', values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def unpack(item):
+    """アイテムの weights（バイナリ）を31日分の配列に戻す"""
+    if not item or 'weights' not in item:
+        return empty_bucket()
+    raw = item['weights']
+    # boto3のリソースはバイナリを boto3.dynamodb.types.Binary で返す
+    raw = getattr(raw, 'value', raw)
+    values = array('f')
+    values.frombytes(bytes(raw))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _update_month(table, line_id, key, changes):
+    """
+    1か月分のアイテムを読み込んで変更し、versionの条件付きで書き戻す
+    他の書き込みと競合した場合は読み込みからやり直す
+    """
+    from botocore.exceptions import ClientError
+
+    for attempt in range(WRITE_MAX_RETRIES + 1):
+        item = table.get_item(Key={'lineId': line_id, 'month': key}, ConsistentRead=True).get('Item')
+        values = unpack(item)
+        for day, weight in changes.items():
+            values[day - 1] = math.nan if weight is None else float(weight)
+
+        version = int(item['version']) if item else 0
+        if version:
+            condition = {
+                'ConditionExpression': '#version = :version',
+                'ExpressionAttributeNames': {'#version': 'version'},
+                'ExpressionAttributeValues': {':version': version}
+            }
+        else:
+            condition = {'ConditionExpression': 'attribute_not_exists(lineId)'}
+
+        try:
+            table.put_item(
+                Item={
+                    'lineId': line_id,
+                    'month': key,
+                    'weights': pack(values),
+                    'version': version + 1,
+                    'updatedAt': str(int(time.time()))
+                },
+                **condition
+            )
+            return
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException' or attempt == WRITE_MAX_RETRIES:
+                raise
+            logger.info(f"体重記録の書き込みが競合したため再試行します: {line_id} {key}")
+            time.sleep(random.uniform(0, 0.02 * (2 ** attempt)))
+
+
+def put_weights(line_id, records, table=None):
+    """
+    体重を記録する（records: (日付, 体重) のリスト。体重がNoneならその日の記録を消す）
+    月ごとにまとめて、1か月につき1回の読み込みと書き込みで反映する
+    """
+    table = table or get_table()
+    months = {}
+    for day, weight in records:
+        months.setdefault(month_key(day), {})[day.day] = weight
+    for key, changes in sorted(months.items()):
+        _update_month(table, line_id, key, changes)
+
+
+def read_range(line_id, start, end, table=None):
+    """
+    期間内（start〜endの両端を含む）の記録を日付の古い順に返す
+    戻り値は (日付のリスト, 体重のリスト)。記録のない日は含まない
+    """
+    from boto3.dynamodb.conditions import Key
+
+    table = table or get_table()
+    kwargs = {
+        'KeyConditionExpression': Key('lineId').eq(line_id) & Key('month').between(month_key(start), month_key(end)),
+        'ProjectionExpression': '#month, weights',
+        'ExpressionAttributeNames': {'#month': 'month'}
+    }
+    days = []
+    weights = []
+    while True:
+        response = table.query(**kwargs)
+        for item in response['Items']:
+            first = month_start(item['month'])
+            for index, weight in enumerate(unpack(item)):
+                if math.isnan(weight):
+                    continue
+                day = first + timedelta(days=index)
+                # 31枠のうち月の日数を超える枠は使わない
+                if day.month != first.month or not start <= day <= end:
+                    continue
+                days.append(day)
+                weights.append(round(weight, 2))
+        if 'LastEvaluatedKey' not in response:
+            return days, weights
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def period_start(day, resolution):
+    if resolution == 'weekly':
+        return day - timedelta(days=day.weekday())
+    if resolution == 'monthly':
+        return day.replace(day=1)
+    return day
+
+
+def aggregate(days, weights, resolution='daily'):
+    """日付の古い順の記録を、日・週（月曜始まり）・月ごとに集計する"""
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"resolution must be one of {', '.join(RESOLUTIONS)}")
+    if not days:
+        return []
+    starts = [period_start(day, resolution) for day in days]
+
+    numpy = get_numpy()
+    if numpy is not None:
+        values = numpy.asarray(weights, dtype=numpy.float64)
+        ordinals = numpy.fromiter((s.toordinal() for s in starts), dtype=numpy.int64, count=len(starts))
+        # 記録は日付順なので、同じ期間の記録は連続している
+        keys, offsets, counts = numpy.unique(ordinals, return_index=True, return_counts=True)
+        sums = numpy.add.reduceat(values, offsets)
+        mins = numpy.minimum.reduceat(values, offsets)
+        maxs = numpy.maximum.reduceat(values, offsets)
+        return [
+            Aggregate(date.fromordinal(int(key)), round(float(total / count), 2), float(low), float(high), int(count))
+            for key, total, low, high, count in zip(keys, sums, mins, maxs, counts)
+        ]
+
+    groups = {}
+    for start, weight in zip(starts, weights):
+        groups.setdefault(start, []).append(weight)
+    return [
+        Aggregate(start, round(sum(values) / len(values), 2), min(values), max(values), len(values))
+        for start, values in groups.items()
+    ]
+
+
+def _slope_per_day(days, weights):
+    """最小二乗法による1日あたりの体重の変化"""
+    numpy = get_numpy()
+    if numpy is not None:
+        x = numpy.fromiter((day.toordinal() for day in days), dtype=numpy.float64, count=len(days))
+        y = numpy.asarray(weights, dtype=numpy.float64)
+        x -= x.mean()
+        denominator = float(numpy.dot(x, x))
+        return float(numpy.dot(x, y - y.mean())) / denominator if denominator else 0.0
+
+    x = [day.toordinal() for day in days]
+    mean_x = sum(x) / len(x)
+    mean_y = sum(weights) / len(weights)
+    denominator = sum((v - mean_x) ** 2 for v in x)
+    if not denominator:
+        return 0.0
+    return sum((v - mean_x) * (w - mean_y) for v, w in zip(x, weights)) / denominator
+
+
+def trend(days, weights, target_weight=None, window_days=TREND_WINDOW_DAYS):
+    """
+    直近window_days日の記録から傾向を計算する
+    目標体重があれば、目標までの差と、今のペースで到達する見込みの日付を返す
+    """
+    if not days:
+        return None
+    since = days[-1] - timedelta(days=window_days - 1)
+    recent = [(day, weight) for day, weight in zip(days, weights) if day >= since]
+    recent_days = [day for day, _ in recent]
+    recent_weights = [weight for _, weight in recent]
+
+    slope = _slope_per_day(recent_days, recent_weights) if len(recent) >= 2 else 0.0
+    result = {
+        'latestDate': days[-1].isoformat(),
+        'latestWeight': weights[-1],
+        'changePerWeek': round(slope * 7, 2),
+        'windowDays': window_days,
+        'samples': len(recent)
+    }
+    if target_weight is not None:
+        target_weight = float(target_weight)
+        remaining = weights[-1] - target_weight
+        result['targetWeight'] = target_weight
+        result['remaining'] = round(remaining, 2)
+        # 目標に向かって変化しているときだけ到達見込みを出す
+        if remaining and slope and (remaining > 0) == (slope < 0):
+            days_left = math.ceil(abs(remaining / slope))
+            if days_left <= MAX_ESTIMATE_DAYS:
+                result['estimatedTargetDate'] = (days[-1] + timedelta(days=days_left)).isoformat()
+    return result
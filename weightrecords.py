@@ -0,0 +1,174 @@
+import json
+import logging
+from datetime import date, datetime, timedelta, timezone
+import profile_store
+import weight_store
+from botocore.exceptions import ClientError
+from http_response import json_response
+
+logger = logging.getLogger()
+
+# 日付の基準にするタイムゾーン（日本時間）
+JST = timezone(timedelta(hours=9))
+
+# 期間を指定しなかったときに返す日数
+DEFAULT_RANGE_DAYS = 90
+# 1回のリクエストで取得できる最大の日数
+MAX_RANGE_DAYS = 3 * 366
+# 記録できる体重の範囲（kg）
+MIN_WEIGHT = 20
+MAX_WEIGHT = 300
+
+def today():
+    return datetime.now(JST).date()
+
+def parse_date(value, default=None):
+    """YYYY-MM-DD 形式の日付（指定がなければdefault）"""
+    if not value:
+        return default
+    return date.fromisoformat(str(value)[:10])
+
+def parse_weight(value):
+    """体重の値を検証してfloatに変換"""
+    weight = float(value)
+    if not MIN_WEIGHT <= weight <= MAX_WEIGHT:
+        raise ValueError(f"weight must be between {MIN_WEIGHT} and {MAX_WEIGHT}")
+    return weight
+
+def get_target_weight(line_id):
+    """プロフィールの目標体重（未設定ならNone）"""
+    item = profile_store.get_table().get_item(
+        Key={'lineId': line_id}, **profile_store.projection(['targetWeight'])
+    ).get('Item') or {}
+    try:
+        return float(item['targetWeight'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def get_records(event, headers):
+    """
+    体重記録の取得
+    クエリ: lineId（必須）, from / to（YYYY-MM-DD、既定は直近90日）, resolution（daily / weekly / monthly）
+    """
+    query = event.get('queryStringParameters') or {}
+    line_id = query.get('lineId')
+    if not line_id:
+        return json_response(400, {'message': 'lineId is required'}, headers)
+
+    try:
+        end = parse_date(query.get('to'), today())
+        start = parse_date(query.get('from'), end - timedelta(days=DEFAULT_RANGE_DAYS - 1))
+    except ValueError:
+        return json_response(400, {'message': 'from / to must be YYYY-MM-DD'}, headers)
+    if start > end or (end - start).days >= MAX_RANGE_DAYS:
+        return json_response(400, {'message': f'Invalid range (max {MAX_RANGE_DAYS} days)'}, headers)
+
+    resolution = query.get('resolution', 'daily')
+    if resolution not in weight_store.RESOLUTIONS:
+        return json_response(400, {
+            'message': f"resolution must be one of {', '.join(weight_store.RESOLUTIONS)}"
+        }, headers)
+
+    days, weights = weight_store.read_range(line_id, start, end)
+    if resolution == 'daily':
+        series = [{'date': day.isoformat(), 'weight': weight} for day, weight in zip(days, weights)]
+    else:
+        series = [
+            {
+                'start': period.start.isoformat(),
+                'average': period.average,
+                'min': period.min,
+                'max': period.max,
+                'count': period.count
+            }
+            for period in weight_store.aggregate(days, weights, resolution)
+        ]
+
+    return json_response(200, {
+        'message': 'Weight records retrieved successfully!',
+        'lineId': line_id,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'resolution': resolution,
+        'data': series,
+        'trend': weight_store.trend(days, weights, get_target_weight(line_id))
+    }, headers)
+
+def put_records(event, headers, delete=False):
+    """
+    体重の記録（POST）と削除（DELETE）
+    ボディ: {"lineId": ..., "date": "YYYY-MM-DD", "weight": 65.2}
+    または {"lineId": ..., "records": [{"date": ..., "weight": ...}, ...]}（dateの既定は今日）
+    """
+    try:
+        body = json.loads(event.get('body') or '{}')
+    except ValueError:
+        return json_response(400, {'message': 'Body must be valid JSON'}, headers)
+    if not isinstance(body, dict):
+        return json_response(400, {'message': 'Body must be a JSON object'}, headers)
+    line_id = body.get('lineId')
+    if not line_id:
+        return json_response(400, {'message': 'lineId is required'}, headers)
+
+    entries = body.get('records') or [body]
+    if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+        return json_response(400, {'message': 'records must be a list of objects'}, headers)
+    try:
+        records = [
+            (parse_date(entry.get('date'), today()), None if delete else parse_weight(entry['weight']))
+            for entry in entries
+        ]
+    except KeyError:
+        return json_response(400, {'message': 'weight is required'}, headers)
+    except (TypeError, ValueError) as e:
+        return json_response(400, {'message': f'Invalid record: {e}'}, headers)
+
+    weight_store.put_weights(line_id, records)
+    return json_response(200, {
+        'message': 'Weight records deleted successfully!' if delete else 'Weight records saved successfully!',
+        'lineId': line_id,
+        'data': [{'date': day.isoformat(), 'weight': weight} for day, weight in records]
+    }, headers)
+
+def lambda_handler(event, context):
+    # デフォルトのレスポンスヘッダー（CORS対応）
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type',
+        'Content-Type': 'application/json'
+    }
+
+    try:
+        # API Gatewayのペイロード形式 1.0 と 2.0 の両方に対応
+        http_method = event.get('httpMethod') or event["requestContext"]["http"]["method"]
+
+        if http_method == 'GET':
+            return get_records(event, headers)
+        elif http_method == 'POST':
+            return put_records(event, headers)
+        elif http_method == 'DELETE':
+            return put_records(event, headers, delete=True)
+        elif http_method == 'OPTIONS':
+            return {
+                'statusCode': 200,
+                'headers': headers,
+                'body': ''
+            }
+        else:
+            return json_response(405, {'message': 'Method Not Allowed'}, headers)
+
+    except ClientError as e:
+        logger.error(f"ClientError: {str(e)}")
+        return json_response(500, {
+            'message': 'An error occurred',
+            'error': str(e)
+        }, headers)
+    except (KeyError, ValueError) as e:
+        # 入力の解釈で検出できなかった不正なリクエスト
+        logger.warning(f"不正なリクエストです: {e!r}")
+        return json_response(400, {'message': 'Invalid request'}, headers)
+    except Exception:
+        # 保存済みの記録の読み込み（struct.errorなど）を含む、想定外のエラー
+        logger.exception("体重記録の処理で予期しないエラーが発生しました")
+        return json_response(500, {'message': 'Internal server error'}, headers)